@@ -0,0 +1,574 @@
+# bench.py
+# ==========================================
+# بنچمارک‌های آفلاین: Bot API محلی (fakeapi.py) + دیتابیس موقت
+# python bench.py updates --users 200 --messages 10
+# python bench.py db --threads 8 --ops 2000
+# python bench.py claim --buyers 500 --stock 300
+# python bench.py stats --rows 1000000   (exit 1 اگه منتظرهای کش آمار گیر کنن)
+# python bench.py expiry --purchases 5000
+# python bench.py state --users 1000000
+# python bench.py keyboards          (کیبورد ساخته‌شده + serialize به ازای هر پاسخ)
+# python bench.py router             (همه‌ی دکمه‌ها/stepها/کال‌بک‌ها مسیر دارن؟ + زمان dispatch)
+# python bench.py explain            (کوئری‌های پرتکرار نباید full scan باشن)
+# ==========================================
+
+import os, sys, asyncio, time, argparse, tempfile
+
+os.environ.setdefault("FAKE_BOT_API", "1")
+os.environ.setdefault("BOT_TOKEN", "123456:FAKE")
+os.environ.setdefault("BASE_URL", "http://localhost")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+# دیتابیس بنچمارک نباید روی bot.db واقعی بنویسه
+os.chdir(tempfile.mkdtemp(prefix="aali-bench-"))
+
+import main  # noqa: E402
+
+
+def report(title: str, rows):
+    print(f"\n== {title} ==")
+    for k, v in rows:
+        print(f"{k:>24}: {v}")
+
+
+async def bench_updates(users: int, messages: int):
+    api = main.fake_api
+    api.record_sent = False
+    script = ["/start", "ℹ️ آموزش", "📊 آمار فروش", "🎟️ تیکت‌ها", "💳 کیف پول"]
+    total = 0
+    for i in range(messages):
+        for uid in range(1, users + 1):
+            api.push_text(100000 + uid, script[i % len(script)])
+            total += 1
+
+    await main.start_bot(webhook=False)
+    stop = asyncio.Event()
+    poller = asyncio.create_task(main.poll_updates(stop))
+    t0 = time.perf_counter()
+    while main.ingest.processed + main.ingest.failed < total:
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - t0
+    stop.set()
+    poller.cancel()
+    await asyncio.gather(poller, return_exceptions=True)
+    await main.stop_bot()
+
+    m = main.ingest.metrics()
+    sm = main.session_stats.metrics()
+    report("updates", [
+        ("updates", total),
+        ("elapsed_s", round(elapsed, 3)),
+        ("updates_per_s", round(total / elapsed, 1)),
+        ("outbound_calls", sum(v for k, v in api.calls.items() if k.startswith("send"))),
+        ("outbound_bytes", api.bytes_out),
+        ("failed", m["failed"]),
+        ("wait_avg_ms", m["wait_avg_ms"]),
+        ("wait_max_ms", m["wait_max_ms"]),
+        ("db_sessions_per_update", sm["sessions_per_update_avg"]),
+        ("db_sessions_max", sm["sessions_per_update_max"]),
+    ])
+
+
+async def bench_outbound(chats: int, messages: int, flood_every: int):
+    api = main.fake_api
+    api.flood_every = flood_every
+    await main.application.initialize()
+    bot = main.application.bot
+    t0 = time.perf_counter()
+
+    async def one(chat_id, i):
+        try:
+            await bot.send_message(chat_id=chat_id, text=f"msg {i}")
+        except Exception:
+            pass
+
+    await asyncio.gather(*(one(200000 + c, i) for i in range(messages) for c in range(chats)))
+    elapsed = time.perf_counter() - t0
+    await main.application.shutdown()
+    m = main.outbound.metrics()
+    report("outbound", [
+        ("requested", chats * messages),
+        ("delivered", api.calls["sendMessage"]),
+        ("elapsed_s", round(elapsed, 3)),
+        ("msgs_per_s", round(api.calls["sendMessage"] / elapsed, 1)),
+        ("fake_429", api.calls["429"]),
+        ("sent", m["sent"]), ("throttled", m["throttled"]), ("retried", m["retried"]), ("failed", m["failed"]),
+    ])
+
+
+def bench_db(threads: int, ops: int, write_every: int):
+    # پروفایل tuned و default روی دو فایل جدا با همون بار ترکیبی خواندن/نوشتن
+    from concurrent.futures import ThreadPoolExecutor
+    from sqlalchemy.exc import OperationalError
+    from sqlalchemy.orm import sessionmaker
+
+    rows = []
+    for profile in ("default", "tuned"):
+        eng = main.make_engine(f"sqlite:///bench-{profile}.db", profile=profile)
+        main.Base.metadata.create_all(eng)
+        Session = sessionmaker(bind=eng, expire_on_commit=False)
+        db = Session()
+        db.add(main.Plan(name="p", days=30, volume_gb=50, price=100, cost_price=50))
+        db.add_all(main.User(id=i, username=f"u{i}") for i in range(1, 201))
+        db.commit()
+        db.close()
+        locked = 0
+
+        def work(n):
+            nonlocal locked
+            db = Session()
+            try:
+                uid = n % 200 + 1
+                if n % write_every == 0:
+                    db.add(main.Purchase(user_id=uid, plan_id=1, price_paid=100,
+                                         expire_at=main.now() + main.dt.timedelta(days=30)))
+                    db.query(main.User).filter(main.User.id == uid).update({"wallet": main.User.wallet + 1})
+                    db.commit()
+                else:
+                    db.query(main.Purchase).filter(main.Purchase.user_id == uid, main.Purchase.active == True).all()
+            except OperationalError:
+                locked += 1
+                db.rollback()
+            finally:
+                db.close()
+
+        t0 = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            list(pool.map(work, range(ops)))
+        elapsed = time.perf_counter() - t0
+        eng.dispose()
+        rows += [(f"{profile}_ops_per_s", round(ops / elapsed, 1)), (f"{profile}_locked", locked)]
+    report(f"db ({threads} threads, 1 write / {write_every} ops)", rows)
+
+
+async def bench_claim(buyers: int, stock: int, buffer: int) -> int:
+    # خریدهای همزمان روی یک پلن: هیچ کانفیگی نباید دوبار تحویل بشه
+    # --buffer N: با InventoryBuffer (N کانفیگ رزرو‌شده در حافظه) همراه refiller
+    def setup(db):
+        plan = main.Plan(name="claim", days=30, volume_gb=10, price=1, cost_price=0)
+        db.add(plan)
+        db.flush()
+        db.add_all(main.User(id=300000 + i, wallet=10) for i in range(buyers))
+        for i in range(stock):
+            main.stock_counters.add(db, plan.id, content_type="text", text_content=f"cfg-{i}")
+        db.commit()
+        return plan.id
+
+    pid = await main.run_db(setup)
+    refiller = None
+    if buffer:
+        main.inventory.size = buffer
+        await main.run_db(main.inventory.refill)
+        refiller = asyncio.create_task(main.inventory.refill_loop())
+    t0 = time.perf_counter()
+    results = await asyncio.gather(
+        *(main.run_db(main.db_purchase, 300000 + i, pid, 1.0, None) for i in range(buyers)),
+        return_exceptions=True,
+    )
+    elapsed = time.perf_counter() - t0
+    if refiller:
+        refiller.cancel()
+        await asyncio.gather(refiller, return_exceptions=True)
+        await main.run_db(main.inventory.release)
+    delivered = [r for r in results if isinstance(r, main.Purchase)]
+    errors = [r for r in results if isinstance(r, Exception)]
+    ids = [p.config_payload_id for p in delivered]
+    left, counter = await main.run_db(lambda db: (
+        db.query(main.ConfigItem).filter(main.ConfigItem.plan_id == pid).count(),
+        db.get(main.Plan, pid).stock,
+    ))
+    double = len(ids) - len(set(ids))
+    report(f"claim ({buyers} buyers, {stock} configs, {main.DB_POOL_SIZE} db threads)", [
+        ("delivered", len(delivered)),
+        ("empty", sum(1 for r in results if r == "empty")),
+        ("errors", len(errors)),
+        ("double_delivery", double),
+        ("repo_left", left),
+        ("stock_counter", counter),
+        ("elapsed_s", round(elapsed, 3)),
+        ("purchases_per_s", round(buyers / elapsed, 1)),
+    ] + ([(f"buffer_{k}", v) for k, v in main.inventory.metrics().items() if k in
+          ("hits", "misses", "hit_rate", "lease_lost", "refill_avg_ms", "refill_max_ms")] if buffer else []))
+    for e in errors[:3]:
+        print(" ", repr(e))
+    ok = double == 0 and not errors and len(delivered) == min(buyers, stock) and left == counter == stock - len(delivered)
+    return 0 if ok else 1
+
+
+def bench_stats(rows: int, legacy: bool):
+    # آمار فروش روی جدول purchases بزرگ: زمان و پیک حافظه‌ی پایتون (tracemalloc)
+    import random, tracemalloc
+    from sqlalchemy import insert
+
+    with main.engine.begin() as conn:
+        conn.execute(insert(main.Plan), [
+            {"id": i, "name": f"p{i}", "days": 30, "volume_gb": 10 * i, "price": 100.0 * i, "cost_price": 40.0 * i}
+            for i in range(1, 6)
+        ])
+        t = main.now()
+        chunk = 50000
+        for start in range(0, rows, chunk):
+            conn.execute(insert(main.Purchase), [{
+                "user_id": random.randint(1, 5000), "plan_id": random.randint(1, 5),
+                "created_at": t - main.dt.timedelta(minutes=random.randint(0, 60 * 24 * 120)),
+                "expire_at": t, "price_paid": float(random.randint(50, 500)), "active": random.random() < 0.9,
+            } for _ in range(start, min(rows, start + chunk))])
+
+    def measure(fn):
+        db = main.SessionLocal()
+        tracemalloc.start()
+        t0 = time.perf_counter()
+        try:
+            res = fn(db)
+        finally:
+            elapsed = time.perf_counter() - t0
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            db.close()
+        return res, round(elapsed, 3), round(peak / 1024 / 1024, 2)
+
+    # درج مستقیم از رول‌آپ رد نمیشه؛ مثل دیتابیس قدیمی از تاریخچه می‌سازیم
+    buckets, rebuild_s, rebuild_mb = measure(main.sales_rollup.rebuild)
+    (s7, s30, sreset, _tb), sec, mb = measure(main.db_admin_stats)
+    out = [("rows", rows), ("rollup_rebuild_s", rebuild_s), ("rollup_rebuild_peak_mb", rebuild_mb),
+           ("rollup_buckets", buckets), ("admin_panel_s", sec), ("admin_panel_peak_mb", mb),
+           ("30d_count", s30[3]), ("30d_profit", round(s30[2], 1))]
+    if legacy:
+        # روش قبلی: همه‌ی خریدهای فعال به پایتون + lazy load پلن، برای هر بازه جدا
+        def old_calc(db, since):
+            q = db.query(main.Purchase).filter(main.Purchase.active == True)
+            if since:
+                q = q.filter(main.Purchase.created_at >= since)
+            sale = cost = 0.0
+            for p in q.all():
+                sale += p.price_paid
+                if p.plan and p.plan.cost_price:
+                    cost += p.plan.cost_price
+            return sale, cost, sale - cost
+        (sale, cost, profit), sec, mb = measure(lambda db: old_calc(db, main.now() - main.dt.timedelta(days=30)))
+        out += [("legacy_30d_s", sec), ("legacy_30d_peak_mb", mb), ("legacy_30d_profit", round(profit, 1))]
+    bad = asyncio.run(check_render_cache())
+    out.append(("cache_stuck_waiters", bad))
+    report("stats", out)
+    return 1 if bad else 0
+
+
+async def check_render_cache() -> int:
+    # single-flight پنل آمار: اگه سازنده cancel بشه یا خطا بده، منتظرها نباید تا ابد بمونن
+    cache = main.RenderCache(60)
+    gate = asyncio.Event()
+
+    async def slow():
+        await gate.wait()
+        return "late"
+
+    async def ok():
+        return "ok"
+
+    async def boom():
+        await gate.wait()
+        raise RuntimeError("boom")
+
+    stuck = 0
+    leader = asyncio.create_task(cache.get("v", slow))
+    await asyncio.sleep(0)
+    waiters = [asyncio.create_task(cache.get("v", ok)) for _ in range(5)]
+    await asyncio.sleep(0)
+    leader.cancel()
+    done, pending = await asyncio.wait(waiters, timeout=2)
+    stuck += len(pending)
+    stuck += sum(1 for t in done if t.cancelled() or t.exception() or t.result() != "ok")
+    for t in pending:
+        t.cancel()
+
+    leader = asyncio.create_task(cache.get("e", boom))
+    await asyncio.sleep(0)
+    waiters = [asyncio.create_task(cache.get("e", ok)) for _ in range(5)]
+    await asyncio.sleep(0)
+    gate.set()
+    done, pending = await asyncio.wait([leader, *waiters], timeout=2)
+    stuck += len(pending)
+    stuck += sum(1 for t in done if t.cancelled() or not isinstance(t.exception(), RuntimeError))
+    for t in pending:
+        t.cancel()
+    return stuck + len(cache.inflight)
+
+
+async def bench_expiry(purchases: int) -> int:
+    # «آخر ماه»: همه با هم منقضی میشن؛ یک UPDATE گروهی + ارسال همزمان از مسیر outbound
+    from sqlalchemy import insert
+    api = main.fake_api
+    api.record_sent = False
+    t = main.now()
+    with main.engine.begin() as conn:
+        conn.execute(insert(main.Plan), [{"id": 1, "name": "p", "days": 30, "volume_gb": 10, "price": 100.0, "cost_price": 40.0}])
+        conn.execute(insert(main.Purchase), [{
+            "user_id": 400000 + i, "plan_id": 1, "created_at": t - main.dt.timedelta(days=30),
+            "expire_at": t - main.dt.timedelta(minutes=1), "price_paid": 100.0, "active": True,
+        } for i in range(purchases)])
+    await main.run_db(main.sales_rollup.rebuild)
+    await main.application.initialize()
+    await main.expiry_scheduler.run(main.application.bot)
+    await main.application.shutdown()
+    r = main.expiry_scheduler.last_run
+    left, (all_sale, _c, _p, all_count) = await main.run_db(lambda db: (
+        db.query(main.Purchase).filter(main.Purchase.active == True).count(), main.get_stats_all(db)))
+    report(f"expiry ({purchases} due at once)", [
+        ("expired", r["expired"]), ("sent", r["sent"]), ("failed", r["failed"]),
+        ("duration_ms", r["duration_ms"]), ("still_active", left), ("rollup_count_after", all_count),
+    ])
+    return 0 if r["expired"] == purchases and left == 0 and all_count == 0 else 1
+
+
+def bench_state(users: int, active_pct: float, maxsize: int):
+    # حافظه‌ی state: dict-of-dicts قبلی (هر کاربری که پیام داده) در برابر UserState و استور محدود
+    import tracemalloc
+    S = main.Step
+    flows = [
+        lambda: {"step": S.PAY_MENU, "selected_plan_id": 3,
+                 "applied_discount": {"code": "OFF10", "percent": 10, "final": 90000.0, "disc": 10000.0}},
+        lambda: {"step": S.PAY_DIFF_WAIT_RECEIPT, "selected_plan_id": 2, "diff_amount": 35000.0},
+        lambda: {"step": S.TICKET_ENTER_MESSAGE, "ticket_subject": "مشکل اتصال"},
+        lambda: {"step": S.ADMIN_PLAN_NEW_PRICE, "new_plan_name": "۱ ماهه", "new_plan_days": 30, "new_plan_vol": 50.0},
+    ]
+    every = max(1, round(100 / active_pct)) if active_pct > 0 else 0
+
+    def fields(uid):
+        return flows[uid % len(flows)]() if every and uid % every == 0 else {"step": S.IDLE}
+
+    def measure(build):
+        tracemalloc.start()
+        t0 = time.perf_counter()
+        obj = build()
+        sec = time.perf_counter() - t0
+        cur, _peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return obj, cur, sec
+
+    def legacy():
+        return {uid: fields(uid) for uid in range(users)}
+
+    def slotted():
+        return {uid: main.UserState(**fields(uid)) for uid in range(users)}
+
+    def store():
+        b = main.MemoryStateBackend(maxsize)
+        for uid in range(users):
+            s = main.UserState(**fields(uid))
+            if not s.is_idle():
+                b.put(uid, s, main.STATE_TTL)
+        return b
+
+    out = []
+    for name, build in (("legacy_dict", legacy), ("userstate_all", slotted), ("memory_store", store)):
+        obj, cur, sec = measure(build)
+        out += [(f"{name}_mb", round(cur / 1e6, 1)), (f"{name}_bytes_per_user", round(cur / users, 1)),
+                (f"{name}_build_s", round(sec, 2))]
+        if name == "memory_store":
+            out += [("memory_store_keys", len(obj.data)), ("memory_store_evicted", obj.evicted)]
+        del obj
+    report(f"state ({users} users, {active_pct}% mid-flow, max {maxsize})", out)
+
+
+def bench_router(lookups: int) -> int:
+    # ۱) هر دکمه‌ی هر کیبورد، توی stepی که اون کیبورد نشون داده میشه، به هندلر خودش برسه
+    # ۲) هر stepی که منتظر متنه ورودی داشته باشه (stepهای عکسی با on_photo ـن)
+    # ۳) callback_data همه‌ی کیبوردهای اینلاین برای ادمین مسیر داشته باشه و برای بقیه نه
+    S, r = main.Step, main.router
+    screens = [
+        ("main", S.IDLE, main.kb_main(1, True)),
+        ("admin", S.ADMIN_MODE, main.kb_admin_main()),
+        ("admin_after_wizard", S.IDLE, main.kb_admin_main()),
+        ("buy", S.PLAN_DETAIL, main.kb_buy_flow()),
+        ("buy_discount", S.APPLY_DISCOUNT, main.kb_buy_flow()),
+        ("diff", S.PAY_WALLET_CONFIRM, main.kb_diff_receipt()),
+        ("wallet", S.TOPUP_WAIT_RECEIPT, main.kb_wallet()),
+        ("tickets", S.IDLE, main.kb_ticket_menu()),
+        ("back_cancel", S.TICKET_ENTER_SUBJECT, main.kb_back_cancel()),
+    ]
+    text_steps = [
+        S.ADMIN_SET_CARD, S.ADMIN_WALLET_ADJ_USER, S.ADMIN_WALLET_ADJ_AMOUNT,
+        S.ADMIN_DISC_NEW_CODE, S.ADMIN_DISC_NEW_PERCENT, S.ADMIN_DISC_NEW_MAXUSES, S.ADMIN_DISC_NEW_EXP,
+        S.ADMIN_BROADCAST, S.ADMIN_PLAN_NEW_NAME, S.ADMIN_PLAN_NEW_DAYS, S.ADMIN_PLAN_NEW_VOL,
+        S.ADMIN_PLAN_NEW_PRICE, S.ADMIN_PLAN_NEW_COST, S.ADMIN_REPO_ADD_TEXT,
+        S.TICKET_ENTER_SUBJECT, S.TICKET_ENTER_MESSAGE, S.TOPUP_WAIT_RECEIPT,
+        S.PLAN_DETAIL, S.APPLY_DISCOUNT, S.PAY_MENU,
+    ]
+    inline = [
+        main.kb_admin_receipt_actions(7, main.ReceiptKind.TOPUP), main.kb_admin_receipt_actions(7, main.ReceiptKind.CARD),
+        main.kb_repo_plan_actions(3), main.kb_repo_bulk_finish(),
+        main.kb_broadcast_actions(5, "RUNNING"), main.kb_broadcast_actions(5, "PAUSED"),
+    ]
+    bad = []
+    pairs = []
+    for name, step, kb in screens:
+        for row in kb.keyboard:
+            for b in row:
+                pairs.append((step, b.text))
+                if r.match_button(step, b.text, True) is None:
+                    bad.append(f"button {b.text!r} @ {name}/{step.value}")
+    for step in text_steps:
+        if r.match_input(step, True) is None:
+            bad.append(f"input @ {step.value}")
+    for kb in inline:
+        for row in kb.inline_keyboard:
+            for b in row:
+                if r.match_callback(b.callback_data, True)[0] is None:
+                    bad.append(f"callback {b.callback_data!r}")
+                if r.match_callback(b.callback_data, False)[0] is not None:
+                    bad.append(f"callback {b.callback_data!r} open to non-admins")
+    for row in main.kb_admin_main().keyboard:
+        for b in row:
+            if r.match_button(S.IDLE, b.text, False) is not None:
+                bad.append(f"admin button {b.text!r} open to non-admins")
+    for line in bad:
+        print("UNREACHABLE ", line)
+
+    # زمان dispatch: جدول (چند lookup دیکشنری) در برابر اسکن خطی همون مسیرها، مثل زنجیره‌ی if قبلی
+    pairs += [(step, "یک متن آزاد") for step in text_steps]
+    linear = ([(None, t, v) for t, v in r.buttons.items()] + [(sp, t, v) for (sp, t), v in r.step_buttons.items()]
+              + [(sp, None, v) for sp, v in r.inputs.items()])
+
+    def scan(step, text):
+        for sp, t, v in linear:
+            if (sp is None or sp == step) and (t is None or t == text):
+                return v[0]
+        return None
+
+    def table(step, text):
+        return r.match_button(step, text, True) or r.match_input(step, True)
+
+    out = [("routes", len(linear)), ("callbacks", len(r.callbacks)), ("unreachable", len(bad))]
+    n = len(pairs)
+    for name, fn in (("table", table), ("linear", scan)):
+        t0 = time.perf_counter()
+        for i in range(lookups):
+            fn(*pairs[i % n])
+        out.append((f"{name}_ns_per_lookup", round((time.perf_counter() - t0) / lookups * 1e9)))
+    report("router", out)
+    return 1 if bad else 0
+
+
+def bench_keyboards(replies: int):
+    # هزینه‌ی reply_markup در مسیر ارسال: ساختن کیبورد + تبدیلش به JSON همون‌طور که PTB می‌سازه
+    from telegram import ReplyKeyboardMarkup, InlineKeyboardMarkup
+    from telegram.request._requestparameter import RequestParameter
+    static = [main.kb_main(1, True), main.kb_admin_main(), main.kb_buy_flow(), main.kb_back_cancel(),
+              main.kb_ticket_menu(), main.kb_repo_bulk_finish()]
+
+    def rebuild(kb):
+        # مثل قبل: هر بار یک آبجکت تازه با همون دکمه‌ها
+        if isinstance(kb, InlineKeyboardMarkup):
+            return InlineKeyboardMarkup(kb.inline_keyboard)
+        return ReplyKeyboardMarkup([[b.text for b in row] for row in kb.keyboard], resize_keyboard=True)
+
+    def cost(make):
+        t0 = time.perf_counter()
+        for i in range(replies):
+            RequestParameter.from_input("reply_markup", make(i)).json_value
+        return round((time.perf_counter() - t0) / replies * 1e6, 2)
+
+    n = len(static)
+    out = [
+        ("per_reply_us_rebuilt", cost(lambda i: rebuild(static[i % n]))),
+        ("per_reply_us_prebuilt", cost(lambda i: static[i % n])),
+        ("receipt_actions_us_rebuilt", cost(lambda i: main.kb_admin_receipt_actions.__wrapped__(i % 50, main.ReceiptKind.TOPUP))),
+        ("receipt_actions_us_memoized", cost(lambda i: main.kb_admin_receipt_actions(i % 50, main.ReceiptKind.TOPUP))),
+    ]
+    report(f"keyboards ({replies} replies)", out)
+
+
+def hot_queries(db):
+    P, since = main.Purchase, main.now() - main.dt.timedelta(days=7)
+    return [
+        ("my_configs", db.query(P).filter(P.user_id == 1, P.active == True).order_by(P.created_at.desc())),
+        ("stats_since", db.query(P).filter(P.created_at >= since, P.active == True)),
+        ("stats_active", db.query(main.func.count(P.id)).filter(P.active == True)),
+        ("expiry_due", db.query(P).filter(P.active == True, P.expire_at < main.now())),
+        ("reminder_window", db.query(P.id).filter(P.active == True, P.expire_at >= since, P.expire_at < main.now())),
+        ("pending_receipts", db.query(main.Receipt).filter(main.Receipt.status == "PENDING")
+            .order_by(main.Receipt.created_at.asc())),
+        ("plan_stock", db.query(main.func.count(main.ConfigItem.id)).filter(main.ConfigItem.plan_id == 1)),
+        ("deliver_item", db.query(main.ConfigItem).filter(main.ConfigItem.plan_id == 1)
+            .order_by(main.ConfigItem.id.asc()).limit(1)),
+        ("my_tickets", db.query(main.Ticket).filter(main.Ticket.user_id == 1).order_by(main.Ticket.created_at.desc())),
+        ("top_buyers", db.query(main.User.id, main.func.sum(P.price_paid)).join(main.User, main.User.id == P.user_id)
+            .filter(P.active == True, P.created_at >= since).group_by(main.User.id)),
+        ("user_by_username", db.query(main.User).filter(main.User.username == "someone")),
+    ]
+
+
+def bench_explain() -> int:
+    # EXPLAIN QUERY PLAN روی همون دیتابیس مایگریت‌شده؛ هر SCAN بدون ایندکس = خطا
+    db = main.SessionLocal()
+    bad = 0
+    try:
+        conn = db.connection()
+        for name, q in hot_queries(db):
+            c = q.statement.compile(dialect=main.engine.dialect)
+            params = tuple(c.params[k] for k in c.positiontup)
+            plan = [r[-1] for r in conn.exec_driver_sql("EXPLAIN QUERY PLAN " + str(c), params)]
+            full = [d for d in plan if d.startswith("SCAN") and "INDEX" not in d]
+            bad += bool(full)
+            print(f"{'FULL SCAN' if full else 'ok':>9}  {name}: {' | '.join(plan)}")
+    finally:
+        db.close()
+    return 1 if bad else 0
+
+
+def cli():
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p = sub.add_parser("updates", help="throughput of the update pipeline over long polling")
+    p.add_argument("--users", type=int, default=200)
+    p.add_argument("--messages", type=int, default=10)
+    p = sub.add_parser("outbound", help="rate limiter: send rate and 429 recovery")
+    p.add_argument("--chats", type=int, default=100)
+    p.add_argument("--messages", type=int, default=3)
+    p.add_argument("--flood-every", type=int, default=50)
+    p = sub.add_parser("db", help="SQLite profile: tuned (WAL + pragmas) vs default journaling")
+    p.add_argument("--threads", type=int, default=8)
+    p.add_argument("--ops", type=int, default=2000)
+    p.add_argument("--write-every", type=int, default=4)
+    p = sub.add_parser("claim", help="concurrent purchases: atomic config claim (exit 1 on double delivery)")
+    p.add_argument("--buyers", type=int, default=500)
+    p.add_argument("--stock", type=int, default=300)
+    p.add_argument("--buffer", type=int, default=0, help="InventoryBuffer size per plan (0 = off)")
+    p = sub.add_parser("stats", help="sales stats on a large purchases table (time + python memory; exit 1 on stuck cache waiters)")
+    p.add_argument("--rows", type=int, default=1000000)
+    p.add_argument("--legacy", action="store_true", help="also run the old per-row calc_profit for comparison")
+    p = sub.add_parser("expiry", help="bulk expiry + concurrent notifications (exit 1 on mismatch)")
+    p.add_argument("--purchases", type=int, default=5000)
+    p = sub.add_parser("state", help="memory of per-user conversation state: legacy dicts vs UserState/LRU store")
+    p.add_argument("--users", type=int, default=1000000)
+    p.add_argument("--active-pct", type=float, default=5.0, help="share of users in the middle of a flow")
+    p.add_argument("--max", type=int, default=main.STATE_MAX_USERS, help="LRU bound of the memory backend")
+    p = sub.add_parser("keyboards", help="reply_markup cost per reply: rebuilt vs prebuilt/memoized keyboards")
+    p.add_argument("--replies", type=int, default=20000)
+    p = sub.add_parser("router", help="text/callback routing: reachability of every button and step (exit 1 if not) + dispatch time")
+    p.add_argument("--lookups", type=int, default=200000)
+    sub.add_parser("explain", help="query plans of the hot queries (exit 1 on full table scans)")
+    args = parser.parse_args()
+    if args.cmd == "updates":
+        asyncio.run(bench_updates(args.users, args.messages))
+    elif args.cmd == "outbound":
+        asyncio.run(bench_outbound(args.chats, args.messages, args.flood_every))
+    elif args.cmd == "db":
+        bench_db(args.threads, args.ops, args.write_every)
+    elif args.cmd == "claim":
+        sys.exit(asyncio.run(bench_claim(args.buyers, args.stock, args.buffer)))
+    elif args.cmd == "stats":
+        sys.exit(bench_stats(args.rows, args.legacy))
+    elif args.cmd == "expiry":
+        sys.exit(asyncio.run(bench_expiry(args.purchases)))
+    elif args.cmd == "state":
+        bench_state(args.users, args.active_pct, args.max)
+    elif args.cmd == "keyboards":
+        bench_keyboards(args.replies)
+    elif args.cmd == "router":
+        sys.exit(bench_router(args.lookups))
+    elif args.cmd == "explain":
+        sys.exit(bench_explain())
+
+
+if __name__ == "__main__":
+    cli()
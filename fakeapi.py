@@ -0,0 +1,147 @@
+# fakeapi.py
+# ==========================================
+# Bot API محلی (جایگزین api.telegram.org) برای اجرای آفلاین و تست بار
+# درخواست‌های خروجی (sendMessage/sendPhoto/...) رو ضبط می‌کنه و
+# آپدیت‌های مصنوعی رو از طریق getUpdates تحویل می‌ده.
+# استفاده: FAKE_BOT_API=1 python main.py poll   یا   python bench.py updates
+# ==========================================
+
+import asyncio, json, time, collections
+from typing import Optional, List, Dict, Tuple
+
+from telegram.request import BaseRequest, RequestData
+
+
+class FakeBotAPI:
+    def __init__(self, bot_id: int = 1000001, username: str = "fake_aali_plus_bot"):
+        self.bot_id = bot_id
+        self.username = username
+        self.calls: "collections.Counter[str]" = collections.Counter()
+        self.sent: List[Tuple[str, Dict]] = []  # (endpoint, params) فقط متدهای ارسال
+        self.record_sent = True
+        self.bytes_out = 0
+        self.flood_every = 0      # هر N ارسال یک 429 مصنوعی (0 = خاموش)
+        self.flood_retry_after = 1
+        self._send_count = 0
+        self._updates: "collections.deque[Dict]" = collections.deque()
+        self._has_updates: Optional[asyncio.Event] = None
+        self._next_update_id = 1
+        self._next_message_id = 1
+
+    # ---------- آپدیت‌های مصنوعی ----------
+    def _event(self) -> asyncio.Event:
+        if self._has_updates is None:
+            self._has_updates = asyncio.Event()
+        return self._has_updates
+
+    def push_update(self, data: Dict) -> int:
+        if "update_id" not in data:
+            data["update_id"] = self._next_update_id
+        self._next_update_id = max(self._next_update_id, data["update_id"]) + 1
+        self._updates.append(data)
+        self._event().set()
+        return data["update_id"]
+
+    def _user(self, user_id: int) -> Dict:
+        return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}", "username": f"user{user_id}"}
+
+    def _message(self, chat_id: int, **extra) -> Dict:
+        mid = self._next_message_id
+        self._next_message_id += 1
+        m = {"message_id": mid, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"}}
+        m.update(extra)
+        return m
+
+    def push_text(self, user_id: int, text: str) -> int:
+        msg = self._message(user_id, text=text, **{"from": self._user(user_id)})
+        if text.startswith("/"):
+            cmd = text.split()[0]
+            msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(cmd)}]
+        return self.push_update({"message": msg})
+
+    def push_photo(self, user_id: int, file_id: str = "fake-photo") -> int:
+        photo = [{"file_id": file_id, "file_unique_id": file_id, "width": 90, "height": 90}]
+        return self.push_update({"message": self._message(user_id, photo=photo, **{"from": self._user(user_id)})})
+
+    def push_callback(self, user_id: int, data: str) -> int:
+        return self.push_update({"callback_query": {
+            "id": str(self._next_update_id), "from": self._user(user_id), "chat_instance": str(user_id),
+            "data": data, "message": self._message(user_id, text="-", **{"from": self._user(self.bot_id)}),
+        }})
+
+    async def _take_updates(self, offset: Optional[int], limit: int, timeout: float) -> List[Dict]:
+        if offset is not None:
+            while self._updates and self._updates[0]["update_id"] < offset:
+                self._updates.popleft()
+        if not self._updates and timeout > 0:
+            ev = self._event()
+            ev.clear()
+            try:
+                await asyncio.wait_for(ev.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        # مثل تلگرام: تا offset بعدی تأیید نشه، همون‌ها دوباره برمی‌گردن
+        return [self._updates[i] for i in range(min(limit, len(self._updates)))]
+
+    # ---------- ضبط خروجی‌ها ----------
+    def sent_to(self, chat_id: int) -> List[Tuple[str, Dict]]:
+        return [(e, p) for e, p in self.sent if str(p.get("chat_id")) == str(chat_id)]
+
+    def reset(self):
+        self.calls.clear()
+        self.sent.clear()
+        self.bytes_out = 0
+
+    async def handle(self, endpoint: str, params: Dict) -> object:
+        self.calls[endpoint] += 1
+        if endpoint == "getMe":
+            return {"id": self.bot_id, "is_bot": True, "first_name": "Fake", "username": self.username}
+        if endpoint == "getUpdates":
+            return await self._take_updates(
+                int(params["offset"]) if "offset" in params else None,
+                int(params.get("limit", 100)), float(params.get("timeout", 0)),
+            )
+        if endpoint.startswith("send") or endpoint.startswith("edit"):
+            if self.record_sent:
+                self.sent.append((endpoint, params))
+            chat_id = int(params.get("chat_id", 0))
+            if endpoint == "sendPhoto":
+                photo = [{"file_id": str(params.get("photo")), "file_unique_id": "p", "width": 90, "height": 90}]
+                return self._message(chat_id, photo=photo, caption=params.get("caption"))
+            return self._message(chat_id, text=params.get("text", ""))
+        # setWebhook / deleteWebhook / setMyCommands / answerCallbackQuery ...
+        return True
+
+    def request(self) -> "FakeRequest":
+        return FakeRequest(self)
+
+
+class FakeRequest(BaseRequest):
+    def __init__(self, api: FakeBotAPI):
+        self.api = api
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_request(self, url: str, method: str, request_data: Optional[RequestData] = None,
+                         read_timeout=None, write_timeout=None, connect_timeout=None, pool_timeout=None) -> Tuple[int, bytes]:
+        endpoint = url.rsplit("/", 1)[-1]
+        api = self.api
+        if api.flood_every and endpoint.startswith("send"):
+            api._send_count += 1
+            if api._send_count % api.flood_every == 0:
+                api.calls["429"] += 1
+                return 429, json.dumps({
+                    "ok": False, "error_code": 429, "description": "Too Many Requests",
+                    "parameters": {"retry_after": api.flood_retry_after},
+                }).encode()
+        # همون payloadی که روی سیم می‌رفت رو می‌سازیم تا هزینه‌ی serialize هم حساب بشه
+        params: Dict = {}
+        if request_data is not None:
+            self.api.bytes_out += len(request_data.json_payload)
+            params = request_data.parameters
+        result = await self.api.handle(endpoint, params)
+        return 200, json.dumps({"ok": True, "result": result}).encode()
@@ -1,38 +1,23 @@
 # main.py
 # ==========================================
 # Bot "Aali Plus" — تک‌فایل فشرده‌شده (Final, single-file)
-# FastAPI (Webhook) + python-telegram-bot v20 + SQLite(SQLAlchemy)
-# ENV: BOT_TOKEN, BASE_URL, ADMIN_IDS (comma), CARD_NUMBER
+# FastAPI (Webhook) + python-telegram-bot v20 + SQLite/Postgres(SQLAlchemy)
+# ENV: BOT_TOKEN, BASE_URL, ADMIN_IDS (comma), CARD_NUMBER, DATABASE_URL
 # ==========================================
 
-import os, asyncio, enum, json, datetime as dt, math, re, uuid, traceback
+import os, asyncio, enum, json, datetime as dt, math, re, uuid, traceback, time, collections, contextlib, contextvars, threading, functools
 from typing import Optional, List, Dict, Tuple
+from concurrent.futures import ThreadPoolExecutor
 
 from fastapi import FastAPI, Request
 from fastapi.responses import JSONResponse, PlainTextResponse
 from pydantic import BaseModel
 from pydantic import BaseModel
 
-# FastAPI fallback برای Koyeb/ASGI
-try:
-    app = FastAPI()
-    from fastapi import Request
-    from telegram import Update
-
-    @app.post("/webhook")
-    async def webhook(request: Request):
-        data = await request.json()
-        update = Update.de_json(data, application.bot)
-        await application.initialize()
-await application.start()
-        await application.process_update(update)
-        return {"ok": True}
-except Exception:
-    app = None
 from sqlalchemy import (
-    create_engine, Column, Integer, String, Float, Boolean, DateTime, Text, ForeignKey, UniqueConstraint, func
+    create_engine, event, Column, Integer, String, Float, Boolean, Date, DateTime, Text, ForeignKey, UniqueConstraint, Index, func, select, delete, update, or_, case
 )
-from sqlalchemy.orm import declarative_base, sessionmaker, relationship, scoped_session
+from sqlalchemy.orm import declarative_base, sessionmaker, relationship
 
 from telegram import (
     Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup,
@@ -40,8 +25,9 @@ from telegram import (
 )
 from telegram.ext import (
     Application, ApplicationBuilder, ContextTypes, CommandHandler, MessageHandler, CallbackQueryHandler,
-    filters
+    BaseRateLimiter, filters
 )
+from telegram.error import RetryAfter, NetworkError, TimedOut
 
 # ==============================
 # ENV & Globals
@@ -56,17 +42,196 @@ if not BOT_TOKEN or not BASE_URL:
 
 WEBHOOK_PATH = "/webhook"
 WEBHOOK_URL  = f"{BASE_URL}{WEBHOOK_PATH}"
+ALLOWED_UPDATES = ["message","callback_query"]
 
 # ==============================
 # DB
 # ==============================
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///bot.db").strip()
+if DATABASE_URL.startswith("postgres://"):  # Heroku/Koyeb هنوز اسکیم قدیمی رو میدن
+    DATABASE_URL = "postgresql://" + DATABASE_URL[len("postgres://"):]
+# هر تابع روی ترد دیتابیس کانکشن رو فقط تا commit خودش نگه می‌داره (UnitOfWork.scope)، پس کانکشن همزمان
+# حداکثر = DB_POOL_SIZE ترد (pool_size) + چند سشن مستقل مثل flush state (overflow، حداقل ۱).
+# به INGEST_WORKERS ربطی نداره: آپدیتی که منتظر ارسال تلگرامه کانکشنی دستش نیست.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "4"))  # تعداد تردهای دیتابیس = حداکثر کوئری همزمان
+DB_MAX_OVERFLOW = max(1, int(os.getenv("DB_MAX_OVERFLOW", "2")))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_PROFILE = os.getenv("DB_PROFILE", "tuned").lower()  # tuned | default (فقط برای مقایسه در بنچمارک)
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+SQLITE_CACHE_KB = int(os.getenv("SQLITE_CACHE_KB", "16384"))
+SQLITE_MMAP_MB = int(os.getenv("SQLITE_MMAP_MB", "64"))
+
+def make_engine(url: str, profile: str = DB_PROFILE):
+    if url.startswith("sqlite"):
+        eng = create_engine(url, connect_args={"check_same_thread": False})
+        if profile == "tuned":
+            @event.listens_for(eng, "connect")
+            def sqlite_pragmas(dbapi_conn, _rec):
+                # WAL: خواننده‌ها پشت نویسنده نمی‌مونن؛ NORMAL در WAL امنه و fsync هر commit رو حذف می‌کنه
+                cur = dbapi_conn.cursor()
+                cur.execute("PRAGMA journal_mode=WAL")
+                cur.execute("PRAGMA synchronous=NORMAL")
+                cur.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+                cur.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_KB}")
+                cur.execute(f"PRAGMA mmap_size={SQLITE_MMAP_MB * 1024 * 1024}")
+                cur.execute("PRAGMA temp_store=MEMORY")
+                cur.close()
+        return eng
+    # Postgres/MySQL: پول واقعی هم‌اندازه‌ی تردپول دیتابیس + pre-ping برای کانکشن‌های مرده
+    return create_engine(
+        url, pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW,
+        pool_pre_ping=True, pool_recycle=DB_POOL_RECYCLE,
+    )
+
 Base = declarative_base()
-engine = create_engine("sqlite:///bot.db", connect_args={"check_same_thread": False})
-SessionLocal = scoped_session(sessionmaker(bind=engine, autocommit=False, autoflush=False))
+engine = make_engine(DATABASE_URL)
+# هر SessionLocal() یک سشن مستقل؛ آبجکت‌ها بعد از commit قابل خوندن می‌مونن (بیرون از ترد دیتابیس)
+SessionLocal = sessionmaker(bind=engine, autocommit=False, autoflush=False, expire_on_commit=False)
 Base.metadata.create_all(engine, checkfirst=True)
+db_executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix="db")
+
 def now():
     return dt.datetime.utcnow()
 
+# ==============================
+# Unit of Work (یک سشن برای کل یک آپدیت)
+# ==============================
+current_uow: contextvars.ContextVar = contextvars.ContextVar("current_uow", default=None)
+
+class UnitOfWork:
+    # ensure_user، user_is_admin، get_card_number و خود هندلر همه همین یک سشن رو می‌گیرن؛
+    # ولی هر run_db / db_session تراکنش خودش رو همون‌جا commit (یا با خطا rollback) می‌کنه تا کانکشن
+    # به پول برگرده: وگرنه موقع await ارسال تلگرام (و throttle خروجی) کانکشن دست آپدیت می‌موند،
+    # روی Postgres «idle in transaction»، و پول باید به تعداد workerهای ingest کانکشن می‌داشت.
+    def __init__(self):
+        self.db = None
+        self.closed = False
+        self.lock = asyncio.Lock()  # کارهای دیتابیسِ یک آپدیت پشت سر هم، نه همزمان روی یک سشن
+        self.failed = False
+        self.sessions = set()       # سشن‌هایی که در طول این آپدیت تراکنش باز کردن (after_begin)
+
+    def session(self):
+        if self.closed:
+            # تسکی که context آپدیت رو با خودش برده (create_task) نباید روی سشن بسته‌شده‌ی اون کار کنه
+            raise RuntimeError("UnitOfWork already closed")
+        if self.db is None:
+            self.db = SessionLocal()
+        return self.db
+
+    @contextlib.contextmanager
+    def scope(self):
+        db = self.session()
+        try:
+            yield db
+            db.commit()
+        except Exception:
+            self.failed = True
+            db.rollback()
+            raise
+
+    def call(self, fn, args, kwargs):
+        with self.scope() as db:
+            return fn(db, *args, **kwargs)
+
+    def close(self):
+        self.closed = True
+        if self.db is None:
+            return
+        try:
+            if self.failed: self.db.rollback()
+            else: self.db.commit()
+        finally:
+            self.db.close()
+
+class SessionStats:
+    # تعداد سشن‌های دیتابیس به ازای هر آپدیت؛ باید ۰ یا ۱ بمونه
+    def __init__(self):
+        self.updates = 0
+        self.sessions = 0
+        self.max = 0
+        self.over_one = 0
+
+    def record(self, uow: UnitOfWork):
+        n = len(uow.sessions)
+        self.updates += 1
+        self.sessions += n
+        self.max = max(self.max, n)
+        if n > 1: self.over_one += 1
+
+    def metrics(self) -> Dict:
+        return {
+            "updates": self.updates,
+            "sessions": self.sessions,
+            "sessions_per_update_avg": round(self.sessions / self.updates, 3) if self.updates else 0.0,
+            "sessions_per_update_max": self.max,
+            "updates_over_one_session": self.over_one,
+        }
+
+session_stats = SessionStats()
+
+@event.listens_for(SessionLocal, "after_begin")
+def _count_update_session(session, transaction, connection):
+    uow = current_uow.get()
+    if uow is not None:
+        uow.sessions.add(id(session))
+
+async def process_update_uow(app: Application, update: Update):
+    uow = UnitOfWork()
+    token = current_uow.set(uow)
+    try:
+        # state فرستنده یک بار اول آپدیت لود میشه و آخرش (حتی با خطا، مثل قبل) ذخیره
+        user = update.effective_user
+        states = await state_store.open(user.id if user else None)
+        states_token = current_states.set(states)
+        try:
+            await app.process_update(update)
+        finally:
+            current_states.reset(states_token)
+            await state_store.close(states)
+    except Exception:
+        uow.failed = True
+        raise
+    finally:
+        current_uow.reset(token)
+        await asyncio.get_running_loop().run_in_executor(db_executor, uow.close)
+        session_stats.record(uow)
+
+async def run_db(fn, *args, **kwargs):
+    # fn(db, *args) توی تردپول دیتابیس اجرا میشه تا event loop (و ack وبهوک) بلاک نشه.
+    # خروجی fn باید بدون سشن قابل استفاده باشه (ستون‌های لود‌شده، نه relationshipهای lazy).
+    # داخل یک آپدیت، سشنِ UnitOfWork همون آپدیت استفاده میشه؛ بیرونش (jobها) سشن مستقل.
+    loop = asyncio.get_running_loop()
+    uow = current_uow.get()
+    if uow is not None:
+        if uow.closed:
+            raise RuntimeError("run_db on a closed UnitOfWork (task started inside an update?)")
+        async with uow.lock:
+            return await loop.run_in_executor(db_executor, contextvars.copy_context().run, uow.call, fn, args, kwargs)
+    def call():
+        db = SessionLocal()
+        try:
+            return fn(db, *args, **kwargs)
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+    return await loop.run_in_executor(db_executor, call)
+
+@contextlib.contextmanager
+def db_session():
+    # برای helperهای sync: اگه وسط یک آپدیت هستیم همون سشن، وگرنه یک سشن کوتاه
+    uow = current_uow.get()
+    if uow is not None:
+        with uow.scope() as db:
+            yield db
+        return
+    db = SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
 class User(Base):
     __tablename__ = "users"
     id = Column(Integer, primary_key=True)  # telegram user id
@@ -78,6 +243,7 @@ class User(Base):
     total_spent = Column(Float, default=0.0, nullable=False)
     purchases = relationship("Purchase", back_populates="user")
     tickets = relationship("Ticket", back_populates="user")
+    __table_args__ = (Index("ix_users_username", "username"),)
 
 class Setting(Base):
     __tablename__ = "settings"
@@ -96,7 +262,8 @@ class Plan(Base):
     volume_gb = Column(Integer, nullable=False)
     price = Column(Float, nullable=False)  # فروش
     cost_price = Column(Float, default=0.0, nullable=False)  # قیمت تمام‌شده (برای سود خالص)
-    # computed stock via relation
+    # تعداد کانفیگ‌های مخزن؛ همراه هر insert/تحویل/پاک‌سازی به‌روز میشه (StockCounters)
+    stock = Column(Integer, default=0, server_default="0", nullable=False)
     configs = relationship("ConfigItem", back_populates="plan", cascade="all, delete-orphan")
 
 class ConfigItem(Base):
@@ -107,7 +274,11 @@ class ConfigItem(Base):
     text_content = Column(Text)  # کانفیگ متنی
     photo_file_id = Column(String(256))  # کانفیگ به صورت عکس (file_id تلگرام)
     created_at = Column(DateTime, default=now, nullable=False)
+    # lease بافر تحویل (InventoryBuffer): کدوم پروسه تا کی این ردیف رو کنار گذاشته
+    reserved_by = Column(String(32))
+    reserved_until = Column(DateTime)
     plan = relationship("Plan", back_populates="configs")
+    __table_args__ = (Index("ix_config_repo_plan_id", "plan_id", "id"),)
 
 class Purchase(Base):
     __tablename__ = "purchases"
@@ -127,6 +298,13 @@ class Purchase(Base):
     user = relationship("User", back_populates="purchases")
     plan = relationship("Plan")
     delivered_item = relationship("ConfigItem")
+    __table_args__ = (
+        Index("ix_purchases_user_active_created", "user_id", "active", "created_at"),
+        # آمار/انقضا (active, created_at) و خریداران برتر (+ user_id) همه از همین یکی
+        Index("ix_purchases_active_created_user", "active", "created_at", "user_id"),
+        # زمان‌بند یادآوری/انقضا
+        Index("ix_purchases_active_expire", "active", "expire_at"),
+    )
 
 class ReceiptKind(str, enum.Enum):
     TOPUP = "TOPUP"
@@ -150,6 +328,7 @@ class Receipt(Base):
     amount_approved = Column(Float, default=0.0, nullable=False)  # مبلغ تایید شده توسط ادمین (برای TOPUP/DIFF)
     user = relationship("User")
     plan = relationship("Plan")
+    __table_args__ = (Index("ix_receipts_status_created", "status", "created_at"),)
 
 class Ticket(Base):
     __tablename__ = "tickets"
@@ -160,6 +339,7 @@ class Ticket(Base):
     subject = Column(String(128))
     messages = relationship("TicketMessage", back_populates="ticket", cascade="all, delete-orphan")
     user = relationship("User", back_populates="tickets")
+    __table_args__ = (Index("ix_tickets_user_created", "user_id", "created_at"),)
 
 class TicketMessage(Base):
     __tablename__ = "ticket_messages"
@@ -186,8 +366,72 @@ class StatReset(Base):
     id = Column(Integer, primary_key=True, autoincrement=True)
     reset_at = Column(DateTime, default=now, nullable=False)
 
+class BroadcastJob(Base):
+    __tablename__ = "broadcast_jobs"
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    admin_id = Column(Integer, nullable=False)
+    text = Column(Text, nullable=False)
+    status = Column(String(16), default="RUNNING", nullable=False)  # RUNNING|PAUSED|CANCELLED|DONE
+    cursor = Column(Integer, default=0, nullable=False)  # آخرین users.id که chunkش تموم شده
+    last_user_id = Column(Integer)  # گیرنده‌ها = users.id <= این (کاربرهای ثبت‌نامی وسط ارسال جزو total نیستن)
+    total = Column(Integer, default=0, nullable=False)
+    sent = Column(Integer, default=0, nullable=False)
+    failed = Column(Integer, default=0, nullable=False)
+    progress_chat_id = Column(Integer)
+    progress_message_id = Column(Integer)
+    created_at = Column(DateTime, default=now, nullable=False)
+    finished_at = Column(DateTime)
+
+class SalesDaily(Base):
+    # رول‌آپ روزانه‌ی خریدهای فعال به تفکیک پلن؛ همراه خرید/انقضا به‌روز میشه (SalesRollup)
+    __tablename__ = "sales_daily"
+    day = Column(Date, primary_key=True)
+    plan_id = Column(Integer, primary_key=True)
+    revenue = Column(Float, default=0.0, server_default="0", nullable=False)
+    cost = Column(Float, default=0.0, server_default="0", nullable=False)
+    count = Column(Integer, default=0, server_default="0", nullable=False)
+    discount = Column(Float, default=0.0, server_default="0", nullable=False)
+
+class ExpiryReminder(Base):
+    # دفتر یادآوری‌های فرستاده‌شده؛ هر (خرید، n روز مونده) فقط یک بار
+    __tablename__ = "expiry_reminders"
+    purchase_id = Column(Integer, ForeignKey("purchases.id"), primary_key=True)
+    days_before = Column(Integer, primary_key=True)
+    sent_at = Column(DateTime, default=now, nullable=False)
+
+class SeenUpdate(Base):
+    # update_idهای دیده‌شده (برای dedup بعد از ری‌استارت)
+    __tablename__ = "seen_updates"
+    update_id = Column(Integer, primary_key=True)
+    seen_at = Column(Float, nullable=False)  # epoch seconds
+
+class UserStateRow(Base):
+    # state مکالمه (step + داده‌های موقت) برای STATE_BACKEND=sqlite؛ data یک JSON
+    __tablename__ = "user_states"
+    __table_args__ = (Index("ix_user_states_expires_at", "expires_at"),)
+    user_id = Column(Integer, primary_key=True)
+    data = Column(Text, nullable=False)
+    expires_at = Column(Float, nullable=False)  # epoch seconds
+
 Base.metadata.create_all(engine)
 
+# ==============================
+# Migrations (alembic)
+# ==============================
+# create_all فقط جدول‌های جدید رو می‌سازه؛ ایندکس/ستون روی جدول‌های موجود از migrations/versions میاد
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def run_migrations():
+    from alembic import command
+    from alembic.config import Config
+    cfg = Config(os.path.join(BASE_DIR, "alembic.ini"))
+    cfg.set_main_option("script_location", os.path.join(BASE_DIR, "migrations"))
+    with engine.begin() as conn:
+        cfg.attributes["connection"] = conn
+        command.upgrade(cfg, "head")
+
+run_migrations()
+
 # Ensure default admins in table
 def ensure_bootstrap_admins():
     db = SessionLocal()
@@ -211,6 +455,151 @@ def ensure_bootstrap_admins():
 
 ensure_bootstrap_admins()
 
+# ==============================
+# In-process caches
+# ==============================
+# هر پروسه یک کپی در حافظه نگه می‌داره. نوشتن write-through ـه و داخل همون تراکنش یک
+# «نسخه» در جدول settings (کلید __ver:<name>) عوض میشه؛ بقیه‌ی پروسه‌ها (چند worker روی یک
+# دیتابیس) هر CACHE_SYNC_SEC نسخه‌ها رو می‌خونن و اگه فرق کرده بود دوباره لود می‌کنن.
+CACHE_SYNC_SEC = float(os.getenv("CACHE_SYNC_SEC", "5"))
+VERSION_PREFIX = "__ver:"
+
+def bump_version(db, name: str) -> str:
+    v = uuid.uuid4().hex
+    db.merge(Setting(key=VERSION_PREFIX + name, value=v))
+    return v
+
+def read_version(db, name: str) -> Optional[str]:
+    s = db.query(Setting).get(VERSION_PREFIX + name)
+    return s.value if s else None
+
+class AdminCache:
+    # ADMIN_IDS + جدول admins؛ user_is_admin دیگه کوئری نمی‌زنه
+    def __init__(self):
+        self.ids: set = set(ADMIN_IDS)
+        self.version: Optional[str] = None
+        self.loaded = False
+        self.reloads = 0
+
+    def load(self, db):
+        self.version = read_version(db, "admins")
+        self.ids = set(ADMIN_IDS) | {aid for (aid,) in db.query(Admin.user_id).all()}
+        self.loaded = True
+        self.reloads += 1
+
+    def sync(self, db):
+        if not self.loaded or read_version(db, "admins") != self.version:
+            self.load(db)
+
+    def has(self, uid: int) -> bool:
+        if not self.loaded:
+            with db_session() as db:
+                self.load(db)
+        return uid in self.ids
+
+    def add(self, db, uid: int) -> bool:
+        if db.query(Admin).get(uid):
+            return False
+        db.add(Admin(user_id=uid))
+        usr = db.query(User).get(uid)
+        if usr:
+            usr.is_admin = True
+        version = bump_version(db, "admins")
+        db.commit()
+        self.ids.add(uid)
+        self.version = version
+        return True
+
+    def remove(self, db, uid: int) -> bool:
+        a = db.query(Admin).get(uid)
+        if not a:
+            return False
+        db.delete(a)
+        usr = db.query(User).get(uid)
+        if usr:
+            usr.is_admin = False
+        version = bump_version(db, "admins")
+        db.commit()
+        self.ids.discard(uid)
+        self.version = version
+        return True
+
+    def metrics(self) -> Dict:
+        return {"size": len(self.ids), "reloads": self.reloads, "version": self.version}
+
+admin_cache = AdminCache()
+
+def parse_int_list(raw: str) -> List[int]:
+    return [int(x) for x in raw.replace("،", ",").split(",") if x.strip()]
+
+class SettingsRegistry:
+    # تنظیمات زمان اجرا روی جدول settings؛ هر کلید نوع و پیش‌فرض خودش رو داره.
+    # خوندن از حافظه، نوشتن write-through + bump نسخه‌ی "settings" برای بقیه‌ی پروسه‌ها.
+    def __init__(self):
+        self.defs: Dict[str, Tuple[object, object, object]] = {}  # key -> (default, parse, dump)
+        self.values: Dict[str, object] = {}
+        self.version: Optional[str] = None
+        self.loaded = False
+        self.reloads = 0
+
+    def register(self, key: str, default, parse=str, dump=str):
+        self.defs[key] = (default, parse, dump)
+        self.values[key] = default
+
+    def load(self, db):
+        self.version = read_version(db, "settings")
+        values = {k: d[0] for k, d in self.defs.items()}
+        for row in db.query(Setting).filter(Setting.key.in_(list(self.defs))).all():
+            try:
+                values[row.key] = self.defs[row.key][1](row.value)
+            except Exception:
+                # مقدار خراب توی دیتابیس نباید ربات رو بخوابونه؛ پیش‌فرض می‌مونه
+                traceback.print_exc()
+        self.values = values
+        self.loaded = True
+        self.reloads += 1
+
+    def sync(self, db):
+        if not self.loaded or read_version(db, "settings") != self.version:
+            self.load(db)
+
+    def get(self, key: str):
+        if not self.loaded:
+            with db_session() as db:
+                self.load(db)
+        return self.values[key]
+
+    def set(self, db, key: str, value):
+        _default, parse, dump = self.defs[key]
+        raw = dump(value)
+        value = parse(raw)  # همون تبدیلی که موقع load انجام میشه؛ ورودی نامعتبر همین‌جا ValueError میده
+        db.merge(Setting(key=key, value=raw))
+        version = bump_version(db, "settings")
+        db.commit()
+        self.values[key] = value
+        self.version = version
+        return value
+
+    def metrics(self) -> Dict:
+        return {"keys": len(self.defs), "reloads": self.reloads, "version": self.version}
+
+settings = SettingsRegistry()
+settings.register("card_number", CARD_NUMBER)
+settings.register("reminder_days", [5, 3, 1], parse_int_list, lambda v: ",".join(str(x) for x in v))
+settings.register("top_buyers_limit", 5, int)
+
+def cache_sync(db):
+    admin_cache.sync(db)
+    settings.sync(db)
+
+async def cache_sync_loop():
+    while True:
+        await asyncio.sleep(CACHE_SYNC_SEC)
+        try:
+            await run_db(cache_sync)
+        except Exception:
+            traceback.print_exc()
+
 # ==============================
 # Helpers
 # ==============================
@@ -220,40 +609,254 @@ def money(n: float) -> str:
     return f"{s} تومان"
 
 def get_card_number() -> str:
-    db = SessionLocal()
-    try:
-        s = db.query(Setting).get("card_number")
-        return s.value if s else CARD_NUMBER
-    finally:
-        db.close()
+    return settings.get("card_number")
 
-def set_card_number(v: str):
-    db = SessionLocal()
-    try:
-        s = db.query(Setting).get("card_number")
-        if not s:
-            s = Setting(key="card_number", value=v)
-            db.add(s)
-        else:
-            s.value = v
-        db.commit()
-    finally:
-        db.close()
+def set_card_number(db, v: str):
+    settings.set(db, "card_number", v)
 
 def user_is_admin(uid: int) -> bool:
-    db = SessionLocal()
-    try:
-        if uid in ADMIN_IDS: return True
-        a = db.query(Admin).get(uid)
-        return a is not None
-    finally:
-        db.close()
+    return admin_cache.has(uid)
 
 def plans_as_rows(db) -> List[Plan]:
     return db.query(Plan).order_by(Plan.days.asc(), Plan.volume_gb.asc()).all()
 
 def plan_stock(db, plan_id: int) -> int:
-    return db.query(ConfigItem).filter(ConfigItem.plan_id==plan_id).count()
+    p = db.query(Plan).get(plan_id)
+    return p.stock if p else 0
+
+# ==============================
+# Stock counters (plans.stock)
+# ==============================
+STOCK_RECONCILE_SEC = float(os.getenv("STOCK_RECONCILE_SEC", "3600"))
+
+class StockCounters:
+    # همه‌ی تغییرات مخزن از اینجا رد میشن تا plans.stock توی همون تراکنش درست بمونه؛
+    # reconcile هر از گاهی با COUNT واقعی مقایسه و اصلاح می‌کنه (تغییر دستی دیتابیس، باگ و ...)
+    def __init__(self):
+        self.runs = 0
+        self.drifted = 0
+        self.last_run_at: Optional[float] = None
+
+    @staticmethod
+    def _bump(db, pid: int, delta: int):
+        if delta:
+            db.query(Plan).filter(Plan.id==pid).update({"stock": Plan.stock + delta}, synchronize_session="evaluate")
+
+    def add(self, db, pid: int, **fields) -> ConfigItem:
+        item = ConfigItem(plan_id=pid, **fields)
+        db.add(item)
+        self._bump(db, pid, 1)
+        return item
+
+    @staticmethod
+    def _take(db, cond):
+        # DELETE ... WHERE cond RETURNING؛ بدون RETURNING: انتخاب + حذف شرطی تا وقتی واقعاً یکی برداشته بشه
+        cols = (ConfigItem.id, ConfigItem.content_type, ConfigItem.text_content, ConfigItem.photo_file_id)
+        if db.get_bind().dialect.delete_returning:
+            return db.execute(
+                delete(ConfigItem).where(cond).returning(*cols).execution_options(synchronize_session=False)
+            ).first()
+        while True:
+            row = db.execute(select(*cols).where(cond)).first()
+            if row is None:
+                return None
+            gone = db.execute(delete(ConfigItem).where(ConfigItem.id==row.id)
+                              .execution_options(synchronize_session=False)).rowcount
+            if gone == 1:
+                return row
+
+    def claim(self, db, pid: int):
+        # یک کانفیگ دقیقاً به یک خرید: انتخاب و حذف در یک statement (DELETE ... RETURNING).
+        # روی Postgres با SKIP LOCKED خریدارهای همزمان روی یک ردیف قفل‌شده صف نمی‌کشن.
+        # اول ردیف‌های بدون lease؛ اگه همه دست بافر پروسه‌های دیگه‌ست، همون‌ها (confirm اون‌ها شرطی‌ه)
+        # خروجی: Row(id, content_type, text_content, photo_file_id) یا None اگه مخزن خالیه
+        row = None
+        for free_only in (True, False):
+            pick = select(ConfigItem.id).where(ConfigItem.plan_id==pid)
+            if free_only:
+                pick = pick.where(or_(ConfigItem.reserved_until == None, ConfigItem.reserved_until < now()))
+            pick = pick.order_by(ConfigItem.id.asc()).limit(1)
+            if db.get_bind().dialect.name == "postgresql":
+                pick = pick.with_for_update(skip_locked=True)
+            row = self._take(db, ConfigItem.id == pick.scalar_subquery())
+            if row is not None:
+                break
+        if row is not None:
+            self._bump(db, pid, -1)
+        return row
+
+    def take_reserved(self, db, pid: int, cid: int, owner: str):
+        row = self._take(db, (ConfigItem.id == cid) & (ConfigItem.reserved_by == owner))
+        if row is not None:
+            self._bump(db, pid, -1)
+        return row
+
+    def clear(self, db, pid: int) -> int:
+        n = db.query(ConfigItem).filter(ConfigItem.plan_id==pid).delete(synchronize_session=False)
+        self._bump(db, pid, -n)
+        return n
+
+    def reconcile(self, db) -> int:
+        # شمارش و اصلاح توی یک UPDATE: خوندن COUNT و بعد نوشتن عدد مطلق (دو مرحله)
+        # خریدی که وسطش commit بشه رو گم می‌کرد و خودش drift می‌ساخت
+        real = (select(func.count(ConfigItem.id)).where(ConfigItem.plan_id == Plan.id)
+                .correlate(Plan).scalar_subquery())
+        fixed = db.execute(
+            update(Plan).where(Plan.stock != real).values(stock=real)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        db.commit()
+        self.runs += 1
+        self.drifted += fixed
+        self.last_run_at = time.time()
+        return fixed
+
+    async def reconcile_loop(self):
+        while True:
+            await asyncio.sleep(STOCK_RECONCILE_SEC)
+            try:
+                fixed = await run_db(self.reconcile)
+                if fixed:
+                    print(f"⚠️ stock reconcile: {fixed} plan(s) drifted")
+            except Exception:
+                traceback.print_exc()
+
+    def metrics(self) -> Dict:
+        return {"reconcile_runs": self.runs, "drift_fixed": self.drifted, "last_run_at": self.last_run_at}
+
+stock_counters = StockCounters()
+
+# ==============================
+# Inventory buffer (اختیاری)
+# ==============================
+INVENTORY_BUFFER = int(os.getenv("INVENTORY_BUFFER", "0"))  # تعداد کانفیگ رزرو‌شده در حافظه به ازای هر پلن (0 = خاموش)
+INVENTORY_LEASE_SEC = int(os.getenv("INVENTORY_LEASE_SEC", "300"))
+INVENTORY_REFILL_SEC = float(os.getenv("INVENTORY_REFILL_SEC", "1"))
+PROCESS_ID = uuid.uuid4().hex  # مالک leaseها؛ هر پروسه جدا
+
+class InventoryBuffer:
+    # refiller برای هر پلن چند ردیف config_repo رو با lease (reserved_by/reserved_until) کنار می‌ذاره
+    # و idشون رو توی حافظه نگه می‌داره؛ خرید از حافظه pop می‌کنه و همون ردیف رو با
+    # DELETE ... WHERE id=? AND reserved_by=? توی تراکنش خرید تأیید می‌کنه (O(1) روی کلید اصلی).
+    # lease ها مدام تمدید میشن؛ اگه پروسه بمیره بعد از INVENTORY_LEASE_SEC خودبه‌خود آزاد میشن.
+    def __init__(self, size: int, lease_sec: int):
+        self.size = size
+        self.lease_sec = lease_sec
+        self.owner = PROCESS_ID
+        self.queues: Dict[int, collections.deque] = {}
+        # refill و drop (پاک کردن مخزن) روی تردهای مختلف DB و metrics روی event loop؛
+        # هر کی خود dict رو می‌گرده یا عوض می‌کنه باید این قفل رو بگیره. popleft روی deque خودش امنه.
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.lease_lost = 0
+        self.refills = 0
+        self.refill_total = 0.0
+        self.refill_max = 0.0
+        self._renewed_at = 0.0
+
+    def claim(self, db, pid: int):
+        with self._lock:
+            q = self.queues.get(pid)
+        while q:
+            try:
+                cid = q.popleft()
+            except IndexError:
+                break
+            row = stock_counters.take_reserved(db, pid, cid, self.owner)
+            if row is not None:
+                self.hits += 1
+                return row
+            # lease منقضی شده و کسی دیگه برداشته، یا مخزن پاک شده
+            self.lease_lost += 1
+        if self.size:
+            self.misses += 1
+        return stock_counters.claim(db, pid)
+
+    def drop(self, pid: int):
+        with self._lock:
+            self.queues.pop(pid, None)
+
+    def refill(self, db) -> int:
+        t0 = time.perf_counter()
+        until = now() + dt.timedelta(seconds=self.lease_sec)
+        if time.monotonic() - self._renewed_at > self.lease_sec / 3:
+            # فقط idهایی که هنوز توی صف‌ان؛ ردیفی که pop شده ولی خریدش rollback خورده خودش منقضی میشه
+            with self._lock:
+                held = [cid for q in self.queues.values() for cid in list(q)]
+            if held:
+                db.execute(update(ConfigItem).where(ConfigItem.id.in_(held), ConfigItem.reserved_by == self.owner)
+                           .values(reserved_until=until).execution_options(synchronize_session=False))
+            self._renewed_at = time.monotonic()
+        added = 0
+        for (pid,) in db.query(Plan.id).filter(Plan.stock > 0).all():
+            with self._lock:
+                q = self.queues.setdefault(pid, collections.deque())
+            want = self.size - len(q)
+            if want <= self.size // 2:
+                continue
+            free = or_(ConfigItem.reserved_until == None, ConfigItem.reserved_until < now())
+            pick = select(ConfigItem.id).where(ConfigItem.plan_id == pid, free).order_by(ConfigItem.id.asc()).limit(want)
+            if db.get_bind().dialect.name == "postgresql":
+                pick = pick.with_for_update(skip_locked=True)
+            ids = [cid for (cid,) in db.execute(pick).all()]
+            if not ids:
+                continue
+            # شرطی: اگه پروسه‌ی دیگه‌ای همین وسط lease گرفته باشه، نمی‌دزدیم
+            stmt = (update(ConfigItem).where(ConfigItem.id.in_(ids), free)
+                    .values(reserved_by=self.owner, reserved_until=until)
+                    .execution_options(synchronize_session=False))
+            if db.get_bind().dialect.update_returning:
+                ids = sorted(cid for (cid,) in db.execute(stmt.returning(ConfigItem.id)).all())
+            else:
+                db.execute(stmt)
+            with self._lock:
+                if self.queues.get(pid) is not q:
+                    continue  # وسط refill مخزن پلن پاک شد؛ lease ها خودشون منقضی میشن
+                q.extend(ids)
+            added += len(ids)
+        db.commit()
+        if added:
+            took = time.perf_counter() - t0
+            self.refills += 1
+            self.refill_total += took
+            self.refill_max = max(self.refill_max, took)
+        return added
+
+    def release(self, db):
+        # خاموش شدن تمیز: leaseها رو همون لحظه پس بده
+        db.execute(update(ConfigItem).where(ConfigItem.reserved_by == self.owner)
+                   .values(reserved_by=None, reserved_until=None).execution_options(synchronize_session=False))
+        db.commit()
+        with self._lock:
+            self.queues.clear()
+
+    async def refill_loop(self):
+        while True:
+            try:
+                await run_db(self.refill)
+            except Exception:
+                traceback.print_exc()
+            await asyncio.sleep(INVENTORY_REFILL_SEC)
+
+    def metrics(self) -> Dict:
+        served = self.hits + self.misses
+        with self._lock:
+            buffered = {pid: len(q) for pid, q in self.queues.items()}
+        return {
+            "enabled": bool(self.size),
+            "size_per_plan": self.size,
+            "buffered": buffered,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / served, 3) if served else 0.0,
+            "lease_lost": self.lease_lost,
+            "refills": self.refills,
+            "refill_avg_ms": round(self.refill_total / self.refills * 1000, 2) if self.refills else 0.0,
+            "refill_max_ms": round(self.refill_max * 1000, 2),
+        }
+
+inventory = InventoryBuffer(INVENTORY_BUFFER, INVENTORY_LEASE_SEC)
 
 def discount_valid(db, code: str) -> Optional[Discount]:
     d = db.query(Discount).filter(Discount.code==code.upper()).first()
@@ -267,69 +870,131 @@ def apply_discount(price: float, percent: int) -> Tuple[float, float]:
     final = max(0.0, price - disc)
     return final, disc
 
-def top_buyers_since(db, since: Optional[dt.datetime]) -> List[Tuple[User, float, int]]:
-    q = db.query(Purchase.user_id, func.sum(Purchase.price_paid), func.count(Purchase.id)).filter(Purchase.active==True)
+def top_buyers(db, limit: int, since: Optional[dt.datetime] = None, until: Optional[dt.datetime] = None,
+               plan_id: Optional[int] = None) -> List[Tuple[object, float, int]]:
+    # یک کوئری: جمع/تعداد روی ایندکس (active, created_at, user_id) + join با users برای اسم
+    # خروجی: [(Row(id, first_name, username), جمع خرید، تعداد)]
+    total = func.sum(Purchase.price_paid)
+    q = (db.query(User.id, User.first_name, User.username, total, func.count(Purchase.id))
+         .join(User, User.id == Purchase.user_id)
+         .filter(Purchase.active==True))
     if since:
         q = q.filter(Purchase.created_at >= since)
-    q = q.group_by(Purchase.user_id).order_by(func.sum(Purchase.price_paid).desc())
-    res = []
-    for uid, total, cnt in q.limit(5).all():
-        u = db.query(User).get(uid)
-        if u:
-            res.append((u, float(total or 0), int(cnt)))
-    return res
-
-def calc_profit(db, since: Optional[dt.datetime]) -> Tuple[float, float, float]:
-    q = db.query(Purchase).filter(Purchase.active==True)
-    if since: q = q.filter(Purchase.created_at >= since)
-    sale = 0.0
-    cost = 0.0
-    for p in q.all():
-        sale += p.price_paid
-        if p.plan and p.plan.cost_price:
-            cost += p.plan.cost_price
-    return sale, cost, sale - cost
-
-def get_stats_since(days: int) -> Tuple[float,float,float,int]:
-    db = SessionLocal()
-    try:
-        since = now() - dt.timedelta(days=days)
-        sale,cost,profit = calc_profit(db, since)
-        count = db.query(Purchase).filter(Purchase.created_at >= since, Purchase.active==True).count()
-        return sale,cost,profit,count
-    finally:
-        db.close()
-
-def get_stats_all() -> Tuple[float,float,float,int]:
-    db = SessionLocal()
-    try:
-        sale,cost,profit = calc_profit(db, None)
-        count = db.query(Purchase).filter(Purchase.active==True).count()
-        return sale,cost,profit,count
-    finally:
-        db.close()
-
-def get_stats_since_reset() -> Tuple[float,float,float,int,dt.datetime]:
-    db = SessionLocal()
-    try:
-        last = db.query(StatReset).order_by(StatReset.reset_at.desc()).first()
-        since = last.reset_at if last else None
-        sale,cost,profit = calc_profit(db, since)
-        count = db.query(Purchase).filter(Purchase.active==True, Purchase.created_at >= (since or dt.datetime.min)).count()
-        return sale,cost,profit,count,(since or dt.datetime.min)
-    finally:
-        db.close()
-
-def reset_stats():
-    db = SessionLocal()
-    try:
-        db.add(StatReset())
+    if until:
+        q = q.filter(Purchase.created_at < until)
+    if plan_id:
+        q = q.filter(Purchase.plan_id == plan_id)
+    q = q.group_by(User.id, User.first_name, User.username).order_by(total.desc()).limit(limit)
+    return [(r, float(r[3] or 0), int(r[4])) for r in q.all()]
+
+def top_buyers_since(db, since: Optional[dt.datetime]) -> List[Tuple[object, float, int]]:
+    return top_buyers(db, settings.get("top_buyers_limit"), since=since)
+
+class SalesRollup:
+    # sales_daily همیشه برابر «جمع خریدهای فعال در اون روز و پلن» ـه:
+    # خرید +1 (توی همون تراکنش خرید)، غیرفعال شدن با انقضا -1. rebuild از روی تاریخچه از صفر می‌سازه.
+    KEYS = ("revenue", "cost", "count", "discount")
+
+    def add(self, db, day: dt.date, plan_id: int, revenue: float, cost: float, count: int, discount: float):
+        values = dict(zip(self.KEYS, (revenue, cost, count, discount)))
+        dialect = db.get_bind().dialect.name
+        if dialect in ("sqlite", "postgresql"):
+            if dialect == "sqlite":
+                from sqlalchemy.dialects.sqlite import insert as upsert
+            else:
+                from sqlalchemy.dialects.postgresql import insert as upsert
+            stmt = upsert(SalesDaily).values(day=day, plan_id=plan_id, **values)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[SalesDaily.day, SalesDaily.plan_id],
+                set_={k: getattr(SalesDaily, k) + stmt.excluded[k] for k in self.KEYS},
+            )
+            db.execute(stmt)
+            return
+        n = db.query(SalesDaily).filter(SalesDaily.day==day, SalesDaily.plan_id==plan_id).update(
+            {k: getattr(SalesDaily, k) + v for k, v in values.items()}, synchronize_session=False)
+        if not n:
+            db.add(SalesDaily(day=day, plan_id=plan_id, **values))
+
+    @staticmethod
+    def _amounts(p: Purchase, plan: Optional[Plan]) -> Tuple[float, float, float]:
+        cost = plan.cost_price if plan and plan.cost_price else 0.0
+        discount = (plan.price - p.price_paid) if plan and p.discount_code else 0.0
+        return p.price_paid, cost, discount
+
+    def purchased(self, db, p: Purchase, plan: Optional[Plan]):
+        revenue, cost, discount = self._amounts(p, plan)
+        self.add(db, p.created_at.date(), p.plan_id, revenue, cost, 1, discount)
+
+    def deactivated(self, db, p: Purchase, plan: Optional[Plan]):
+        revenue, cost, discount = self._amounts(p, plan)
+        self.add(db, p.created_at.date(), p.plan_id, -revenue, -cost, -1, -discount)
+
+    def rebuild(self, db) -> int:
+        # stream روی خریدهای فعال؛ حافظه = تعداد (روز، پلن) نه تعداد خریدها
+        plans = {pl.id: pl for pl in db.query(Plan).all()}
+        acc: Dict[Tuple[dt.date, int], List[float]] = {}
+        q = (db.query(Purchase.created_at, Purchase.plan_id, Purchase.price_paid, Purchase.discount_code)
+             .filter(Purchase.active==True).yield_per(10000))
+        for created_at, plan_id, price_paid, disc_code in q:
+            plan = plans.get(plan_id)
+            b = acc.setdefault((created_at.date(), plan_id), [0.0, 0.0, 0, 0.0])
+            b[0] += price_paid
+            b[1] += plan.cost_price if plan and plan.cost_price else 0.0
+            b[2] += 1
+            b[3] += (plan.price - price_paid) if plan and disc_code else 0.0
+        db.query(SalesDaily).delete(synchronize_session=False)
+        db.add_all(SalesDaily(day=d, plan_id=pid, revenue=v[0], cost=v[1], count=v[2], discount=v[3])
+                   for (d, pid), v in acc.items())
         db.commit()
-    finally:
-        db.close()
+        return len(acc)
+
+    def ensure(self, db):
+        # دیتابیس قدیمی که رول‌آپ نداره (مایگریشن 0005 فقط جدول می‌سازه)
+        if db.query(SalesDaily.day).first() is None and db.query(Purchase.id).filter(Purchase.active==True).first() is not None:
+            self.rebuild(db)
+
+    def window(self, db, since: Optional[dt.datetime]) -> Tuple[float, float, float, int]:
+        # روزهای کامل از رول‌آپ؛ فقط تکه‌ی اول روزِ since (بعد از ساعت since) از خود purchases
+        q = db.query(func.sum(SalesDaily.revenue), func.sum(SalesDaily.cost), func.sum(SalesDaily.count))
+        if since is not None:
+            q = q.filter(SalesDaily.day > since.date())
+        sale, cost, count = q.one()
+        sale, cost, count = float(sale or 0), float(cost or 0), int(count or 0)
+        if since is not None:
+            next_day = dt.datetime.combine(since.date() + dt.timedelta(days=1), dt.time())
+            ps, pc, pn = (db.query(func.sum(Purchase.price_paid), func.sum(func.coalesce(Plan.cost_price, 0.0)), func.count(Purchase.id))
+                          .outerjoin(Plan, Plan.id == Purchase.plan_id)
+                          .filter(Purchase.active==True, Purchase.created_at >= since, Purchase.created_at < next_day)
+                          .one())
+            sale += float(ps or 0); cost += float(pc or 0); count += int(pn or 0)
+        return sale, cost, sale - cost, count
+
+sales_rollup = SalesRollup()
+
+def sales_summary(db, windows: Dict[str, Optional[dt.datetime]]) -> Dict[str, Tuple[float,float,float,int]]:
+    # خروجی: {نام بازه: (فروش، هزینه، سود، تعداد)} ؛ since=None یعنی کل خریدهای فعال
+    return {name: sales_rollup.window(db, since) for name, since in windows.items()}
+
+def last_reset_at(db) -> Optional[dt.datetime]:
+    last = db.query(StatReset).order_by(StatReset.reset_at.desc()).first()
+    return last.reset_at if last else None
+
+def get_stats_since(db, days: int) -> Tuple[float,float,float,int]:
+    return sales_summary(db, {"since": now() - dt.timedelta(days=days)})["since"]
+
+def get_stats_all(db) -> Tuple[float,float,float,int]:
+    return sales_summary(db, {"all": None})["all"]
+
+def get_stats_since_reset(db) -> Tuple[float,float,float,int,dt.datetime]:
+    since = last_reset_at(db)
+    return (*sales_summary(db, {"reset": since})["reset"], since or dt.datetime.min)
+
+def reset_stats(db):
+    db.add(StatReset())
+    db.commit()
 
 # ==============================
-# State Machine In-Memory
+# State Machine (استور قابل تعویض: memory | sqlite | kv)
 # ==============================
 class Step(str, enum.Enum):
     IDLE="IDLE"
@@ -370,77 +1035,468 @@ class Step(str, enum.Enum):
     ADMIN_REPO_BULK_MODE="ADMIN_REPO_BULK_MODE"
     ADMIN_REPO_BULK_DONE="ADMIN_REPO_BULK_DONE"
 
-user_state: Dict[int, Dict] = {}
+class UserState:
+    # یک رکورد ثابت به‌جای dict آزاد؛ هندلرها همچنان s["key"] / s.get("key") می‌نویسن.
+    # کلید ناشناخته KeyError میده (غلط تایپی دیگه بی‌صدا یک کلید جدید نمی‌سازه).
+    __slots__ = (
+        "step",
+        # خرید
+        "selected_plan_id", "applied_discount", "diff_amount", "card_price",
+        # تیکت
+        "ticket_subject",
+        # ادمین
+        "enter_amount_for_receipt", "wallet_adj_target", "disc_code", "disc_percent", "disc_max",
+        "new_plan_name", "new_plan_days", "new_plan_vol", "new_plan_price", "repo_plan_id",
+    )
 
-def st(uid:int) -> Dict:
-    if uid not in user_state: user_state[uid]={"step":Step.IDLE}
-    return user_state[uid]
+    def __init__(self, step: Step = Step.IDLE, **fields):
+        self.step = step
+        for k in USER_STATE_DATA:
+            setattr(self, k, None)
+        for k, v in fields.items():
+            self[k] = v
+
+    def __repr__(self) -> str:
+        return f"UserState({self.to_json()})"
+
+    def __getitem__(self, key: str):
+        if key not in USER_STATE_FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key: str, value):
+        if key not in USER_STATE_FIELDS:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __delitem__(self, key: str):
+        if key not in self:
+            raise KeyError(key)
+        setattr(self, key, None)
+
+    def __contains__(self, key: str) -> bool:
+        return key in USER_STATE_FIELDS and getattr(self, key) is not None
+
+    def get(self, key: str, default=None):
+        v = getattr(self, key) if key in USER_STATE_FIELDS else None
+        return default if v is None else v
+
+    def snapshot(self) -> Tuple:
+        # برای تشخیص تغییر آخر آپدیت؛ applied_discount تنها فیلد dict ـه
+        return tuple(tuple(sorted(v.items())) if isinstance(v, dict) else v
+                     for v in (getattr(self, k) for k in self.__slots__))
+
+    def is_idle(self) -> bool:
+        return self.step == Step.IDLE and all(getattr(self, k) is None for k in USER_STATE_DATA)
+
+    def to_json(self) -> str:
+        return json.dumps({k: getattr(self, k) for k in self.__slots__ if getattr(self, k) is not None},
+                          ensure_ascii=False, default=str)
+
+    @classmethod
+    def from_json(cls, raw: str) -> "UserState":
+        d = json.loads(raw)
+        s = cls()
+        for k, v in d.items():
+            if k in USER_STATE_FIELDS and k != "step":
+                setattr(s, k, v)
+        try:
+            s.step = Step(d.get("step", Step.IDLE))
+        except ValueError:
+            s.step = Step.IDLE  # مرحله‌ای که بعد از دیپلوی دیگه وجود نداره
+        return s
+
+USER_STATE_FIELDS = frozenset(UserState.__slots__)
+USER_STATE_DATA = UserState.__slots__[1:]  # همه به‌جز step
+
+STATE_BACKEND = os.getenv("STATE_BACKEND", "memory").lower()  # memory | sqlite | kv
+STATE_TTL = int(os.getenv("STATE_TTL", str(2*86400)))  # state رهاشده بعد از این مدت به IDLE برمی‌گرده
+STATE_MAX_USERS = int(os.getenv("STATE_MAX_USERS", "100000"))  # سقف LRU برای backend حافظه
+STATE_FLUSH_SEC = float(os.getenv("STATE_FLUSH_SEC", "1"))  # write-behind برای sqlite؛ 0 = write-through
+REDIS_URL = os.getenv("REDIS_URL", "").strip()  # برای STATE_BACKEND=kv؛ خالی = KV محلی داخل پروسه
+
+class MemoryStateBackend:
+    # رفتار قبلی (فقط همین پروسه)، ولی محدود: LRU با سقف maxsize و TTL هر کلید.
+    # کاربرِ بیرون‌افتاده (یا منقضی) یعنی برگشت به IDLE؛ کاربرهای IDLE اصلاً نگه داشته نمیشن.
+    name = "memory"
+    blocking = False
+
+    def __init__(self, maxsize: int):
+        self.maxsize = max(1, maxsize)
+        self.data: "collections.OrderedDict[int, Tuple[UserState, float]]" = collections.OrderedDict()
+        self.expired = 0
+        self.evicted = 0
+
+    def get(self, uid: int) -> Optional[UserState]:
+        hit = self.data.get(uid)
+        if hit is None:
+            return None
+        if hit[1] < time.time():
+            del self.data[uid]
+            self.expired += 1
+            return None
+        self.data.move_to_end(uid)
+        return hit[0]
+
+    def put(self, uid: int, state: UserState, ttl: int):
+        self.data[uid] = (state, time.time() + ttl)
+        self.data.move_to_end(uid)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+            self.evicted += 1
+
+    def delete(self, uid: int):
+        self.data.pop(uid, None)
+
+    def flush(self):
+        # ترتیب LRU تقریباً همون ترتیب انقضاست؛ از سر صف تا اولین کلید زنده
+        t = time.time()
+        while self.data:
+            uid, (_, exp) = next(iter(self.data.items()))
+            if exp >= t:
+                break
+            self.data.popitem(last=False)
+            self.expired += 1
+
+    def metrics(self) -> Dict:
+        return {"keys": len(self.data), "max": self.maxsize, "expired": self.expired, "evicted": self.evicted}
+
+class SqlStateBackend:
+    # جدول user_states روی همون DATABASE_URL؛ بین پروسه‌ها مشترک و بعد از ری‌استارت باقی.
+    # نوشتن‌ها write-behind: توی _dirty جمع میشن و هر STATE_FLUSH_SEC یکجا commit میشن؛
+    # خوندنِ همین پروسه اول از _dirty، پس پروسه‌های دیگه حداکثر STATE_FLUSH_SEC عقب‌ترن.
+    name = "sqlite"
+    blocking = True
+
+    def __init__(self, write_behind: bool):
+        self.write_behind = write_behind
+        self._dirty: Dict[int, Optional[Tuple[str, float]]] = {}  # None یعنی حذف
+        self._lock = threading.Lock()
+        self.flushes = 0
+        self.written = 0
+
+    def get(self, uid: int) -> Optional[UserState]:
+        with self._lock:
+            if uid in self._dirty:
+                hit = self._dirty[uid]
+                return UserState.from_json(hit[0]) if hit is not None else None
+        with db_session() as db:
+            row = db.execute(
+                select(UserStateRow.data).where(UserStateRow.user_id == uid, UserStateRow.expires_at >= time.time())
+            ).first()
+        return UserState.from_json(row[0]) if row else None
+
+    def put(self, uid: int, state: UserState, ttl: int):
+        with self._lock:
+            self._dirty[uid] = (state.to_json(), time.time() + ttl)
+        if not self.write_behind:
+            self.flush()
+
+    def delete(self, uid: int):
+        with self._lock:
+            self._dirty[uid] = None
+        if not self.write_behind:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            batch, self._dirty = self._dirty, {}
+        # سشن مستقل: commit این‌ها نباید به commit/rollback آپدیت جاری گره بخوره
+        db = SessionLocal()
+        try:
+            gone = [uid for uid, hit in batch.items() if hit is None]
+            if gone:
+                db.execute(delete(UserStateRow).where(UserStateRow.user_id.in_(gone)))
+            for uid, hit in batch.items():
+                if hit is not None:
+                    db.merge(UserStateRow(user_id=uid, data=hit[0], expires_at=hit[1]))
+            db.execute(delete(UserStateRow).where(UserStateRow.expires_at < time.time()))
+            db.commit()
+        except Exception:
+            db.rollback()
+            with self._lock:
+                # نوشتن‌های جدیدتر برنده‌ان؛ بقیه برای flush بعدی برمی‌گردن
+                for uid, hit in batch.items():
+                    self._dirty.setdefault(uid, hit)
+            raise
+        finally:
+            db.close()
+        self.flushes += 1
+        self.written += len(batch)
+
+    def metrics(self) -> Dict:
+        return {"pending": len(self._dirty), "flushes": self.flushes, "written": self.written,
+                "write_behind": self.write_behind}
+
+class LocalKV:
+    # جایگزین داخل‌پروسه برای Redis با همون زیرمجموعه‌ی API (get / set(ex=) / delete)
+    def __init__(self):
+        self.data: Dict[str, Tuple[str, Optional[float]]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            hit = self.data.get(key)
+            if hit is None:
+                return None
+            if hit[1] is not None and hit[1] < time.time():
+                del self.data[key]
+                return None
+            return hit[0]
+
+    def set(self, key: str, value: str, ex: Optional[int] = None):
+        with self._lock:
+            self.data[key] = (value, time.time() + ex if ex else None)
+
+    def delete(self, key: str):
+        with self._lock:
+            self.data.pop(key, None)
+
+    def sweep(self):
+        t = time.time()
+        with self._lock:
+            for key in [k for k, (_, exp) in self.data.items() if exp is not None and exp < t]:
+                del self.data[key]
+
+class KvStateBackend:
+    # هر state یک کلید با TTL خودش؛ با REDIS_URL بین پروسه‌ها/ماشین‌ها مشترکه
+    name = "kv"
+
+    def __init__(self, client, blocking: bool):
+        self.client = client
+        self.blocking = blocking
+        self.prefix = "state:"
+
+    def get(self, uid: int) -> Optional[UserState]:
+        raw = self.client.get(self.prefix + str(uid))
+        if raw is None:
+            return None
+        return UserState.from_json(raw.decode() if isinstance(raw, bytes) else raw)
+
+    def put(self, uid: int, state: UserState, ttl: int):
+        self.client.set(self.prefix + str(uid), state.to_json(), ex=ttl)
+
+    def delete(self, uid: int):
+        self.client.delete(self.prefix + str(uid))
+
+    def flush(self):
+        if isinstance(self.client, LocalKV):
+            self.client.sweep()
+
+    def metrics(self) -> Dict:
+        if isinstance(self.client, LocalKV):
+            return {"client": "local", "keys": len(self.client.data)}
+        return {"client": "redis"}
+
+def make_state_backend(kind: str):
+    if kind in ("sqlite", "sql"):
+        return SqlStateBackend(write_behind=STATE_FLUSH_SEC > 0)
+    if kind == "kv":
+        if REDIS_URL:
+            try:
+                import redis  # اختیاری؛ فقط وقتی REDIS_URL ست شده
+                return KvStateBackend(redis.Redis.from_url(REDIS_URL), blocking=True)
+            except ImportError:
+                print("⚠️ REDIS_URL set but redis package missing; using local KV.")
+        return KvStateBackend(LocalKV(), blocking=False)
+    return MemoryStateBackend(STATE_MAX_USERS)
+
+current_states: contextvars.ContextVar = contextvars.ContextVar("current_states", default=None)
+
+class StateStore:
+    # هندلرها مثل قبل UserState رو درجا عوض می‌کنن؛ state کاربرِ آپدیت اول آپدیت یک بار لود میشه
+    # (scope) و آخرش فقط اگه عوض شده باشه نوشته میشه. state خالیِ IDLE یعنی حذف.
+    def __init__(self, backend, ttl: int):
+        self.backend = backend
+        self.ttl = ttl
+        self.loads = 0
+        self.saves = 0
+        self.deletes = 0
+
+    def _read(self, uid: int) -> List:
+        # [state, snapshot اول آپدیت (None = توی backend نبود)]
+        self.loads += 1
+        s = self.backend.get(uid)
+        if s is None:
+            return [UserState(), None]
+        return [s, s.snapshot()]
+
+    def _write(self, uid: int, s: UserState, before: Optional[Tuple]):
+        if s.is_idle():
+            if before is not None:
+                self.backend.delete(uid)
+                self.deletes += 1
+            return
+        if s.snapshot() != before:
+            self.backend.put(uid, s, self.ttl)
+            self.saves += 1
+
+    def _write_scope(self, scope: Dict[int, List]):
+        for uid, (s, before) in scope.items():
+            self._write(uid, s, before)
+
+    async def _run(self, fn, *args):
+        if not self.backend.blocking:
+            return fn(*args)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(db_executor, contextvars.copy_context().run, fn, *args)
+
+    async def open(self, uid: Optional[int]) -> Dict[int, List]:
+        scope: Dict[int, List] = {}
+        if uid is not None:
+            scope[uid] = await self._run(self._read, uid)
+        return scope
+
+    async def close(self, scope: Dict[int, List]):
+        if not scope:
+            return
+        try:
+            await self._run(self._write_scope, scope)
+        except Exception:
+            # ذخیره‌نشدن state نباید کار انجام‌شده‌ی آپدیت (مثلاً خرید) رو rollback کنه
+            traceback.print_exc()
+
+    async def flush(self):
+        await self._run(self.backend.flush)
+
+    def get(self, uid: int) -> UserState:
+        scope = current_states.get()
+        if scope is None:
+            # بیرون از آپدیت: فقط خوندن؛ نوشتن با set_step/clear_step
+            return self._read(uid)[0]
+        if uid not in scope:
+            scope[uid] = self._read(uid)  # کاربر دیگه‌ای غیر از فرستنده‌ی آپدیت (نادر)
+        return scope[uid][0]
+
+    def put(self, uid: int, s: UserState):
+        scope = current_states.get()
+        if scope is not None:
+            if uid not in scope:
+                scope[uid] = self._read(uid)
+            scope[uid][0] = s
+            return
+        self._write(uid, s, ())
+
+    async def flush_loop(self):
+        while True:
+            await asyncio.sleep(max(STATE_FLUSH_SEC, 1.0))
+            try:
+                await self.flush()
+            except Exception:
+                traceback.print_exc()
+
+    def metrics(self) -> Dict:
+        m = {"backend": self.backend.name, "ttl_sec": self.ttl,
+             "loads": self.loads, "saves": self.saves, "deletes": self.deletes}
+        m.update(self.backend.metrics())
+        return m
+
+state_store = StateStore(make_state_backend(STATE_BACKEND), STATE_TTL)
+
+def st(uid:int) -> UserState:
+    return state_store.get(uid)
 
 def set_step(uid:int, step:Step, **kwargs):
     s = st(uid)
     s["step"]=step
     for k,v in kwargs.items():
         s[k]=v
+    state_store.put(uid, s)
 
 def clear_step(uid:int):
-    user_state[uid]={"step":Step.IDLE}
+    state_store.put(uid, UserState())
 
 # ==============================
 # UI (Keyboards & Texts)
 # ==============================
+class CachedMarkup:
+    # TelegramObjectها بعد از __init__ فریز میشن، پس to_dict (همون چیزی که PTB موقع ارسال serialize می‌کنه)
+    # یک بار حساب و نگه داشته میشه. خروجی مشترکه؛ کسی نباید تغییرش بده.
+    __slots__ = ()
+
+    def to_dict(self, recursive: bool = True) -> Dict:
+        if not recursive:
+            return super().to_dict(recursive)
+        d = getattr(self, "_as_dict", None)
+        if d is None:
+            d = super().to_dict()
+            self._as_dict = d
+        return d
+
+class StaticReplyKeyboard(CachedMarkup, ReplyKeyboardMarkup):
+    __slots__ = ("_as_dict",)
+
+class StaticInlineKeyboard(CachedMarkup, InlineKeyboardMarkup):
+    __slots__ = ("_as_dict",)
+
+# کیبوردهای ثابت یک بار ساخته میشن؛ kb_*ها فقط همون آبجکت رو برمی‌گردونن
+# کاربر: منوی اصلی (کیبورد منو) — مرتب + ایموجی‌ها
+MAIN_USER_ROWS = [
+    ["🛍 خرید سرویس", "🧾 کانفیگ‌های من"],
+    ["💳 کیف پول", "🎟️ تیکت‌ها"],
+    ["ℹ️ آموزش", "📊 آمار فروش"],
+]
+KB_MAIN_USER = StaticReplyKeyboard(MAIN_USER_ROWS, resize_keyboard=True)
+KB_MAIN_ADMIN = StaticReplyKeyboard(MAIN_USER_ROWS + [["🛠 پنل ادمین"]], resize_keyboard=True)
+KB_ADMIN_MAIN = StaticReplyKeyboard([
+    ["💳 تغییر شماره کارت", "👤 مدیریت ادمین‌ها"],
+    ["📥 رسیدهای در انتظار", "👛 کیف پول کاربر"],
+    ["🏷️ کُدهای تخفیف", "📢 اعلان همگانی"],
+    ["🧩 مدیریت پلن و مخزن", "📈 آمار فروش"],
+    ["🔙 بازگشت به منوی کاربر"],
+], resize_keyboard=True)
+KB_BACK_CANCEL = StaticReplyKeyboard([["🔙 بازگشت", "❌ انصراف"]], resize_keyboard=True)
+# کارت به کارت + پرداخت با کیف پول + کد تخفیف + برگشت
+KB_BUY_FLOW = StaticReplyKeyboard([
+    ["🧾 اعمال کد تخفیف"],
+    ["💼 پرداخت با کیف پول", "🏦 کارت به کارت"],
+    ["🔙 بازگشت"],
+], resize_keyboard=True)
+KB_WALLET = StaticReplyKeyboard([["📤 ارسال رسید شارژ"], ["🔙 بازگشت"]], resize_keyboard=True)
+KB_DIFF_RECEIPT = StaticReplyKeyboard([["📤 ارسال رسید ما‌به‌تفاوت"], ["🔙 بازگشت"]], resize_keyboard=True)
+KB_TICKET_MENU = StaticReplyKeyboard([["🆕 تیکت جدید", "📚 سابقه تیکت‌ها"], ["🔙 بازگشت"]], resize_keyboard=True)
+KB_REPO_BULK_FINISH = StaticInlineKeyboard([[InlineKeyboardButton("✅ اتمام", callback_data="rp_bulk_done")]])
+
 def kb_main(uid:int, is_admin:bool=False):
-    # کاربر: منوی اصلی (کیبورد منو)
-    # مرتب + ایموجی‌ها
-    user_rows = [
-        ["🛍 خرید سرویس", "🧾 کانفیگ‌های من"],
-        ["💳 کیف پول", "🎟️ تیکت‌ها"],
-        ["ℹ️ آموزش", "📊 آمار فروش"],
-    ]
-    if is_admin:
-        user_rows.append(["🛠 پنل ادمین"])
-    return ReplyKeyboardMarkup(user_rows, resize_keyboard=True)
+    return KB_MAIN_ADMIN if is_admin else KB_MAIN_USER
 
 def kb_admin_main():
-    rows = [
-        ["💳 تغییر شماره کارت", "👤 مدیریت ادمین‌ها"],
-        ["📥 رسیدهای در انتظار", "👛 کیف پول کاربر"],
-        ["🏷️ کُدهای تخفیف", "📢 اعلان همگانی"],
-        ["🧩 مدیریت پلن و مخزن", "📈 آمار فروش"],
-        ["🔙 بازگشت به منوی کاربر"],
-    ]
-    return ReplyKeyboardMarkup(rows, resize_keyboard=True)
+    return KB_ADMIN_MAIN
 
 def kb_back_cancel():
-    return ReplyKeyboardMarkup([["🔙 بازگشت", "❌ انصراف"]], resize_keyboard=True)
+    return KB_BACK_CANCEL
 
 def kb_buy_flow():
-    # کارت به کارت + پرداخت با کیف پول + کد تخفیف + برگشت
-    rows = [
-        ["🧾 اعمال کد تخفیف"],
-        ["💼 پرداخت با کیف پول", "🏦 کارت به کارت"],
-        ["🔙 بازگشت"],
-    ]
-    return ReplyKeyboardMarkup(rows, resize_keyboard=True)
+    return KB_BUY_FLOW
+
+def kb_wallet():
+    return KB_WALLET
+
+def kb_diff_receipt():
+    return KB_DIFF_RECEIPT
 
 def kb_ticket_menu():
-    return ReplyKeyboardMarkup([["🆕 تیکت جدید", "📚 سابقه تیکت‌ها"], ["🔙 بازگشت"]], resize_keyboard=True)
+    return KB_TICKET_MENU
 
+# کیبوردهای پارامتری: یک بار به ازای هر آرگومان (LRU تا آیدی‌های قدیمی نمونن)
+@functools.lru_cache(maxsize=1024)
 def kb_admin_receipt_actions(receipt_id: int, kind: ReceiptKind):
     # برای TOPUP/DIFF: رد ❌ و تایید + ورود مبلغ ✅
     # برای CARD: رد ❌ و تایید ✅
     if kind in [ReceiptKind.TOPUP, ReceiptKind.DIFF]:
-        return InlineKeyboardMarkup([
+        return StaticInlineKeyboard([
             [InlineKeyboardButton("❌ رد", callback_data=f"rc_rej:{receipt_id}")],
             [InlineKeyboardButton("✅ تایید + ورود مبلغ", callback_data=f"rc_ok_amt:{receipt_id}")]
         ])
     else:
-        return InlineKeyboardMarkup([
+        return StaticInlineKeyboard([
             [InlineKeyboardButton("❌ رد", callback_data=f"rc_rej:{receipt_id}")],
             [InlineKeyboardButton("✅ تایید", callback_data=f"rc_ok:{receipt_id}")]
         ])
 
+@functools.lru_cache(maxsize=256)
 def kb_repo_plan_actions(pid:int):
-    return InlineKeyboardMarkup([
+    return StaticInlineKeyboard([
         [InlineKeyboardButton("➕ افزودن کانفیگ متنی", callback_data=f"rp_add_text:{pid}")],
         [InlineKeyboardButton("🖼 افزودن کانفیگ عکس", callback_data=f"rp_add_photo:{pid}")],
         [InlineKeyboardButton("📦 مشاهده موجودی", callback_data=f"rp_view:{pid}")],
@@ -448,12 +1504,172 @@ def kb_repo_plan_actions(pid:int):
     ])
 
 def kb_repo_bulk_finish():
-    return InlineKeyboardMarkup([[InlineKeyboardButton("✅ اتمام", callback_data="rp_bulk_done")]])
+    return KB_REPO_BULK_FINISH
+
+def keyboard_metrics() -> Dict:
+    return {name: fn.cache_info()._asdict() for name, fn in
+            (("receipt_actions", kb_admin_receipt_actions), ("repo_plan_actions", kb_repo_plan_actions),
+             ("broadcast_actions", kb_broadcast_actions))}
+
+# ==============================
+# Outbound rate limiter (محدودیت‌های ارسال تلگرام)
+# ==============================
+RL_GLOBAL_PER_SEC = float(os.getenv("RL_GLOBAL_PER_SEC", "30"))  # کل ربات
+RL_CHAT_PER_SEC   = float(os.getenv("RL_CHAT_PER_SEC", "1"))     # هر چت خصوصی
+RL_CHAT_BURST     = float(os.getenv("RL_CHAT_BURST", "3"))
+RL_GROUP_PER_MIN  = float(os.getenv("RL_GROUP_PER_MIN", "20"))   # هر گروه/کانال
+RL_BULK_PER_SEC   = float(os.getenv("RL_BULK_PER_SEC", "25"))    # سهم ارسال‌های انبوه (اعلان همگانی) از سقف کلی
+RL_MAX_RETRIES    = int(os.getenv("RL_MAX_RETRIES", "3"))
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "last", "paused_until")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = max(1.0, capacity)
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, t: float):
+        self.tokens = min(self.capacity, self.tokens + (t - self.last) * self.rate)
+        self.last = t
+
+    def idle(self) -> bool:
+        t = time.monotonic()
+        self._refill(t)
+        return self.tokens >= self.capacity and t >= self.paused_until
+
+    async def acquire(self) -> bool:
+        # True یعنی مجبور شدیم صبر کنیم
+        waited = False
+        while True:
+            t = time.monotonic()
+            if t < self.paused_until:
+                waited = True
+                await asyncio.sleep(self.paused_until - t)
+                continue
+            self._refill(t)
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return waited
+            waited = True
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+class OutboundLimiter(BaseRateLimiter):
+    # دور application.bot پیچیده می‌شه: سقف کلی ~۳۰ پیام در ثانیه، سقف هر چت و هر گروه،
+    # رعایت retry_after در 429 و تلاش مجدد با backoff برای خطای شبکه.
+    def __init__(self):
+        self.global_bucket = TokenBucket(RL_GLOBAL_PER_SEC, RL_GLOBAL_PER_SEC)
+        # ارسال‌های bulk جدا هم محدود می‌شن تا جواب‌های عادی کاربرها پشتشون گیر نکنن
+        self.bulk_bucket = TokenBucket(RL_BULK_PER_SEC, RL_BULK_PER_SEC)
+        self.chats: Dict[int, TokenBucket] = {}
+        self.queued = 0
+        self.sent = 0
+        self.throttled = 0   # مجبور شدیم صبر کنیم (سقف محلی)
+        self.flood_429 = 0   # تلگرام 429 داد
+        self.retried = 0
+        self.failed = 0
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        b = self.chats.get(chat_id)
+        if b is None:
+            if len(self.chats) > 10000:
+                # باکت‌های پر و بیکار رو دور می‌ریزیم
+                for cid in [c for c, x in self.chats.items() if x.idle()]:
+                    del self.chats[cid]
+            if chat_id < 0:
+                b = TokenBucket(RL_GROUP_PER_MIN / 60.0, 1)
+            else:
+                b = TokenBucket(RL_CHAT_PER_SEC, RL_CHAT_BURST)
+            self.chats[chat_id] = b
+        return b
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        limited = isinstance(chat_id, int) and endpoint.startswith(("send", "copy", "forward", "edit"))
+        attempt = 0
+        while True:
+            if limited:
+                self.queued += 1
+                try:
+                    waited_bulk = False
+                    if rate_limit_args and rate_limit_args.get("priority") == "bulk":
+                        waited_bulk = await self.bulk_bucket.acquire()
+                    waited_chat = await self._chat_bucket(chat_id).acquire()
+                    waited_global = await self.global_bucket.acquire()
+                finally:
+                    self.queued -= 1
+                if waited_bulk or waited_chat or waited_global:
+                    self.throttled += 1
+            try:
+                result = await callback(*args, **kwargs)
+                self.sent += 1
+                return result
+            except RetryAfter as e:
+                self.flood_429 += 1
+                if attempt >= RL_MAX_RETRIES:
+                    self.failed += 1
+                    raise
+                wait = float(e.retry_after) + 0.1 * attempt
+                if limited:
+                    # خود باکت چت تا retry_after صبر می‌کنه
+                    self._chat_bucket(chat_id).pause(wait)
+                    wait = 0
+            except TimedOut:
+                # معلوم نیست رسیده یا نه؛ تکرارش ممکنه پیام تکراری بسازه
+                self.failed += 1
+                raise
+            except NetworkError:
+                if attempt >= RL_MAX_RETRIES:
+                    self.failed += 1
+                    raise
+                wait = 0.5 * (2 ** attempt)
+            except Exception:
+                self.failed += 1
+                raise
+            attempt += 1
+            self.retried += 1
+            await asyncio.sleep(wait)
+
+    def metrics(self) -> Dict:
+        return {
+            "queued": self.queued,
+            "sent": self.sent,
+            "throttled": self.throttled,
+            "flood_429": self.flood_429,
+            "retried": self.retried,
+            "failed": self.failed,
+            "chats_tracked": len(self.chats),
+        }
+
+outbound = OutboundLimiter()
 
 # ==============================
 # Bot (Application)
 # ==============================
-application: Application = ApplicationBuilder().token(BOT_TOKEN).build()
+FAKE_BOT_API = os.getenv("FAKE_BOT_API", "0") == "1"  # Bot API محلی (fakeapi.py) برای تست آفلاین
+fake_api = None
+
+def build_application() -> Application:
+    global fake_api
+    builder = ApplicationBuilder().token(BOT_TOKEN).rate_limiter(outbound)
+    if FAKE_BOT_API:
+        from fakeapi import FakeBotAPI
+        fake_api = FakeBotAPI()
+        builder = builder.request(fake_api.request()).get_updates_request(fake_api.request())
+    return builder.build()
+
+application: Application = build_application()
 
 # ==============================
 # Text blocks (خلاصه و مودبانه)
@@ -478,572 +1694,685 @@ HELP_TEXT = (
     "موفق باشی رفیق! 💙"
 )
 
+# ==============================
+# Router (جدول دیسپچ متن و کال‌بک، به‌جای زنجیره‌ی if)
+# ==============================
+class Router:
+    # متن: (step، دکمه) -> دکمه‌ی سراسری -> ورودی آزادِ همون step؛ هر کدوم یک lookup دیکشنری.
+    # کال‌بک: قسمت قبل از ":" کلید جدوله و بقیه‌ش آرگومان هندلر.
+    # هندلرهای متن: fn(update, context, u, text) | کال‌بک: fn(update, context, u, arg)
+    def __init__(self):
+        self.buttons: Dict[str, Tuple] = {}                    # متن دکمه -> (fn, فقط ادمین)
+        self.step_buttons: Dict[Tuple[Step, str], Tuple] = {}  # (step، متن دکمه) -> (fn, فقط ادمین)
+        self.inputs: Dict[Step, Tuple] = {}                    # step -> (fn, فقط ادمین)
+        self.callbacks: Dict[str, Tuple] = {}                  # پیشوند callback_data -> (fn, فقط ادمین)
+        self.routed = 0
+        self.unmatched = 0
+
+    @staticmethod
+    def _add(table: Dict, keys, fn, admin: bool):
+        for k in keys:
+            if k in table:
+                raise ValueError(f"duplicate route: {k!r}")
+            table[k] = (fn, admin)
+
+    def button(self, text: str, *steps: Step, admin: bool = False):
+        # بدون steps یعنی دکمه‌ی سراسری (توی هر stepی کار می‌کنه)
+        def deco(fn):
+            if steps:
+                self._add(self.step_buttons, [(s, text) for s in steps], fn, admin)
+            else:
+                self._add(self.buttons, [text], fn, admin)
+            return fn
+        return deco
+
+    def input(self, *steps: Step, admin: bool = False):
+        def deco(fn):
+            self._add(self.inputs, steps, fn, admin)
+            return fn
+        return deco
+
+    def callback(self, *prefixes: str, admin: bool = False):
+        def deco(fn):
+            self._add(self.callbacks, prefixes, fn, admin)
+            return fn
+        return deco
+
+    @staticmethod
+    def _pick(hit: Optional[Tuple], is_admin: bool):
+        # مسیر ادمینی برای غیرادمین یعنی «نیست»؛ نوبت مرحله‌ی بعدی lookup
+        if hit is None or (hit[1] and not is_admin):
+            return None
+        return hit[0]
+
+    def match_button(self, step: Step, text: str, is_admin: bool):
+        return (self._pick(self.step_buttons.get((step, text)), is_admin)
+                or self._pick(self.buttons.get(text), is_admin))
+
+    def match_input(self, step: Step, is_admin: bool):
+        return self._pick(self.inputs.get(step), is_admin)
+
+    def match_callback(self, data: str, is_admin: bool):
+        prefix, _, arg = data.partition(":")
+        return self._pick(self.callbacks.get(prefix), is_admin), arg
+
+    def metrics(self) -> Dict:
+        return {
+            "buttons": len(self.buttons), "step_buttons": len(self.step_buttons),
+            "inputs": len(self.inputs), "callbacks": len(self.callbacks),
+            "routed": self.routed, "unmatched": self.unmatched,
+        }
+
+router = Router()
+
 # ==============================
 # Core Handlers
 # ==============================
+def db_ensure_user(db, uid:int, username:Optional[str], first_name:Optional[str]) -> User:
+    u = db.query(User).get(uid)
+    if not u:
+        u = User(id=uid, username=username, first_name=first_name, is_admin=user_is_admin(uid))
+        db.add(u); db.commit()
+    else:
+        # sync admin flag
+        was = u.is_admin
+        u.is_admin = user_is_admin(uid)
+        if u.is_admin != was:
+            db.commit()
+    return u
+
 async def ensure_user(update: Update, context: ContextTypes.DEFAULT_TYPE) -> User:
     tg: TgUser = update.effective_user
-    db = SessionLocal()
-    try:
-        u = db.query(User).get(tg.id)
-        if not u:
-            u = User(id=tg.id, username=tg.username, first_name=tg.first_name, is_admin=user_is_admin(tg.id))
-            db.add(u); db.commit()
-        else:
-            # sync admin flag
-            was = u.is_admin
-            u.is_admin = user_is_admin(tg.id)
-            if u.is_admin != was:
-                db.commit()
-        return u
-    finally:
-        db.close()
+    return await run_db(db_ensure_user, tg.id, tg.username, tg.first_name)
 
 async def start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     u = await ensure_user(update, context)
     clear_step(u.id)
     await update.effective_message.reply_text(WELCOME, reply_markup=kb_main(u.id, u.is_admin))
 
-async def fallback_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # تنها هندلر متن‌ها (بجز /commandها)؛ مسیر از جدول router
     u = await ensure_user(update, context)
-    s = st(u.id).get("step", Step.IDLE)
-
     text = (update.effective_message.text or "").strip()
+    s = st(u.id)
+    is_admin = user_is_admin(u.id)
+    fn = router.match_button(s["step"], text, is_admin)
+    if fn is None and "enter_amount_for_receipt" in s:
+        fn = admin_enter_amount  # ادمین بعد از «✅ تایید + ورود مبلغ»، مبلغ رو می‌فرسته
+    if fn is None:
+        fn = router.match_input(s["step"], is_admin)
+    if fn is None:
+        router.unmatched += 1
+        fn = not_understood
+    else:
+        router.routed += 1
+    await fn(update, context, u, text)
 
-    # ===== Global navigation =====
-    if text == "🔙 بازگشت":
-        clear_step(u.id)
-        await update.effective_message.reply_text("برگشتیم به منوی قبلی ✨", reply_markup=kb_main(u.id, u.is_admin))
-        return
-    if text == "❌ انصراف":
-        clear_step(u.id)
-        await update.effective_message.reply_text("عملیات لغو شد ✅", reply_markup=kb_main(u.id, u.is_admin))
-        return
-
-    # ===== Main menu =====
-    if text == "🛍 خرید سرویس":
-        await show_plans(update, context, u.id)
-        return
-
-    if text == "🧾 کانفیگ‌های من":
-        await my_configs(update, context, u.id)
-        return
-
-    if text == "💳 کیف پول":
-        await wallet_menu(update, context, u.id)
-        return
-
-    if text == "🎟️ تیکت‌ها":
-        await ticket_menu(update, context, u.id)
-        return
-
-    if text == "ℹ️ آموزش":
-        await update.effective_message.reply_text(HELP_TEXT, reply_markup=kb_main(u.id, u.is_admin))
-        return
+async def not_understood(update: Update, context: ContextTypes.DEFAULT_TYPE, u: User, text: str):
+    await update.effective_message.reply_text("متوجه نشدم چی می‌خوای 🤔 لطفاً از منوی پایین انتخاب کن.", reply_markup=kb_main(u.id, u.is_admin))
 
-    if text == "📊 آمار فروش":
-        await stats_menu_user(update, context, u.id)
-        return
+# ===== Global navigation =====
+@router.button("🔙 بازگشت")
+async def route_back(update: Update, context: ContextTypes.DEFAULT_TYPE, u: User, text: str):
+    clear_step(u.id)
+    await update.effective_message.reply_text("برگشتیم به منوی قبلی ✨", reply_markup=kb_main(u.id, u.is_admin))
 
-    if text == "🛠 پنل ادمین" and user_is_admin(u.id):
-        set_step(u.id, Step.ADMIN_MODE)
-        await update.effective_message.reply_text("پنل ادمین باز شد 👨🏻‍💻", reply_markup=kb_admin_main())
+@router.button("❌ انصراف")
+async def route_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE, u: User, text: str):
+    clear_step(u.id)
+    await update.effective_message.reply_text("عملیات لغو شد ✅", reply_markup=kb_main(u.id, u.is_admin))
+
+# ===== Main menu =====
+@router.button("🛍 خرید سرویس")
+async def route_buy(update: Update, context: ContextTypes.DEFAULT_TYPE, u: User, text: str):
+    await show_plans(update, context, u.id)
+
+@router.button("🧾 کانفیگ‌های من")
+async def route_my_configs(update: Update, context: ContextTypes.DEFAULT_TYPE, u: User, text: str):
+    await my_configs(update, context, u.id)
+
+@router.button("💳 کیف پول")
+async def route_wallet(update: Update, context: ContextTypes.DEFAULT_TYPE, u: User, text: str):
+    await wallet_menu(update, context, u.id)
+
+@router.button("🎟️ تیکت‌ها")
+async def route_tickets(update: Update, context: ContextTypes.DEFAULT_TYPE, u: User, text: str):
+    await ticket_menu(update, context, u.id)
+
+@router.button("🆕 تیکت جدید")
+async def route_ticket_new(update: Update, context: ContextTypes.DEFAULT_TYPE, u: User, text: str):
+    await ticket_new(update, context, u.id)
+
+@router.button("📚 سابقه تیکت‌ها")
+async def route_ticket_history(update: Update, context: ContextTypes.DEFAULT_TYPE, u: User, text: str):
+    await ticket_history(update, context, u.id)
+
+@router.button("ℹ️ آموزش")
+async def route_help(update: Update, context: ContextTypes.DEFAULT_TYPE, u: User, text: str):
+    await update.effective_message.reply_text(HELP_TEXT, reply_markup=kb_main(u.id, u.is_admin))
+
+@router.button("📊 آمار فروش")
+async def route_user_stats(update: Update, context: ContextTypes.DEFAULT_TYPE, u: User, text: str):
+    await stats_menu_user(update, context, u.id)
+
+@router.button("🛠 پنل ادمین", admin=True)
+async def route_admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE, u: User, text: str):
+    set_step(u.id, Step.ADMIN_MODE)
+    await update.effective_message.reply_text("پنل ادمین باز شد 👨🏻‍💻", reply_markup=kb_admin_main())
+
+# ===== Admin menu =====
+# سراسری (نه فقط در ADMIN_MODE): بعد از هر ویزارد ادمین state پاک میشه ولی کیبورد پنل ادمین سر جاشه
+@router.button("🔙 بازگشت به منوی کاربر", admin=True)
+async def route_admin_exit(update: Update, context: ContextTypes.DEFAULT_TYPE, u: User, text: str):
+    clear_step(u.id)
+    await update.effective_message.reply_text("بازگشت به حالت کاربر ✅", reply_markup=kb_main(u.id, u.is_admin))
+
+@router.button("💳 تغییر شماره کارت", admin=True)
+async def route_admin_set_card(update: Update, context: ContextTypes.DEFAULT_TYPE, u: User, text: str):
+    set_step(u.id, Step.ADMIN_SET_CARD)
+    await update.effective_message.reply_text("شماره کارت جدید رو بفرست (با خط تیره‌های مرتب) 💳", reply_markup=kb_back_cancel())
+
+@router.button("👤 مدیریت ادمین‌ها", admin=True)
+async def route_admin_admins(update: Update, context: ContextTypes.DEFAULT_TYPE, u: User, text: str):
+    await admin_manage_admins(update, context, u.id)
+
+@router.button("📥 رسیدهای در انتظار", admin=True)
+async def route_admin_receipts(update: Update, context: ContextTypes.DEFAULT_TYPE, u: User, text: str):
+    await admin_list_pending_receipts(update, context, u.id)
+
+@router.button("👛 کیف پول کاربر", admin=True)
+async def route_admin_wallet(update: Update, context: ContextTypes.DEFAULT_TYPE, u: User, text: str):
+    set_step(u.id, Step.ADMIN_WALLET_ADJ_USER)
+    st(u.id)["wallet_adj_target"]=None
+    await update.effective_message.reply_text("آیدی عددی یا یوزرنیم کاربر رو بفرست 🆔", reply_markup=kb_back_cancel())
+
+@router.button("🏷️ کُدهای تخفیف", admin=True)
+async def route_admin_discounts(update: Update, context: ContextTypes.DEFAULT_TYPE, u: User, text: str):
+    await admin_discounts_menu(update, context, u.id)
+
+@router.button("📢 اعلان همگانی", admin=True)
+async def route_admin_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE, u: User, text: str):
+    set_step(u.id, Step.ADMIN_BROADCAST)
+    await update.effective_message.reply_text("متن اعلان برای همه‌ی کاربران رو بفرست 📣", reply_markup=kb_back_cancel())
+
+@router.button("🧩 مدیریت پلن و مخزن", admin=True)
+async def route_admin_plans(update: Update, context: ContextTypes.DEFAULT_TYPE, u: User, text: str):
+    await admin_plans_and_repo(update, context, u.id)
+
+@router.button("📈 آمار فروش", admin=True)
+async def route_admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE, u: User, text: str):
+    await admin_stats_panel(update, context, u.id)
+
+# ===== Admin steps =====
+@router.input(Step.ADMIN_SET_CARD, admin=True)
+async def input_card_number(update: Update, context: ContextTypes.DEFAULT_TYPE, u: User, text: str):
+    if len(text) < 8:
+        await update.effective_message.reply_text("شماره کارت معتبر نیست. دوباره بفرست 🙏")
         return
-
-    # ===== Admin menu =====
-    if s == Step.ADMIN_MODE:
-        if text == "🔙 بازگشت به منوی کاربر":
-            clear_step(u.id)
-            await update.effective_message.reply_text("بازگشت به حالت کاربر ✅", reply_markup=kb_main(u.id, u.is_admin))
-            return
-
-        if text == "💳 تغییر شماره کارت":
-            set_step(u.id, Step.ADMIN_SET_CARD)
-            await update.effective_message.reply_text("شماره کارت جدید رو بفرست (با خط تیره‌های مرتب) 💳", reply_markup=kb_back_cancel())
-            return
-
-        if text == "👤 مدیریت ادمین‌ها":
-            await admin_manage_admins(update, context, u.id)
-            return
-
-        if text == "📥 رسیدهای در انتظار":
-            await admin_list_pending_receipts(update, context, u.id)
-            return
-
-        if text == "👛 کیف پول کاربر":
-            set_step(u.id, Step.ADMIN_WALLET_ADJ_USER)
-            st(u.id)["wallet_adj_target"]=None
-            await update.effective_message.reply_text("آیدی عددی یا یوزرنیم کاربر رو بفرست 🆔", reply_markup=kb_back_cancel())
-            return
-
-        if text == "🏷️ کُدهای تخفیف":
-            await admin_discounts_menu(update, context, u.id)
-            return
-
-        if text == "📢 اعلان همگانی":
-            set_step(u.id, Step.ADMIN_BROADCAST)
-            await update.effective_message.reply_text("متن اعلان برای همه‌ی کاربران رو بفرست 📣", reply_markup=kb_back_cancel())
-            return
-
-        if text == "🧩 مدیریت پلن و مخزن":
-            await admin_plans_and_repo(update, context, u.id)
-            return
-
-        if text == "📈 آمار فروش":
-            await admin_stats_panel(update, context, u.id)
-            return
-
-    # ===== Admin steps =====
-    if s == Step.ADMIN_SET_CARD:
-        v = text
-        if len(v) < 8:
-            await update.effective_message.reply_text("شماره کارت معتبر نیست. دوباره بفرست 🙏")
-            return
-        set_card_number(v)
-        clear_step(u.id)
-        await update.effective_message.reply_text(f"شماره کارت با موفقیت تغییر کرد ✅\n\n🔢 {get_card_number()}", reply_markup=kb_admin_main())
+    await run_db(set_card_number, text)
+    clear_step(u.id)
+    await update.effective_message.reply_text(f"شماره کارت با موفقیت تغییر کرد ✅\n\n🔢 {get_card_number()}", reply_markup=kb_admin_main())
+
+@router.input(Step.ADMIN_WALLET_ADJ_USER, admin=True)
+async def input_wallet_user(update: Update, context: ContextTypes.DEFAULT_TYPE, u: User, text: str):
+    def find_user(db):
+        if text.isdigit():
+            return db.query(User).get(int(text))
+        return db.query(User).filter(User.username==text.lstrip("@")).first()
+    target = await run_db(find_user)
+    if not target:
+        await update.effective_message.reply_text("کاربر پیدا نشد 🙏 دوباره آیدی عددی یا یوزرنیم بده.")
         return
+    st(u.id)["wallet_adj_target"]=target.id
+    set_step(u.id, Step.ADMIN_WALLET_ADJ_AMOUNT)
+    await update.effective_message.reply_text(
+        f"کاربر: {target.first_name or ''} @{target.username or '-'}\n"
+        f"موجودی فعلی: {money(target.wallet)}\n\n"
+        f"مبلغ (+ برای افزایش، - برای کاهش) رو بفرست. مثال: 20000 یا -5000",
+        reply_markup=kb_back_cancel()
+    )
 
-    if s == Step.ADMIN_WALLET_ADJ_USER:
-        target = None
-        db = SessionLocal()
-        try:
-            if text.isdigit():
-                target = db.query(User).get(int(text))
-            else:
-                t = text.lstrip("@")
-                target = db.query(User).filter(User.username==t).first()
-            if not target:
-                await update.effective_message.reply_text("کاربر پیدا نشد 🙏 دوباره آیدی عددی یا یوزرنیم بده.")
-                return
-            st(u.id)["wallet_adj_target"]=target.id
-            set_step(u.id, Step.ADMIN_WALLET_ADJ_AMOUNT)
-            await update.effective_message.reply_text(
-                f"کاربر: {target.first_name or ''} @{target.username or '-'}\n"
-                f"موجودی فعلی: {money(target.wallet)}\n\n"
-                f"مبلغ (+ برای افزایش، - برای کاهش) رو بفرست. مثال: 20000 یا -5000",
-                reply_markup=kb_back_cancel()
-            )
-        finally:
-            db.close()
+@router.input(Step.ADMIN_WALLET_ADJ_AMOUNT, admin=True)
+async def input_wallet_amount(update: Update, context: ContextTypes.DEFAULT_TYPE, u: User, text: str):
+    try:
+        amt = float(text)
+    except:
+        await update.effective_message.reply_text("عدد معتبر بفرست 🙏")
         return
-
-    if s == Step.ADMIN_WALLET_ADJ_AMOUNT:
-        try:
-            amt = float(text)
-        except:
-            await update.effective_message.reply_text("عدد معتبر بفرست 🙏")
-            return
-        db = SessionLocal()
-        try:
-            target_id = st(u.id).get("wallet_adj_target")
-            target = db.query(User).get(target_id)
-            if not target:
-                await update.effective_message.reply_text("کاربر یافت نشد.")
-                clear_step(u.id); return
+    def adjust_wallet(db, target_id):
+        target = db.query(User).get(target_id)
+        if target:
             target.wallet = max(0.0, (target.wallet or 0.0) + amt)
             db.commit()
-            await update.effective_message.reply_text(
-                f"انجام شد ✅\nموجودی جدید {target.first_name or ''}: {money(target.wallet)}",
-                reply_markup=kb_admin_main()
-            )
-            clear_step(u.id)
-        finally:
-            db.close()
-        return
-
-    if s == Step.ADMIN_DISC_NEW_CODE:
-        code = re.sub(r"\s+", "", text).upper()
-        if not code or len(code) < 3:
-            await update.effective_message.reply_text("کد معتبر نیست. دوباره بفرست.")
-            return
-        st(u.id)["disc_code"]=code
-        set_step(u.id, Step.ADMIN_DISC_NEW_PERCENT)
-        await update.effective_message.reply_text("درصد تخفیف رو بفرست (0..100) 📉", reply_markup=kb_back_cancel())
-        return
-
-    if s == Step.ADMIN_DISC_NEW_PERCENT:
-        try:
-            p = int(text)
-        except:
-            await update.effective_message.reply_text("درصد صحیح بفرست (0..100) 🙏")
-            return
-        if p<0 or p>100:
-            await update.effective_message.reply_text("درصد باید بین 0 و 100 باشه.")
-            return
-        st(u.id)["disc_percent"]=p
-        set_step(u.id, Step.ADMIN_DISC_NEW_MAXUSES)
-        await update.effective_message.reply_text("حداکثر دفعات استفاده رو بفرست (0=نامحدود) ♾️", reply_markup=kb_back_cancel())
-        return
-
-    if s == Step.ADMIN_DISC_NEW_MAXUSES:
-        try:
-            mu = int(text)
-        except:
-            await update.effective_message.reply_text("عدد صحیح بفرست 🙏")
-            return
-        st(u.id)["disc_max"]=mu
-        set_step(u.id, Step.ADMIN_DISC_NEW_EXP)
-        await update.effective_message.reply_text("تاریخ انقضا رو بفرست (YYYY-MM-DD) یا بنویس 'بدون' 📅", reply_markup=kb_back_cancel())
-        return
+        return target
+    target = await run_db(adjust_wallet, st(u.id).get("wallet_adj_target"))
+    if not target:
+        await update.effective_message.reply_text("کاربر یافت نشد.")
+        clear_step(u.id); return
+    await update.effective_message.reply_text(
+        f"انجام شد ✅\nموجودی جدید {target.first_name or ''}: {money(target.wallet)}",
+        reply_markup=kb_admin_main()
+    )
+    clear_step(u.id)
 
-    if s == Step.ADMIN_DISC_NEW_EXP:
-        exp=None
-        if text.strip()!="بدون":
-            try:
-                exp = dt.datetime.strptime(text.strip(), "%Y-%m-%d")
-            except:
-                await update.effective_message.reply_text("فرمت تاریخ اشتباهه. مثلا 2025-12-31")
-                return
-        db=SessionLocal()
-        try:
-            code=st(u.id)["disc_code"]; percent=st(u.id)["disc_percent"]; mx=st(u.id)["disc_max"]
-            if db.query(Discount).filter(Discount.code==code).first():
-                await update.effective_message.reply_text("این کد وجود داره. کد دیگری انتخاب کن.")
-                return
-            d=Discount(code=code, percent=percent, max_uses=mx, expires_at=exp)
-            db.add(d); db.commit()
-            await update.effective_message.reply_text(f"کد تخفیف ساخته شد ✅\n{code} — {percent}%\nحداکثر استفاده: {mx}\nانقضا: {exp or 'بدون'}",
-                                                      reply_markup=kb_admin_main())
-            clear_step(u.id)
-        finally:
-            db.close()
+@router.input(Step.ADMIN_DISC_NEW_CODE, admin=True)
+async def input_disc_code(update: Update, context: ContextTypes.DEFAULT_TYPE, u: User, text: str):
+    code = re.sub(r"\s+", "", text).upper()
+    if not code or len(code) < 3:
+        await update.effective_message.reply_text("کد معتبر نیست. دوباره بفرست.")
         return
+    st(u.id)["disc_code"]=code
+    set_step(u.id, Step.ADMIN_DISC_NEW_PERCENT)
+    await update.effective_message.reply_text("درصد تخفیف رو بفرست (0..100) 📉", reply_markup=kb_back_cancel())
 
-    if s == Step.ADMIN_BROADCAST:
-        txt = text
-        db=SessionLocal()
-        try:
-            ids=[u.id for u in db.query(User).all()]
-        finally: db.close()
-        cnt=0
-        for uid in ids:
-            try:
-                await context.bot.send_message(chat_id=uid, text=f"📣 {txt}")
-                cnt+=1
-            except: pass
-        clear_step(u.id)
-        await update.effective_message.reply_text(f"ارسال شد ✅ ({cnt} کاربر)", reply_markup=kb_admin_main())
+@router.input(Step.ADMIN_DISC_NEW_PERCENT, admin=True)
+async def input_disc_percent(update: Update, context: ContextTypes.DEFAULT_TYPE, u: User, text: str):
+    try:
+        p = int(text)
+    except:
+        await update.effective_message.reply_text("درصد صحیح بفرست (0..100) 🙏")
         return
-
-    if s == Step.ADMIN_PLAN_NEW_NAME:
-        st(u.id)["new_plan_name"]=text
-        set_step(u.id, Step.ADMIN_PLAN_NEW_DAYS)
-        await update.effective_message.reply_text("مدت پلن چند روزه‌ست؟ (عدد) 📆", reply_markup=kb_back_cancel()); return
-    if s == Step.ADMIN_PLAN_NEW_DAYS:
-        try: d=int(text)
-        except: await update.effective_message.reply_text("عدد معتبر بفرست."); return
-        st(u.id)["new_plan_days"]=d
-        set_step(u.id, Step.ADMIN_PLAN_NEW_VOL)
-        await update.effective_message.reply_text("حجم پلن چند گیگابایته؟ (عدد) 📦", reply_markup=kb_back_cancel()); return
-    if s == Step.ADMIN_PLAN_NEW_VOL:
-        try: v=int(text)
-        except: await update.effective_message.reply_text("عدد معتبر بفرست."); return
-        st(u.id)["new_plan_vol"]=v
-        set_step(u.id, Step.ADMIN_PLAN_NEW_PRICE)
-        await update.effective_message.reply_text("قیمت فروش پلن؟ (تومان) 💵", reply_markup=kb_back_cancel()); return
-    if s == Step.ADMIN_PLAN_NEW_PRICE:
-        try: pr=float(text)
-        except: await update.effective_message.reply_text("عدد معتبر بفرست."); return
-        st(u.id)["new_plan_price"]=pr
-        set_step(u.id, Step.ADMIN_PLAN_NEW_COST)
-        await update.effective_message.reply_text("قیمت تمام‌شده پلن؟ (برای محاسبه سود) 🧮", reply_markup=kb_back_cancel()); return
-    if s == Step.ADMIN_PLAN_NEW_COST:
-        try: cp=float(text)
-        except: await update.effective_message.reply_text("عدد معتبر بفرست."); return
-        db=SessionLocal()
-        try:
-            pl=Plan(
-                name=st(u.id)["new_plan_name"], days=st(u.id)["new_plan_days"],
-                volume_gb=st(u.id)["new_plan_vol"], price=st(u.id)["new_plan_price"],
-                cost_price=cp
-            )
-            db.add(pl); db.commit()
-            clear_step(u.id)
-            await update.effective_message.reply_text("پلن ساخته شد ✅", reply_markup=kb_admin_main())
-        finally: db.close()
+    if p<0 or p>100:
+        await update.effective_message.reply_text("درصد باید بین 0 و 100 باشه.")
         return
+    st(u.id)["disc_percent"]=p
+    set_step(u.id, Step.ADMIN_DISC_NEW_MAXUSES)
+    await update.effective_message.reply_text("حداکثر دفعات استفاده رو بفرست (0=نامحدود) ♾️", reply_markup=kb_back_cancel())
 
-    # ===== Tickets =====
-    if s == Step.TICKET_ENTER_SUBJECT:
-        st(u.id)["ticket_subject"]=text
-        set_step(u.id, Step.TICKET_ENTER_MESSAGE)
-        await update.effective_message.reply_text("متن پیام تیکت رو بنویس 📝", reply_markup=kb_back_cancel())
+@router.input(Step.ADMIN_DISC_NEW_MAXUSES, admin=True)
+async def input_disc_maxuses(update: Update, context: ContextTypes.DEFAULT_TYPE, u: User, text: str):
+    try:
+        mu = int(text)
+    except:
+        await update.effective_message.reply_text("عدد صحیح بفرست 🙏")
         return
-    if s == Step.TICKET_ENTER_MESSAGE:
-        db=SessionLocal()
+    st(u.id)["disc_max"]=mu
+    set_step(u.id, Step.ADMIN_DISC_NEW_EXP)
+    await update.effective_message.reply_text("تاریخ انقضا رو بفرست (YYYY-MM-DD) یا بنویس 'بدون' 📅", reply_markup=kb_back_cancel())
+
+@router.input(Step.ADMIN_DISC_NEW_EXP, admin=True)
+async def input_disc_exp(update: Update, context: ContextTypes.DEFAULT_TYPE, u: User, text: str):
+    exp=None
+    if text.strip()!="بدون":
         try:
-            t=Ticket(user_id=u.id, subject=st(u.id)["ticket_subject"])
-            db.add(t); db.flush()
-            db.add(TicketMessage(ticket_id=t.id, user_id=u.id, text=text))
-            db.commit()
-            clear_step(u.id)
-            await update.effective_message.reply_text("تیکت ثبت شد ✅ پشتیبانی بزودی پاسخ می‌ده.", reply_markup=kb_main(u.id, u.is_admin))
-        finally: db.close()
+            exp = dt.datetime.strptime(text.strip(), "%Y-%m-%d")
+        except:
+            await update.effective_message.reply_text("فرمت تاریخ اشتباهه. مثلا 2025-12-31")
+            return
+    code=st(u.id)["disc_code"]; percent=st(u.id)["disc_percent"]; mx=st(u.id)["disc_max"]
+    def create_discount(db):
+        if db.query(Discount).filter(Discount.code==code).first():
+            return False
+        db.add(Discount(code=code, percent=percent, max_uses=mx, expires_at=exp)); db.commit()
+        return True
+    if not await run_db(create_discount):
+        await update.effective_message.reply_text("این کد وجود داره. کد دیگری انتخاب کن.")
         return
+    await update.effective_message.reply_text(f"کد تخفیف ساخته شد ✅\n{code} — {percent}%\nحداکثر استفاده: {mx}\nانقضا: {exp or 'بدون'}",
+                                              reply_markup=kb_admin_main())
+    clear_step(u.id)
 
-    # ===== Buy flow =====
-    if s == Step.PLAN_DETAIL or s == Step.APPLY_DISCOUNT or s == Step.PAY_MENU:
-        await handle_buy_flow_text(update, context, u, text)
-        return
+@router.input(Step.ADMIN_BROADCAST, admin=True)
+async def input_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE, u: User, text: str):
+    clear_step(u.id)
+    jid = await broadcasts.create(context.bot, u.id, text)
+    await update.effective_message.reply_text(f"اعلان #{jid} در پس‌زمینه شروع شد ✅ پیشرفتش همون بالا آپدیت میشه.", reply_markup=kb_admin_main())
+
+@router.input(Step.ADMIN_PLAN_NEW_NAME, admin=True)
+async def input_plan_name(update: Update, context: ContextTypes.DEFAULT_TYPE, u: User, text: str):
+    st(u.id)["new_plan_name"]=text
+    set_step(u.id, Step.ADMIN_PLAN_NEW_DAYS)
+    await update.effective_message.reply_text("مدت پلن چند روزه‌ست؟ (عدد) 📆", reply_markup=kb_back_cancel())
+
+@router.input(Step.ADMIN_PLAN_NEW_DAYS, admin=True)
+async def input_plan_days(update: Update, context: ContextTypes.DEFAULT_TYPE, u: User, text: str):
+    try: d=int(text)
+    except: await update.effective_message.reply_text("عدد معتبر بفرست."); return
+    st(u.id)["new_plan_days"]=d
+    set_step(u.id, Step.ADMIN_PLAN_NEW_VOL)
+    await update.effective_message.reply_text("حجم پلن چند گیگابایته؟ (عدد) 📦", reply_markup=kb_back_cancel())
+
+@router.input(Step.ADMIN_PLAN_NEW_VOL, admin=True)
+async def input_plan_vol(update: Update, context: ContextTypes.DEFAULT_TYPE, u: User, text: str):
+    try: v=int(text)
+    except: await update.effective_message.reply_text("عدد معتبر بفرست."); return
+    st(u.id)["new_plan_vol"]=v
+    set_step(u.id, Step.ADMIN_PLAN_NEW_PRICE)
+    await update.effective_message.reply_text("قیمت فروش پلن؟ (تومان) 💵", reply_markup=kb_back_cancel())
+
+@router.input(Step.ADMIN_PLAN_NEW_PRICE, admin=True)
+async def input_plan_price(update: Update, context: ContextTypes.DEFAULT_TYPE, u: User, text: str):
+    try: pr=float(text)
+    except: await update.effective_message.reply_text("عدد معتبر بفرست."); return
+    st(u.id)["new_plan_price"]=pr
+    set_step(u.id, Step.ADMIN_PLAN_NEW_COST)
+    await update.effective_message.reply_text("قیمت تمام‌شده پلن؟ (برای محاسبه سود) 🧮", reply_markup=kb_back_cancel())
+
+@router.input(Step.ADMIN_PLAN_NEW_COST, admin=True)
+async def input_plan_cost(update: Update, context: ContextTypes.DEFAULT_TYPE, u: User, text: str):
+    try: cp=float(text)
+    except: await update.effective_message.reply_text("عدد معتبر بفرست."); return
+    pl=Plan(
+        name=st(u.id)["new_plan_name"], days=st(u.id)["new_plan_days"],
+        volume_gb=st(u.id)["new_plan_vol"], price=st(u.id)["new_plan_price"],
+        cost_price=cp
+    )
+    def create_plan(db):
+        db.add(pl); db.commit()
+    await run_db(create_plan)
+    clear_step(u.id)
+    await update.effective_message.reply_text("پلن ساخته شد ✅", reply_markup=kb_admin_main())
 
-    # ===== Wallet topup =====
-    if s == Step.TOPUP_WAIT_RECEIPT:
-        # انتظار رسید: فقط با عکس/متن هندل میشه؛ برای متن رسید همینجا بگیریم
-        rid = await create_receipt(u.id, kind=ReceiptKind.TOPUP, text=text)
-        await notify_admins_new_receipt(context, rid)
-        clear_step(u.id)
-        await update.effective_message.reply_text("مرسی 🙏 رسیدت رسید. بعد از تایید ادمین، کیف پولت شارژ میشه. ✨",
-                                                  reply_markup=kb_main(u.id, u.is_admin))
+# افزودن کانفیگ متنی در مخزن (هر پیام = یک کانفیگ)
+@router.input(Step.ADMIN_REPO_ADD_TEXT, admin=True)
+async def input_repo_text(update: Update, context: ContextTypes.DEFAULT_TYPE, u: User, text: str):
+    pid = st(u.id).get("repo_plan_id")
+    if not pid:
+        await update.effective_message.reply_text("ابتدا پلن را انتخاب کن.")
         return
-
-    # اگر به اینجا رسید:
-    await update.effective_message.reply_text("متوجه نشدم چی می‌خوای 🤔 لطفاً از منوی پایین انتخاب کن.", reply_markup=kb_main(u.id, u.is_admin))
+    def add_text_config(db):
+        stock_counters.add(db, pid, content_type="text", text_content=text)
+        db.commit()
+    await run_db(add_text_config)
+    await update.effective_message.reply_text("یک کانفیگ متنی اضافه شد ✅ (برای پایان «✅ اتمام»)")
+
+# ===== Tickets =====
+@router.input(Step.TICKET_ENTER_SUBJECT)
+async def input_ticket_subject(update: Update, context: ContextTypes.DEFAULT_TYPE, u: User, text: str):
+    st(u.id)["ticket_subject"]=text
+    set_step(u.id, Step.TICKET_ENTER_MESSAGE)
+    await update.effective_message.reply_text("متن پیام تیکت رو بنویس 📝", reply_markup=kb_back_cancel())
+
+@router.input(Step.TICKET_ENTER_MESSAGE)
+async def input_ticket_message(update: Update, context: ContextTypes.DEFAULT_TYPE, u: User, text: str):
+    subject = st(u.id)["ticket_subject"]
+    def create_ticket(db):
+        t=Ticket(user_id=u.id, subject=subject)
+        db.add(t); db.flush()
+        db.add(TicketMessage(ticket_id=t.id, user_id=u.id, text=text))
+        db.commit()
+    await run_db(create_ticket)
+    clear_step(u.id)
+    await update.effective_message.reply_text("تیکت ثبت شد ✅ پشتیبانی بزودی پاسخ می‌ده.", reply_markup=kb_main(u.id, u.is_admin))
+
+# ===== Wallet topup =====
+@router.button("📤 ارسال رسید شارژ", Step.TOPUP_WAIT_RECEIPT)
+async def route_topup_receipt(update: Update, context: ContextTypes.DEFAULT_TYPE, u: User, text: str):
+    # خود متن دکمه رسید نیست
+    await update.effective_message.reply_text("عکس رسید یا متن رسید کارت‌به‌کارت رو بفرست 📸🧾", reply_markup=kb_back_cancel())
+
+@router.input(Step.TOPUP_WAIT_RECEIPT)
+async def input_topup_receipt(update: Update, context: ContextTypes.DEFAULT_TYPE, u: User, text: str):
+    # انتظار رسید: فقط با عکس/متن هندل میشه؛ برای متن رسید همینجا بگیریم
+    rid = await create_receipt(u.id, kind=ReceiptKind.TOPUP, text=text)
+    await notify_admins_new_receipt(context, rid)
+    clear_step(u.id)
+    await update.effective_message.reply_text("مرسی 🙏 رسیدت رسید. بعد از تایید ادمین، کیف پولت شارژ میشه. ✨",
+                                              reply_markup=kb_main(u.id, u.is_admin))
 
 # ==============================
 # Buy Flow Helpers
 # ==============================
-async def show_plans(update: Update, context: ContextTypes.DEFAULT_TYPE, uid:int):
-    db=SessionLocal()
-    try:
-        pls = plans_as_rows(db)
-        if not pls:
-            await update.effective_message.reply_text("فعلاً پلنی ثبت نشده 🙏", reply_markup=kb_main(uid, user_is_admin(uid)))
-            return
-        lines=["🛍 لیست پلن‌ها:\n"]
-        for p in pls:
-            stock = plan_stock(db, p.id)
-            lines.append(
-                f"• {p.name}\n"
-                f"⏳ مدت: {p.days} روز | 🧰 حجم: {p.volume_gb}GB | 💵 قیمت: {money(p.price)} | 📦 موجودی مخزن: {stock}\n"
-                f"/plan_{p.id}\n"
-            )
-        await update.effective_message.reply_text("\n".join(lines))
-        set_step(uid, Step.SELECT_PLAN)
-    finally: db.close()
+def db_catalog(db) -> List[Tuple[Plan, int]]:
+    # یک کوئری؛ موجودی از ستون plans.stock
+    return [(p, p.stock) for p in plans_as_rows(db)]
 
-async def show_plan_detail(update: Update, context: ContextTypes.DEFAULT_TYPE, uid:int, plan_id:int):
-    db=SessionLocal()
-    try:
-        p = db.query(Plan).get(plan_id)
-        if not p:
-            await update.effective_message.reply_text("پلن پیدا نشد 🙏"); return
-        stock = plan_stock(db, plan_id)
-        s = st(uid)
-        s["selected_plan_id"]=plan_id
-        s["applied_discount"]=None
-        txt = (
-            f"🔘 {p.name}\n\n"
-            f"⏳ مدت: {p.days} روز\n🧰 حجم: {p.volume_gb}GB\n"
-            f"💵 قیمت: {money(p.price)}\n"
-            f"📦 موجودی مخزن: {stock}\n\n"
-            f"یه گزینه رو انتخاب کن👇"
+async def show_plans(update: Update, context: ContextTypes.DEFAULT_TYPE, uid:int):
+    pls = await run_db(db_catalog)
+    if not pls:
+        await update.effective_message.reply_text("فعلاً پلنی ثبت نشده 🙏", reply_markup=kb_main(uid, user_is_admin(uid)))
+        return
+    lines=["🛍 لیست پلن‌ها:\n"]
+    for p, stock in pls:
+        lines.append(
+            f"• {p.name}\n"
+            f"⏳ مدت: {p.days} روز | 🧰 حجم: {p.volume_gb}GB | 💵 قیمت: {money(p.price)} | 📦 موجودی مخزن: {stock}\n"
+            f"/plan_{p.id}\n"
         )
-        set_step(uid, Step.PLAN_DETAIL)
-        await update.effective_message.reply_text(txt, reply_markup=kb_buy_flow())
-    finally: db.close()
+    await update.effective_message.reply_text("\n".join(lines))
+    set_step(uid, Step.SELECT_PLAN)
 
-async def handle_buy_flow_text(update: Update, context: ContextTypes.DEFAULT_TYPE, u:User, text:str):
-    s = st(u.id); pid = s.get("selected_plan_id")
-    if not pid:
-        await update.effective_message.reply_text("اول یک پلن انتخاب کن 🙏"); return
-    db=SessionLocal()
-    try:
-        plan = db.query(Plan).get(pid)
-        if not plan:
-            await update.effective_message.reply_text("پلن پیدا نشد 🙏"); return
-
-        # اعمال کد تخفیف
-        if text == "🧾 اعمال کد تخفیف":
-            set_step(u.id, Step.APPLY_DISCOUNT)
-            await update.effective_message.reply_text("کد تخفیف رو بفرست (مثلاً OFF30) 🎟️", reply_markup=kb_back_cancel())
-            return
+def db_plan_with_stock(db, plan_id:int) -> Tuple[Optional[Plan], int]:
+    p = db.query(Plan).get(plan_id)
+    return p, (p.stock if p else 0)
 
-        if st(u.id)["step"] == Step.APPLY_DISCOUNT and re.match(r"^[A-Za-z0-9_-]+$", text):
-            d = discount_valid(db, text)
-            if not d:
-                await update.effective_message.reply_text("کد تخفیف نامعتبره یا منقضی شده 😅", reply_markup=kb_buy_flow()); 
-                set_step(u.id, Step.PLAN_DETAIL)
-                return
-            final, disc = apply_discount(plan.price, d.percent)
-            s["applied_discount"]={"code":d.code,"percent":d.percent,"final":final,"disc":disc}
-            await update.effective_message.reply_text(
-                f"کد {d.code} اعمال شد ✅\n"
-                f"تخفیف: {money(disc)}\n"
-                f"مبلغ جدید: {money(final)}",
-                reply_markup=kb_buy_flow()
-            )
-            set_step(u.id, Step.PLAN_DETAIL)
-            return
+async def show_plan_detail(update: Update, context: ContextTypes.DEFAULT_TYPE, uid:int, plan_id:int):
+    p, stock = await run_db(db_plan_with_stock, plan_id)
+    if not p:
+        await update.effective_message.reply_text("پلن پیدا نشد 🙏"); return
+    s = st(uid)
+    s["selected_plan_id"]=plan_id
+    s["applied_discount"]=None
+    txt = (
+        f"🔘 {p.name}\n\n"
+        f"⏳ مدت: {p.days} روز\n🧰 حجم: {p.volume_gb}GB\n"
+        f"💵 قیمت: {money(p.price)}\n"
+        f"📦 موجودی مخزن: {stock}\n\n"
+        f"یه گزینه رو انتخاب کن👇"
+    )
+    set_step(uid, Step.PLAN_DETAIL)
+    await update.effective_message.reply_text(txt, reply_markup=kb_buy_flow())
 
-        # پرداخت با کیف پول
-        if text == "💼 پرداخت با کیف پول":
-            price = s.get("applied_discount",{}).get("final", plan.price)
-            if (u.wallet or 0.0) >= price:
-                # خرید مستقیم
-                await perform_purchase_deliver(update, context, u.id, plan.id, price, s.get("applied_discount",{}).get("code"))
-                clear_step(u.id)
-                return
-            else:
-                diff = price - (u.wallet or 0.0)
-                set_step(u.id, Step.PAY_WALLET_CONFIRM)
-                await update.effective_message.reply_text(
-                    f"کیف پولت {money(u.wallet)} ـه و قیمت این پلن {money(price)}.\n"
-                    f"ما‌به‌تفاوت میشه {money(diff)} 💳\n\n"
-                    f"اگه اوکی هست کارت‌به‌کارت کن به این شماره:\n"
-                    f"🔢 {get_card_number()}\n"
-                    f"و بعد «رسید» رو بفرست. 🙏",
-                    reply_markup=ReplyKeyboardMarkup([["📤 ارسال رسید ما‌به‌تفاوت"], ["🔙 بازگشت"]], resize_keyboard=True)
-                )
-                s["diff_amount"]=diff
-                return
-
-        if st(u.id)["step"] == Step.PAY_WALLET_CONFIRM and text == "📤 ارسال رسید ما‌به‌تفاوت":
-            set_step(u.id, Step.PAY_DIFF_WAIT_RECEIPT)
-            await update.effective_message.reply_text("عکس رسید یا متن رسید کارت‌به‌کارت ما‌به‌تفاوت رو بفرست 📸🧾", reply_markup=kb_back_cancel())
-            return
+BUY_STEPS = (Step.PLAN_DETAIL, Step.APPLY_DISCOUNT, Step.PAY_MENU)
 
-        # کارت به کارت مستقیم خرید پلن
-        if text == "🏦 کارت به کارت":
-            set_step(u.id, Step.PAY_CARD_WAIT_RECEIPT)
-            price = s.get("applied_discount",{}).get("final", plan.price)
-            await update.effective_message.reply_text(
-                f"عالی! لطفاً مبلغ {money(price)} رو کارت‌به‌کارت کن به:\n"
-                f"🔢 {get_card_number()}\n\n"
-                f"و بعد رسید رو همینجا بفرست (عکس یا متن) 🙏",
-                reply_markup=kb_back_cancel()
-            )
-            s["card_price"]=price
-            return
+async def selected_plan(update: Update, u: User) -> Optional[Plan]:
+    pid = st(u.id).get("selected_plan_id")
+    if not pid:
+        await update.effective_message.reply_text("اول یک پلن انتخاب کن 🙏"); return None
+    plan = await run_db(lambda db: db.query(Plan).get(pid))
+    if not plan:
+        await update.effective_message.reply_text("پلن پیدا نشد 🙏"); return None
+    return plan
+
+# اعمال کد تخفیف
+@router.button("🧾 اعمال کد تخفیف", *BUY_STEPS)
+async def buy_discount_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE, u: User, text: str):
+    if not await selected_plan(update, u): return
+    set_step(u.id, Step.APPLY_DISCOUNT)
+    await update.effective_message.reply_text("کد تخفیف رو بفرست (مثلاً OFF30) 🎟️", reply_markup=kb_back_cancel())
 
-        # اگر چیز دیگری نوشت
-        await update.effective_message.reply_text("از گزینه‌های زیر انتخاب کن لطفاً 🙏", reply_markup=kb_buy_flow())
-    finally:
-        db.close()
+@router.input(Step.APPLY_DISCOUNT)
+async def buy_discount_code(update: Update, context: ContextTypes.DEFAULT_TYPE, u: User, text: str):
+    plan = await selected_plan(update, u)
+    if not plan: return
+    if not re.match(r"^[A-Za-z0-9_-]+$", text):
+        await update.effective_message.reply_text("از گزینه‌های زیر انتخاب کن لطفاً 🙏", reply_markup=kb_buy_flow()); return
+    d = await run_db(discount_valid, text)
+    if not d:
+        await update.effective_message.reply_text("کد تخفیف نامعتبره یا منقضی شده 😅", reply_markup=kb_buy_flow()); 
+        set_step(u.id, Step.PLAN_DETAIL)
+        return
+    final, disc = apply_discount(plan.price, d.percent)
+    st(u.id)["applied_discount"]={"code":d.code,"percent":d.percent,"final":final,"disc":disc}
+    await update.effective_message.reply_text(
+        f"کد {d.code} اعمال شد ✅\n"
+        f"تخفیف: {money(disc)}\n"
+        f"مبلغ جدید: {money(final)}",
+        reply_markup=kb_buy_flow()
+    )
+    set_step(u.id, Step.PLAN_DETAIL)
+
+# پرداخت با کیف پول
+@router.button("💼 پرداخت با کیف پول", *BUY_STEPS)
+async def buy_pay_wallet(update: Update, context: ContextTypes.DEFAULT_TYPE, u: User, text: str):
+    plan = await selected_plan(update, u)
+    if not plan: return
+    s = st(u.id)
+    price = s.get("applied_discount",{}).get("final", plan.price)
+    if (u.wallet or 0.0) >= price:
+        # خرید مستقیم
+        await perform_purchase_deliver(update, context, u.id, plan.id, price, s.get("applied_discount",{}).get("code"))
+        clear_step(u.id)
+        return
+    diff = price - (u.wallet or 0.0)
+    set_step(u.id, Step.PAY_WALLET_CONFIRM)
+    await update.effective_message.reply_text(
+        f"کیف پولت {money(u.wallet)} ـه و قیمت این پلن {money(price)}.\n"
+        f"ما‌به‌تفاوت میشه {money(diff)} 💳\n\n"
+        f"اگه اوکی هست کارت‌به‌کارت کن به این شماره:\n"
+        f"🔢 {get_card_number()}\n"
+        f"و بعد «رسید» رو بفرست. 🙏",
+        reply_markup=kb_diff_receipt()
+    )
+    s["diff_amount"]=diff
+
+@router.button("📤 ارسال رسید ما‌به‌تفاوت", Step.PAY_WALLET_CONFIRM)
+async def buy_diff_receipt(update: Update, context: ContextTypes.DEFAULT_TYPE, u: User, text: str):
+    if not await selected_plan(update, u): return
+    set_step(u.id, Step.PAY_DIFF_WAIT_RECEIPT)
+    await update.effective_message.reply_text("عکس رسید یا متن رسید کارت‌به‌کارت ما‌به‌تفاوت رو بفرست 📸🧾", reply_markup=kb_back_cancel())
+
+# کارت به کارت مستقیم خرید پلن
+@router.button("🏦 کارت به کارت", *BUY_STEPS)
+async def buy_pay_card(update: Update, context: ContextTypes.DEFAULT_TYPE, u: User, text: str):
+    plan = await selected_plan(update, u)
+    if not plan: return
+    set_step(u.id, Step.PAY_CARD_WAIT_RECEIPT)
+    price = st(u.id).get("applied_discount",{}).get("final", plan.price)
+    await update.effective_message.reply_text(
+        f"عالی! لطفاً مبلغ {money(price)} رو کارت‌به‌کارت کن به:\n"
+        f"🔢 {get_card_number()}\n\n"
+        f"و بعد رسید رو همینجا بفرست (عکس یا متن) 🙏",
+        reply_markup=kb_back_cancel()
+    )
+    st(u.id)["card_price"]=price
+
+# اگر چیز دیگری نوشت
+@router.input(Step.PLAN_DETAIL, Step.PAY_MENU)
+async def buy_other(update: Update, context: ContextTypes.DEFAULT_TYPE, u: User, text: str):
+    if not await selected_plan(update, u): return
+    await update.effective_message.reply_text("از گزینه‌های زیر انتخاب کن لطفاً 🙏", reply_markup=kb_buy_flow())
+
+def db_purchase(db, uid:int, plan_id:int, price_paid:float, disc_code:Optional[str]):
+    # کل خرید توی یک تراکنش؛ خروجی: "no_plan" | "empty" | Purchase
+    user = db.query(User).get(uid)
+    plan = db.query(Plan).get(plan_id)
+    if not plan:
+        return "no_plan"
+    stock_item = inventory.claim(db, plan_id)
+    if not stock_item:
+        return "empty"
+    # کسر از کیف پول در صورت خرید کیف پولی
+    if (user.wallet or 0.0) >= price_paid:
+        user.wallet = (user.wallet or 0.0) - price_paid
+    user.total_spent = (user.total_spent or 0.0) + price_paid
+
+    expire_at = now() + dt.timedelta(days=plan.days)
+    p = Purchase(
+        user_id=uid, plan_id=plan_id, created_at=now(), expire_at=expire_at,
+        price_paid=price_paid, discount_code=disc_code,
+        config_payload_id=stock_item.id, active=True,
+        delivered_type=stock_item.content_type,
+        delivered_text=stock_item.text_content,
+        delivered_photo_file_id=stock_item.photo_file_id
+    )
+    # به‌روزرسانی discount usage
+    if disc_code:
+        d = db.query(Discount).filter(Discount.code==disc_code).first()
+        if d:
+            d.used_count += 1
+            d.total_discount_toman += (plan.price - price_paid)
+    db.add(p)
+    sales_rollup.purchased(db, p, plan)
+    db.commit()
+    return p
 
 async def perform_purchase_deliver(update: Update, context: ContextTypes.DEFAULT_TYPE, uid:int, plan_id:int, price_paid:float, disc_code:Optional[str]):
-    db=SessionLocal()
-    try:
-        user = db.query(User).get(uid)
-        plan = db.query(Plan).get(plan_id)
-        if not plan:
-            await update.effective_message.reply_text("پلن یافت نشد 🙏"); return
-        stock_item = db.query(ConfigItem).filter(ConfigItem.plan_id==plan_id).order_by(ConfigItem.id.asc()).first()
-        if not stock_item:
-            await update.effective_message.reply_text("مخزن این پلن فعلاً خالیه 😅 بزودی شارژ میشه.", reply_markup=kb_main(uid, user_is_admin(uid)))
-            return
-        # کسر از کیف پول در صورت خرید کیف پولی
-        if (user.wallet or 0.0) >= price_paid:
-            user.wallet = (user.wallet or 0.0) - price_paid
-        user.total_spent = (user.total_spent or 0.0) + price_paid
-
-        expire_at = now() + dt.timedelta(days=plan.days)
-        p = Purchase(
-            user_id=uid, plan_id=plan_id, created_at=now(), expire_at=expire_at,
-            price_paid=price_paid, discount_code=disc_code,
-            config_payload_id=stock_item.id, active=True,
-            delivered_type=stock_item.content_type,
-            delivered_text=stock_item.text_content,
-            delivered_photo_file_id=stock_item.photo_file_id
-        )
-        # حذف از مخزن
-        db.delete(stock_item)
-        # به‌روزرسانی discount usage
-        if disc_code:
-            d = db.query(Discount).filter(Discount.code==disc_code).first()
-            if d:
-                d.used_count += 1
-                d.total_discount_toman += (plan.price - price_paid)
-        db.add(p); db.commit()
-
-        # ارسال به کاربر
-        if p.delivered_type == "photo" and p.delivered_photo_file_id:
-            await update.effective_message.reply_photo(
-                p.delivered_photo_file_id,
-                caption=(
-                    f"تبریک! خریدت موفق بود 🎉\n"
-                    f"کانفیگ برات ارسال شد. (قابل کپی)\n"
-                    f"⏳ انقضا: {p.expire_at.date()}"
-                ),
-                reply_markup=kb_main(uid, user_is_admin(uid))
-            )
-        else:
-            await update.effective_message.reply_text(
+    p = await run_db(db_purchase, uid, plan_id, price_paid, disc_code)
+    if p == "no_plan":
+        await update.effective_message.reply_text("پلن یافت نشد 🙏"); return
+    if p == "empty":
+        await update.effective_message.reply_text("مخزن این پلن فعلاً خالیه 😅 بزودی شارژ میشه.", reply_markup=kb_main(uid, user_is_admin(uid)))
+        return
+    stats_cache.invalidate()
+    expiry_scheduler.wake()  # موعد یادآوری این خرید ممکنه زودتر از خواب فعلی باشه
+
+    # ارسال به کاربر
+    if p.delivered_type == "photo" and p.delivered_photo_file_id:
+        await update.effective_message.reply_photo(
+            p.delivered_photo_file_id,
+            caption=(
                 f"تبریک! خریدت موفق بود 🎉\n"
-                f"اینم کانفیگ:\n\n"
-                f"{p.delivered_text or '—'}\n\n"
-                f"⏳ انقضا: {p.expire_at.date()}",
-                reply_markup=kb_main(uid, user_is_admin(uid))
-            )
-    finally:
-        db.close()
+                f"کانفیگ برات ارسال شد. (قابل کپی)\n"
+                f"⏳ انقضا: {p.expire_at.date()}"
+            ),
+            reply_markup=kb_main(uid, user_is_admin(uid))
+        )
+    else:
+        await update.effective_message.reply_text(
+            f"تبریک! خریدت موفق بود 🎉\n"
+            f"اینم کانفیگ:\n\n"
+            f"{p.delivered_text or '—'}\n\n"
+            f"⏳ انقضا: {p.expire_at.date()}",
+            reply_markup=kb_main(uid, user_is_admin(uid))
+        )
 
 # ==============================
 # Wallet & Receipts
 # ==============================
 async def wallet_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, uid:int):
-    db=SessionLocal()
-    try:
-        u=db.query(User).get(uid)
-        await update.effective_message.reply_text(
-            f"💳 کیف پول تو: {money(u.wallet)}\n\n"
-            f"اگه میخوای شارژ کنی، کارت‌به‌کارت کن به:\n"
-            f"🔢 {get_card_number()}\n"
-            f"و بعد رسید رو بفرست تا تایید کنیم ✨",
-            reply_markup=ReplyKeyboardMarkup([["📤 ارسال رسید شارژ"], ["🔙 بازگشت"]], resize_keyboard=True)
-        )
-        set_step(uid, Step.TOPUP_WAIT_RECEIPT)
-    finally: db.close()
+    u = await run_db(lambda db: db.query(User).get(uid))
+    await update.effective_message.reply_text(
+        f"💳 کیف پول تو: {money(u.wallet)}\n\n"
+        f"اگه میخوای شارژ کنی، کارت‌به‌کارت کن به:\n"
+        f"🔢 {get_card_number()}\n"
+        f"و بعد رسید رو بفرست تا تایید کنیم ✨",
+        reply_markup=kb_wallet()
+    )
+    set_step(uid, Step.TOPUP_WAIT_RECEIPT)
+
+def db_my_configs(db, uid:int) -> List[Tuple[Purchase, str]]:
+    items = db.query(Purchase).filter(Purchase.user_id==uid, Purchase.active==True).order_by(Purchase.created_at.desc()).all()
+    return [(p, p.plan.name) for p in items]
 
 async def my_configs(update: Update, context: ContextTypes.DEFAULT_TYPE, uid:int):
-    db=SessionLocal()
-    try:
-        items = db.query(Purchase).filter(Purchase.user_id==uid, Purchase.active==True).order_by(Purchase.created_at.desc()).all()
-        if not items:
-            await update.effective_message.reply_text("فعلاً کانفیگ فعالی نداری 🙂", reply_markup=kb_main(uid, user_is_admin(uid)))
-            return
-        for p in items:
-            remain = (p.expire_at - now()).days
-            base = f"🧾 {p.plan.name}\n⏳ انقضا: {p.expire_at.date()} (حدود {max(0, remain)} روز)"
-            if p.delivered_type=="photo" and p.delivered_photo_file_id:
-                await update.effective_message.reply_photo(p.delivered_photo_file_id, caption=base)
-            else:
-                await update.effective_message.reply_text(base + f"\n\n{p.delivered_text or ''}")
-    finally: db.close()
+    items = await run_db(db_my_configs, uid)
+    if not items:
+        await update.effective_message.reply_text("فعلاً کانفیگ فعالی نداری 🙂", reply_markup=kb_main(uid, user_is_admin(uid)))
+        return
+    for p, plan_name in items:
+        remain = (p.expire_at - now()).days
+        base = f"🧾 {plan_name}\n⏳ انقضا: {p.expire_at.date()} (حدود {max(0, remain)} روز)"
+        if p.delivered_type=="photo" and p.delivered_photo_file_id:
+            await update.effective_message.reply_photo(p.delivered_photo_file_id, caption=base)
+        else:
+            await update.effective_message.reply_text(base + f"\n\n{p.delivered_text or ''}")
+
+def db_create_receipt(db, uid:int, kind:ReceiptKind, text:str=None, photo_file_id:str=None, plan_id:int=None, price_due:float=0.0) -> int:
+    r=Receipt(
+        user_id=uid, kind=kind.value, text=text, photo_file_id=photo_file_id,
+        plan_id=plan_id, price_due=price_due
+    )
+    db.add(r); db.commit()
+    return r.id
 
 async def create_receipt(uid:int, kind:ReceiptKind, text:str=None, photo_file_id:str=None, plan_id:int=None, price_due:float=0.0) -> int:
-    db=SessionLocal()
-    try:
-        r=Receipt(
-            user_id=uid, kind=kind.value, text=text, photo_file_id=photo_file_id,
-            plan_id=plan_id, price_due=price_due
-        )
-        db.add(r); db.commit()
-        return r.id
-    finally: db.close()
+    return await run_db(db_create_receipt, uid, kind, text, photo_file_id, plan_id, price_due)
+
+RECEIPT_KIND_FA = {"TOPUP":"شارژ کیف پول","DIFF":"پرداخت ما‌به‌تفاوت","CARD":"کارت‌به‌کارت خرید پلن"}
+
+def db_receipt_notice(db, rid:int) -> Tuple[Receipt, str, List[int]]:
+    r=db.query(Receipt).get(rid); u=db.query(User).get(r.user_id)
+    txt = (
+        f"📥 رسید جدید ({RECEIPT_KIND_FA.get(r.kind,r.kind)})\n"
+        f"کاربر: {u.first_name or ''} @{u.username or '-'} ({u.id})\n"
+        f"زمان: {r.created_at}\n"
+        f"پلن: {db.query(Plan).get(r.plan_id).name if r.plan_id else '-'}\n"
+        f"مبلغ مورد نیاز/فاکتور: {money(r.price_due)}\n"
+        f"وضعیت: {r.status}\n"
+        f"نوع رسید: {'عکس' if r.photo_file_id else 'متن'}"
+    )
+    return r, txt, sorted(admin_cache.ids)
 
 async def notify_admins_new_receipt(context: ContextTypes.DEFAULT_TYPE, rid:int):
-    db=SessionLocal()
-    try:
-        r=db.query(Receipt).get(rid); u=db.query(User).get(r.user_id)
-        kind_map={"TOPUP":"شارژ کیف پول","DIFF":"پرداخت ما‌به‌تفاوت","CARD":"کارت‌به‌کارت خرید پلن"}
-        txt = (
-            f"📥 رسید جدید ({kind_map.get(r.kind,r.kind)})\n"
-            f"کاربر: {u.first_name or ''} @{u.username or '-'} ({u.id})\n"
-            f"زمان: {r.created_at}\n"
-            f"پلن: {db.query(Plan).get(r.plan_id).name if r.plan_id else '-'}\n"
-            f"مبلغ مورد نیاز/فاکتور: {money(r.price_due)}\n"
-            f"وضعیت: {r.status}\n"
-            f"نوع رسید: {'عکس' if r.photo_file_id else 'متن'}"
-        )
-        for admin in db.query(Admin).all():
-            try:
-                if r.photo_file_id:
-                    await context.bot.send_photo(chat_id=admin.user_id, photo=r.photo_file_id, caption=txt, reply_markup=kb_admin_receipt_actions(r.id, ReceiptKind(r.kind)))
-                else:
-                    await context.bot.send_message(chat_id=admin.user_id, text=f"{txt}\n\nمتن:\n{r.text or '-'}", reply_markup=kb_admin_receipt_actions(r.id, ReceiptKind(r.kind)))
-            except: pass
-    finally: db.close()
+    r, txt, admin_ids = await run_db(db_receipt_notice, rid)
+    for admin_id in admin_ids:
+        try:
+            if r.photo_file_id:
+                await context.bot.send_photo(chat_id=admin_id, photo=r.photo_file_id, caption=txt, reply_markup=kb_admin_receipt_actions(r.id, ReceiptKind(r.kind)))
+            else:
+                await context.bot.send_message(chat_id=admin_id, text=f"{txt}\n\nمتن:\n{r.text or '-'}", reply_markup=kb_admin_receipt_actions(r.id, ReceiptKind(r.kind)))
+        except: pass
 
 # ==============================
 # Tickets
@@ -1052,14 +2381,11 @@ async def ticket_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, uid:in
     await update.effective_message.reply_text("بخش تیکت 🎟️", reply_markup=kb_ticket_menu())
 
 async def ticket_history(update: Update, context: ContextTypes.DEFAULT_TYPE, uid:int):
-    db=SessionLocal()
-    try:
-        tks=db.query(Ticket).filter(Ticket.user_id==uid).order_by(Ticket.created_at.desc()).all()
-        if not tks:
-            await update.effective_message.reply_text("هنوز تیکتی نساختی 🙂", reply_markup=kb_ticket_menu()); return
-        for t in tks:
-            await update.effective_message.reply_text(f"تیکت #{t.id} — {t.status}\nموضوع: {t.subject or '-'}\nتاریخ: {t.created_at}")
-    finally: db.close()
+    tks = await run_db(lambda db: db.query(Ticket).filter(Ticket.user_id==uid).order_by(Ticket.created_at.desc()).all())
+    if not tks:
+        await update.effective_message.reply_text("هنوز تیکتی نساختی 🙂", reply_markup=kb_ticket_menu()); return
+    for t in tks:
+        await update.effective_message.reply_text(f"تیکت #{t.id} — {t.status}\nموضوع: {t.subject or '-'}\nتاریخ: {t.created_at}")
 
 async def ticket_new(update: Update, context: ContextTypes.DEFAULT_TYPE, uid:int):
     set_step(uid, Step.TICKET_ENTER_SUBJECT)
@@ -1068,106 +2394,170 @@ async def ticket_new(update: Update, context: ContextTypes.DEFAULT_TYPE, uid:int
 # ==============================
 # Stats
 # ==============================
-async def stats_menu_user(update: Update, context: ContextTypes.DEFAULT_TYPE, uid:int):
-    s7 = get_stats_since(7)
-    s30 = get_stats_since(30)
-    sall = get_stats_all()
-    msg = (
+STATS_CACHE_TTL = float(os.getenv("STATS_CACHE_TTL", "30"))
+
+class RenderCache:
+    # متن رندرشده‌ی آمار با کلید (view, epoch). epoch با ریست آمار، خرید جدید و انقضا زیاد میشه،
+    # پس invalidate یعنی فقط epoch++ و کلیدهای قدیمی دیگه خونده نمیشن.
+    # single-flight: اگه چند نفر همزمان بزنن، فقط اولی می‌سازه و بقیه منتظر همون future می‌مونن.
+    # پروسه‌های دیگه حداکثر به اندازه‌ی TTL عقب‌ان.
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.epoch = 0
+        self.entries: Dict[Tuple[str, int], Tuple[float, object]] = {}
+        self.inflight: Dict[Tuple[str, int], asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def invalidate(self):
+        self.epoch += 1
+        self.entries.clear()
+
+    async def get(self, view: str, build):
+        while True:
+            key = (view, self.epoch)
+            hit = self.entries.get(key)
+            if hit and hit[0] > time.monotonic():
+                self.hits += 1
+                return hit[1]
+            fut = self.inflight.get(key)
+            if fut is None:
+                break
+            self.coalesced += 1
+            try:
+                return await asyncio.shield(fut)
+            except asyncio.CancelledError:
+                if not fut.cancelled():
+                    raise  # خود این منتظر cancel شده
+                # سازنده cancel شد؛ از اول، یکی از منتظرها سازنده‌ی بعدی میشه
+        self.misses += 1
+        fut = self.inflight[key] = asyncio.get_running_loop().create_future()
+        try:
+            value = await build()
+        except Exception as e:
+            fut.set_exception(e)
+            fut.exception()  # اگه منتظری نداشت، warning «never retrieved» نده
+            raise
+        else:
+            if key[1] == self.epoch:  # وسط ساختن invalidate نشده باشه
+                self.entries[key] = (time.monotonic() + self.ttl, value)
+            fut.set_result(value)
+            return value
+        finally:
+            self.inflight.pop(key, None)
+            if not fut.done():
+                fut.cancel()  # CancelledError (BaseException) هم باید منتظرها رو آزاد کنه
+
+    def metrics(self) -> Dict:
+        return {"epoch": self.epoch, "entries": len(self.entries), "hits": self.hits,
+                "misses": self.misses, "coalesced": self.coalesced}
+
+stats_cache = RenderCache(STATS_CACHE_TTL)
+
+def db_user_stats(db):
+    t = now()
+    s = sales_summary(db, {"7": t - dt.timedelta(days=7), "30": t - dt.timedelta(days=30), "all": None})
+    return s["7"], s["30"], s["all"]
+
+async def render_user_stats() -> str:
+    s7, s30, sall = await run_db(db_user_stats)
+    return (
         "📊 آمار فروش (نمای کاربر):\n\n"
         f"۷ روز اخیر: فروش {money(s7[0])} | تعداد {s7[3]}\n"
         f"۳۰ روز اخیر: فروش {money(s30[0])} | تعداد {s30[3]}\n"
         f"کل: فروش {money(sall[0])} | تعداد {sall[3]}"
     )
+
+async def stats_menu_user(update: Update, context: ContextTypes.DEFAULT_TYPE, uid:int):
+    msg = await stats_cache.get("user", render_user_stats)
     await update.effective_message.reply_text(msg, reply_markup=kb_main(uid, user_is_admin(uid)))
 
+def db_admin_stats(db):
+    t = now()
+    since = last_reset_at(db)
+    s = sales_summary(db, {"7": t - dt.timedelta(days=7), "30": t - dt.timedelta(days=30), "reset": since})
+    return s["7"], s["30"], (*s["reset"], since or dt.datetime.min), top_buyers_since(db, since)
+
+async def render_admin_stats() -> str:
+    s7, s30, (sa, sb, sc, cnt, since), tb = await run_db(db_admin_stats)
+    lines = [
+        "📈 آمار فروش (ادمین):",
+        f"۷ روز: فروش {money(s7[0])} | هزینه {money(s7[1])} | سود {money(s7[2])} | تعداد {s7[3]}",
+        f"۳۰ روز: فروش {money(s30[0])} | هزینه {money(s30[1])} | سود {money(s30[2])} | تعداد {s30[3]}",
+        f"از ریست ({since.date()}): فروش {money(sa)} | هزینه {money(sb)} | سود {money(sc)} | تعداد {cnt}",
+        "\n👑 Top Buyers:"
+    ]
+    rank=1
+    for u, tot, c in tb:
+        lines.append(f"{rank}. {u.first_name or ''} @{u.username or '-'} — {money(tot)} ({c} خرید)")
+        rank+=1
+    lines.append("\nبرای ریست آمار، دستور /reset_stats را بزن (فقط ادمین).")
+    return "\n".join(lines)
+
 async def admin_stats_panel(update: Update, context: ContextTypes.DEFAULT_TYPE, uid:int):
-    db=SessionLocal()
-    try:
-        s7 = get_stats_since(7)
-        s30 = get_stats_since(30)
-        sa, sb, sc, cnt, since = get_stats_since_reset()
-        tb = top_buyers_since(db, since)
-        lines = [
-            "📈 آمار فروش (ادمین):",
-            f"۷ روز: فروش {money(s7[0])} | هزینه {money(s7[1])} | سود {money(s7[2])} | تعداد {s7[3]}",
-            f"۳۰ روز: فروش {money(s30[0])} | هزینه {money(s30[1])} | سود {money(s30[2])} | تعداد {s30[3]}",
-            f"از ریست ({since.date()}): فروش {money(sa)} | هزینه {money(sb)} | سود {money(sc)} | تعداد {cnt}",
-            "\n👑 Top Buyers:"
-        ]
-        rank=1
-        for u, tot, c in tb:
-            lines.append(f"{rank}. {u.first_name or ''} @{u.username or '-'} — {money(tot)} ({c} خرید)")
-            rank+=1
-        lines.append("\nبرای ریست آمار، دستور /reset_stats را بزن (فقط ادمین).")
-        await update.effective_message.reply_text("\n".join(lines), reply_markup=kb_admin_main())
-    finally: db.close()
+    msg = await stats_cache.get("admin", render_admin_stats)
+    await update.effective_message.reply_text(msg, reply_markup=kb_admin_main())
 
 # ==============================
 # Admin Panels
 # ==============================
 async def admin_manage_admins(update: Update, context: ContextTypes.DEFAULT_TYPE, uid:int):
-    db=SessionLocal()
-    try:
-        admins = [a.user_id for a in db.query(Admin).all()]
-        lines=["👤 مدیریت ادمین‌ها","ادمین‌های فعلی:"]
-        for a in admins:
-            lines.append(f"• {a} {'(پیش‌فرض)' if a in ADMIN_IDS else ''}")
-        lines.append("\nبرای افزودن: /add_admin <user_id>\nبرای حذف: /del_admin <user_id>")
-        await update.effective_message.reply_text("\n".join(lines), reply_markup=kb_admin_main())
-    finally: db.close()
+    admins = sorted(admin_cache.ids)
+    lines=["👤 مدیریت ادمین‌ها","ادمین‌های فعلی:"]
+    for a in admins:
+        lines.append(f"• {a} {'(پیش‌فرض)' if a in ADMIN_IDS else ''}")
+    lines.append("\nبرای افزودن: /add_admin <user_id>\nبرای حذف: /del_admin <user_id>")
+    await update.effective_message.reply_text("\n".join(lines), reply_markup=kb_admin_main())
+
+def db_pending_receipts(db) -> List[Tuple[Receipt, str]]:
+    rs=db.query(Receipt).filter(Receipt.status=="PENDING").order_by(Receipt.created_at.asc()).all()
+    out=[]
+    for r in rs:
+        u=db.query(User).get(r.user_id)
+        out.append((r, (
+            f"📥 رسید #{r.id} — {r.kind}\n"
+            f"کاربر: {u.first_name or ''} @{u.username or '-'} ({u.id})\n"
+            f"زمان: {r.created_at}\n"
+            f"پلن: {db.query(Plan).get(r.plan_id).name if r.plan_id else '-'}\n"
+            f"مبلغ مورد نیاز/فاکتور: {money(r.price_due)}\n"
+            f"وضعیت: {r.status}\n"
+            f"نوع رسید: {'عکس' if r.photo_file_id else 'متن'}"
+        )))
+    return out
 
 async def admin_list_pending_receipts(update: Update, context: ContextTypes.DEFAULT_TYPE, uid:int):
-    db=SessionLocal()
-    try:
-        rs=db.query(Receipt).filter(Receipt.status=="PENDING").order_by(Receipt.created_at.asc()).all()
-        if not rs:
-            await update.effective_message.reply_text("چیزی تو صف رسیدگی نیست ✅", reply_markup=kb_admin_main()); return
-        for r in rs:
-            u=db.query(User).get(r.user_id)
-            txt = (
-                f"📥 رسید #{r.id} — {r.kind}\n"
-                f"کاربر: {u.first_name or ''} @{u.username or '-'} ({u.id})\n"
-                f"زمان: {r.created_at}\n"
-                f"پلن: {db.query(Plan).get(r.plan_id).name if r.plan_id else '-'}\n"
-                f"مبلغ مورد نیاز/فاکتور: {money(r.price_due)}\n"
-                f"وضعیت: {r.status}\n"
-                f"نوع رسید: {'عکس' if r.photo_file_id else 'متن'}"
-            )
-            if r.photo_file_id:
-                await update.effective_message.reply_photo(r.photo_file_id, caption=txt, reply_markup=kb_admin_receipt_actions(r.id, ReceiptKind(r.kind)))
-            else:
-                await update.effective_message.reply_text(f"{txt}\n\nمتن:\n{r.text or '-'}", reply_markup=kb_admin_receipt_actions(r.id, ReceiptKind(r.kind)))
-    finally: db.close()
+    rs = await run_db(db_pending_receipts)
+    if not rs:
+        await update.effective_message.reply_text("چیزی تو صف رسیدگی نیست ✅", reply_markup=kb_admin_main()); return
+    for r, txt in rs:
+        if r.photo_file_id:
+            await update.effective_message.reply_photo(r.photo_file_id, caption=txt, reply_markup=kb_admin_receipt_actions(r.id, ReceiptKind(r.kind)))
+        else:
+            await update.effective_message.reply_text(f"{txt}\n\nمتن:\n{r.text or '-'}", reply_markup=kb_admin_receipt_actions(r.id, ReceiptKind(r.kind)))
 
 async def admin_discounts_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, uid:int):
-    db=SessionLocal()
-    try:
-        ds=db.query(Discount).order_by(Discount.id.desc()).all()
-        lines=["🏷️ کدهای تخفیف:"]
-        if not ds:
-            lines.append("فعلاً هیچ کدی ثبت نشده.")
-        else:
-            for d in ds:
-                lines.append(f"• {d.code} — {d.percent}% | استفاده: {d.used_count}/{d.max_uses or '∞'} | انقضا: {d.expires_at or 'بدون'} | جمع تخفیف: {money(d.total_discount_toman)}")
-        lines.append("\nساخت کد جدید: /new_discount")
-        await update.effective_message.reply_text("\n".join(lines), reply_markup=kb_admin_main())
-    finally: db.close()
+    ds = await run_db(lambda db: db.query(Discount).order_by(Discount.id.desc()).all())
+    lines=["🏷️ کدهای تخفیف:"]
+    if not ds:
+        lines.append("فعلاً هیچ کدی ثبت نشده.")
+    else:
+        for d in ds:
+            lines.append(f"• {d.code} — {d.percent}% | استفاده: {d.used_count}/{d.max_uses or '∞'} | انقضا: {d.expires_at or 'بدون'} | جمع تخفیف: {money(d.total_discount_toman)}")
+    lines.append("\nساخت کد جدید: /new_discount")
+    await update.effective_message.reply_text("\n".join(lines), reply_markup=kb_admin_main())
 
 async def admin_plans_and_repo(update: Update, context: ContextTypes.DEFAULT_TYPE, uid:int):
-    db=SessionLocal()
-    try:
-        pls = plans_as_rows(db)
-        if not pls:
-            await update.effective_message.reply_text("پلنی موجود نیست. /new_plan برای ساخت پلن.", reply_markup=kb_admin_main()); return
-        for p in pls:
-            stock=plan_stock(db, p.id)
-            await update.effective_message.reply_text(
-                f"🧩 {p.name}\n"
-                f"⏳ {p.days} روز | 🧰 {p.volume_gb}GB | 💵 {money(p.price)} | 📦 موجودی مخزن: {stock}",
-                reply_markup=kb_repo_plan_actions(p.id)
-            )
-        await update.effective_message.reply_text("ساخت پلن جدید: /new_plan", reply_markup=kb_admin_main())
-    finally: db.close()
+    pls = await run_db(db_catalog)
+    if not pls:
+        await update.effective_message.reply_text("پلنی موجود نیست. /new_plan برای ساخت پلن.", reply_markup=kb_admin_main()); return
+    for p, stock in pls:
+        await update.effective_message.reply_text(
+            f"🧩 {p.name}\n"
+            f"⏳ {p.days} روز | 🧰 {p.volume_gb}GB | 💵 {money(p.price)} | 📦 موجودی مخزن: {stock}",
+            reply_markup=kb_repo_plan_actions(p.id)
+        )
+    await update.effective_message.reply_text("ساخت پلن جدید: /new_plan", reply_markup=kb_admin_main())
 
 # ==============================
 # Commands (ادمین)
@@ -1187,17 +2577,10 @@ async def cmd_add_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if uid in ADMIN_IDS:
         await update.effective_message.reply_text("ادمین پیش‌فرض رو نمی‌تونی اضافه/حذف کنی؛ خودش ادمینه.")
         return
-    db=SessionLocal()
-    try:
-        if db.query(Admin).get(uid):
-            await update.effective_message.reply_text("قبلاً ادمین شده.")
-        else:
-            db.add(Admin(user_id=uid)); db.commit()
-            usr=db.query(User).get(uid)
-            if usr:
-                usr.is_admin=True; db.commit()
-            await update.effective_message.reply_text("ادمین افزوده شد ✅")
-    finally: db.close()
+    if not await run_db(admin_cache.add, uid):
+        await update.effective_message.reply_text("قبلاً ادمین شده.")
+    else:
+        await update.effective_message.reply_text("ادمین افزوده شد ✅")
 
 async def cmd_del_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     u = await ensure_user(update, context)
@@ -1212,18 +2595,10 @@ async def cmd_del_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if uid in ADMIN_IDS:
         await update.effective_message.reply_text("❌ حذف ادمین پیش‌فرض مجاز نیست.")
         return
-    db=SessionLocal()
-    try:
-        a=db.query(Admin).get(uid)
-        if not a:
-            await update.effective_message.reply_text("ادمین نبود.")
-        else:
-            db.delete(a); db.commit()
-            usr=db.query(User).get(uid)
-            if usr:
-                usr.is_admin=False; db.commit()
-            await update.effective_message.reply_text("ادمین حذف شد ✅")
-    finally: db.close()
+    if not await run_db(admin_cache.remove, uid):
+        await update.effective_message.reply_text("ادمین نبود.")
+    else:
+        await update.effective_message.reply_text("ادمین حذف شد ✅")
 
 async def cmd_new_discount(update: Update, context: ContextTypes.DEFAULT_TYPE):
     u=await ensure_user(update, context)
@@ -1237,10 +2612,32 @@ async def cmd_new_plan(update: Update, context: ContextTypes.DEFAULT_TYPE):
     set_step(u.id, Step.ADMIN_PLAN_NEW_NAME)
     await update.effective_message.reply_text("اسم پلن رو بفرست ✍️", reply_markup=kb_back_cancel())
 
+async def cmd_top_buyers(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # /top_buyers [N] [days] [plan_id]   — days=0 یعنی از اول
+    u=await ensure_user(update, context)
+    if not user_is_admin(u.id): return
+    try:
+        args = [int(a) for a in (context.args or [])]
+    except ValueError:
+        await update.effective_message.reply_text("استفاده: /top_buyers [تعداد] [روز] [plan_id]")
+        return
+    n = args[0] if len(args) > 0 else settings.get("top_buyers_limit")
+    days = args[1] if len(args) > 1 else 30
+    pid = args[2] if len(args) > 2 else None
+    since = now() - dt.timedelta(days=days) if days > 0 else None
+    rows = await run_db(top_buyers, max(1, min(n, 50)), since=since, plan_id=pid)
+    lines = [f"👑 Top Buyers — {'کل' if not since else f'{days} روز اخیر'}{f' | پلن {pid}' if pid else ''}:"]
+    for rank, (b, tot, c) in enumerate(rows, 1):
+        lines.append(f"{rank}. {b.first_name or ''} @{b.username or '-'} ({b.id}) — {money(tot)} ({c} خرید)")
+    if not rows:
+        lines.append("خریدی در این بازه نیست.")
+    await update.effective_message.reply_text("\n".join(lines), reply_markup=kb_admin_main())
+
 async def cmd_reset_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     u=await ensure_user(update, context)
     if not user_is_admin(u.id): return
-    reset_stats()
+    await run_db(reset_stats)
+    stats_cache.invalidate()
     await update.effective_message.reply_text("آمار ریست شد ✅", reply_markup=kb_admin_main())
 
 # ==============================
@@ -1251,92 +2648,114 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     data = q.data or ""
     await q.answer()
     u = await ensure_user(update, context)
-    if data.startswith("rc_rej:"):
-        rid=int(data.split(":")[1])
-        await admin_receipt_reject(update, context, u.id, rid)
-        return
-    if data.startswith("rc_ok_amt:"):
-        rid=int(data.split(":")[1])
-        await admin_receipt_ok_amount(update, context, u.id, rid)
-        return
-    if data.startswith("rc_ok:"):
-        rid=int(data.split(":")[1])
-        await admin_receipt_ok(update, context, u.id, rid)
-        return
-    if data.startswith("rp_add_text:"):
-        pid=int(data.split(":")[1])
-        set_step(u.id, Step.ADMIN_REPO_ADD_TEXT); st(u.id)["repo_plan_id"]=pid
-        await q.message.reply_text("متن کانفیگ رو بفرست (هر پیام = یک کانفیگ). برای پایان روی «✅ اتمام» بزن.", reply_markup=kb_repo_bulk_finish()); 
+    fn, arg = router.match_callback(data, user_is_admin(u.id))
+    if fn is None:
+        router.unmatched += 1
         return
-    if data=="rp_bulk_done":
-        clear_step(u.id)
-        await q.message.reply_text("افزودن پایان یافت ✅", reply_markup=kb_admin_main()); return
-    if data.startswith("rp_add_photo:"):
-        pid=int(data.split(":")[1])
-        set_step(u.id, Step.ADMIN_REPO_ADD_PHOTO); st(u.id)["repo_plan_id"]=pid
-        await q.message.reply_text("عکس کانفیگ رو بفرست (هر عکس = یک کانفیگ). برای پایان روی «✅ اتمام» بزن.", reply_markup=kb_repo_bulk_finish()); 
-        return
-    if data.startswith("rp_view:"):
-        pid=int(data.split(":")[1]); await repo_view(update, context, pid); return
-    if data.startswith("rp_clear:"):
-        pid=int(data.split(":")[1]); await repo_clear(update, context, pid); return
+    router.routed += 1
+    await fn(update, context, u, arg)
+
+# کیبوردهای اینلاین رسید/مخزن/اعلان فقط برای ادمین فرستاده میشن؛ callback_data جعلی از بقیه نادیده گرفته میشه
+@router.callback("rc_rej", admin=True)
+async def cb_receipt_reject(update: Update, context: ContextTypes.DEFAULT_TYPE, u: User, arg: str):
+    await admin_receipt_reject(update, context, u.id, int(arg))
+
+@router.callback("rc_ok_amt", admin=True)
+async def cb_receipt_ok_amount(update: Update, context: ContextTypes.DEFAULT_TYPE, u: User, arg: str):
+    await admin_receipt_ok_amount(update, context, u.id, int(arg))
+
+@router.callback("rc_ok", admin=True)
+async def cb_receipt_ok(update: Update, context: ContextTypes.DEFAULT_TYPE, u: User, arg: str):
+    await admin_receipt_ok(update, context, u.id, int(arg))
+
+@router.callback("rp_add_text", admin=True)
+async def cb_repo_add_text(update: Update, context: ContextTypes.DEFAULT_TYPE, u: User, arg: str):
+    set_step(u.id, Step.ADMIN_REPO_ADD_TEXT); st(u.id)["repo_plan_id"]=int(arg)
+    await update.callback_query.message.reply_text("متن کانفیگ رو بفرست (هر پیام = یک کانفیگ). برای پایان روی «✅ اتمام» بزن.", reply_markup=kb_repo_bulk_finish())
+
+@router.callback("rp_add_photo", admin=True)
+async def cb_repo_add_photo(update: Update, context: ContextTypes.DEFAULT_TYPE, u: User, arg: str):
+    set_step(u.id, Step.ADMIN_REPO_ADD_PHOTO); st(u.id)["repo_plan_id"]=int(arg)
+    await update.callback_query.message.reply_text("عکس کانفیگ رو بفرست (هر عکس = یک کانفیگ). برای پایان روی «✅ اتمام» بزن.", reply_markup=kb_repo_bulk_finish())
+
+@router.callback("rp_bulk_done", admin=True)
+async def cb_repo_done(update: Update, context: ContextTypes.DEFAULT_TYPE, u: User, arg: str):
+    clear_step(u.id)
+    await update.callback_query.message.reply_text("افزودن پایان یافت ✅", reply_markup=kb_admin_main())
+
+@router.callback("rp_view", admin=True)
+async def cb_repo_view(update: Update, context: ContextTypes.DEFAULT_TYPE, u: User, arg: str):
+    await repo_view(update, context, int(arg))
+
+@router.callback("rp_clear", admin=True)
+async def cb_repo_clear(update: Update, context: ContextTypes.DEFAULT_TYPE, u: User, arg: str):
+    await repo_clear(update, context, int(arg))
+
+def cb_broadcast(action: str):
+    async def handler(update: Update, context: ContextTypes.DEFAULT_TYPE, u: User, arg: str):
+        await broadcasts.control(context.bot, int(arg), action)
+    return handler
+
+for _action in ("pause", "resume", "cancel"):
+    router.callback(f"bc_{_action}", admin=True)(cb_broadcast(_action))
+
+def db_review_receipt(db, rid:int, admin_id:int, status:str, kinds:Tuple[str,...], amount:float=None):
+    # فقط رسید PENDING تغییر می‌کنه (شرط توی خود UPDATE)، پس دو ادمین همزمان یک رسید رو دوبار تایید نمی‌کنن.
+    # خروجی: (None, None) رسید نیست/بررسی شده | (r, False) نوعش نمی‌خوره | (r, True) انجام شد
+    r=db.query(Receipt).get(rid)
+    if not r or r.status!="PENDING": return None, None
+    if r.kind not in kinds: return r, False
+    values = {"status":status, "reviewed_at":now(), "admin_id":admin_id}
+    if amount is not None:
+        values["amount_approved"] = amount
+    n = db.query(Receipt).filter(Receipt.id==rid, Receipt.status=="PENDING").update(values, synchronize_session=False)
+    if n and status=="APPROVED" and r.kind=="TOPUP":
+        uu=db.query(User).get(r.user_id)
+        uu.wallet = max(0.0, (uu.wallet or 0.0) + amount)
+        r.user_wallet = uu.wallet
+    db.commit()
+    return (r, True) if n else (None, None)
 
 async def admin_receipt_reject(update: Update, context: ContextTypes.DEFAULT_TYPE, admin_id:int, rid:int):
-    db=SessionLocal()
+    r, ok = await run_db(db_review_receipt, rid, admin_id, "REJECTED", ("TOPUP","DIFF","CARD"))
+    if not ok: return
     try:
-        r=db.query(Receipt).get(rid)
-        if not r or r.status!="PENDING": return
-        r.status="REJECTED"; r.reviewed_at=now(); r.admin_id=admin_id
-        db.commit()
-        try:
-            await context.bot.send_message(chat_id=r.user_id, text="😕 رسیدت رد شد. در صورت ابهام با پشتیبانی در ارتباط باش. 🙏")
-        except: pass
-        await update.effective_message.reply_text("رد شد ✅ (کاربر مطلع شد)")
-    finally: db.close()
+        await context.bot.send_message(chat_id=r.user_id, text="😕 رسیدت رد شد. در صورت ابهام با پشتیبانی در ارتباط باش. 🙏")
+    except: pass
+    await update.effective_message.reply_text("رد شد ✅ (کاربر مطلع شد)")
 
 async def admin_receipt_ok(update: Update, context: ContextTypes.DEFAULT_TYPE, admin_id:int, rid:int):
     # برای CARD (خرید مستقیم) — بدون ورود مبلغ
-    db=SessionLocal()
-    try:
-        r=db.query(Receipt).get(rid)
-        if not r or r.status!="PENDING": return
-        if r.kind!="CARD":
-            await update.effective_message.reply_text("این دکمه فقط برای کارت‌به‌کارت مستقیمه."); return
-        # تحویل پلن
-        await fake_update_for_delivery(context, r.user_id, r.plan_id, r.price_due)
-        r.status="APPROVED"; r.reviewed_at=now(); r.admin_id=admin_id
-        db.commit()
-        await update.effective_message.reply_text("تایید شد ✅ کانفیگ ارسال گردید.")
-    finally: db.close()
+    r, ok = await run_db(db_review_receipt, rid, admin_id, "APPROVED", ("CARD",))
+    if r is None: return
+    if not ok:
+        await update.effective_message.reply_text("این دکمه فقط برای کارت‌به‌کارت مستقیمه."); return
+    # تحویل پلن
+    await fake_update_for_delivery(context, r.user_id, r.plan_id, r.price_due)
+    await update.effective_message.reply_text("تایید شد ✅ کانفیگ ارسال گردید.")
 
 async def admin_receipt_ok_amount(update: Update, context: ContextTypes.DEFAULT_TYPE, admin_id:int, rid:int):
     # برای TOPUP و DIFF — با ورود مبلغ
-    db=SessionLocal()
-    try:
-        r=db.query(Receipt).get(rid)
-        if not r or r.status!="PENDING": return
-        if r.kind not in ["TOPUP","DIFF"]:
-            await update.effective_message.reply_text("این دکمه مخصوص شارژ کیف پول/ما‌به‌تفاوته."); return
-        # از ادمین می‌خواهیم مبلغ تاییدی را بفرستد — با next message (با state transient داخل memory برای ادمین)
-        s = st(admin_id)
-        s["enter_amount_for_receipt"]=rid
-        await update.effective_message.reply_text("مبلغ تایید شده را ارسال کنید (تومان):")
-    finally: db.close()
+    r = await run_db(lambda db: db.query(Receipt).get(rid))
+    if not r or r.status!="PENDING": return
+    if r.kind not in ["TOPUP","DIFF"]:
+        await update.effective_message.reply_text("این دکمه مخصوص شارژ کیف پول/ما‌به‌تفاوته."); return
+    # از ادمین می‌خواهیم مبلغ تاییدی را بفرستد — با next message (با state transient داخل memory برای ادمین)
+    s = st(admin_id)
+    s["enter_amount_for_receipt"]=rid
+    await update.effective_message.reply_text("مبلغ تایید شده را ارسال کنید (تومان):")
 
 async def repo_view(update: Update, context: ContextTypes.DEFAULT_TYPE, pid:int):
-    db=SessionLocal()
-    try:
-        p=db.query(Plan).get(pid); cnt=plan_stock(db, pid)
-        await update.effective_message.reply_text(f"📦 مخزن {p.name}\nموجودی: {cnt}")
-    finally: db.close()
+    p, cnt = await run_db(db_plan_with_stock, pid)
+    await update.effective_message.reply_text(f"📦 مخزن {p.name}\nموجودی: {cnt}")
 
 async def repo_clear(update: Update, context: ContextTypes.DEFAULT_TYPE, pid:int):
-    db=SessionLocal()
-    try:
-        db.query(ConfigItem).filter(ConfigItem.plan_id==pid).delete()
+    def clear_repo(db):
+        stock_counters.clear(db, pid)
         db.commit()
-        await update.effective_message.reply_text("مخزن پاک‌سازی شد ✅")
-    finally: db.close()
+        inventory.drop(pid)
+    await run_db(clear_repo)
+    await update.effective_message.reply_text("مخزن پاک‌سازی شد ✅")
 
 async def fake_update_for_delivery(context: ContextTypes.DEFAULT_TYPE, uid:int, plan_id:int, price:float):
     # برای رویدادهای تایید دستی کارت‌به‌کارت یا ما‌به‌تفاوت پس از تایید، تحویل داده شود.
@@ -1398,59 +2817,41 @@ async def on_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not pid:
             await update.effective_message.reply_text("ابتدا پلن را انتخاب کن.")
             return
-        db=SessionLocal()
-        try:
-            db.add(ConfigItem(plan_id=pid, content_type="photo", photo_file_id=file_id))
+        def add_photo_config(db):
+            stock_counters.add(db, pid, content_type="photo", photo_file_id=file_id)
             db.commit()
-            await update.effective_message.reply_text("یک کانفیگ عکس اضافه شد ✅ (برای پایان «✅ اتمام»)")
-        finally: db.close()
+        await run_db(add_photo_config)
+        await update.effective_message.reply_text("یک کانفیگ عکس اضافه شد ✅ (برای پایان «✅ اتمام»)")
         return
 
-async def on_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    # همه متنی‌ها اول برن fallback_text (استیت‌ماشین مدیریت می‌کند)
-    await fallback_text(update, context)
-
 # ==============================
 # Special -> Admin entering amount (for receipts)
 # ==============================
-async def on_admin_enter_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    u = await ensure_user(update, context)
+async def admin_enter_amount(update: Update, context: ContextTypes.DEFAULT_TYPE, u: User, text: str):
     s = st(u.id)
     key="enter_amount_for_receipt"
     if key not in s: 
         return
     rid = s[key]
     try:
-        amt = float((update.effective_message.text or "0").strip())
+        amt = float(text or "0")
     except:
         await update.effective_message.reply_text("عدد معتبر بفرست 🙏")
         return
-    db=SessionLocal()
-    try:
-        r=db.query(Receipt).get(rid)
-        if not r or r.status!="PENDING":
-            del s[key]; return
-        # اعمال تأثیر: برای TOPUP -> افزایش کیف پول، برای DIFF -> تکمیل خرید
-        if r.kind=="TOPUP":
-            uu=db.query(User).get(r.user_id)
-            uu.wallet = max(0.0, (uu.wallet or 0.0) + amt)
-            r.amount_approved = amt
-            r.status="APPROVED"; r.reviewed_at=now(); r.admin_id=u.id
-            db.commit()
-            try:
-                await context.bot.send_message(chat_id=r.user_id, text=f"شارژ کیف پول تایید شد ✅\nمبلغ: {money(amt)}\nموجودی جدید: {money(uu.wallet)}")
-            except: pass
-            await update.effective_message.reply_text("شارژ کیف پول انجام شد ✅")
-        elif r.kind=="DIFF":
-            # تکمیل خرید با تحویل کانفیگ؛ مبلغ تاییدی اهمیتی برای کسر ندارد چون ما‌به‌تفاوت کارت به کارت بوده
-            r.amount_approved = amt
-            await fake_update_for_delivery(context, r.user_id, r.plan_id, r.price_due + 0.0)  # قیمت نهایی همان اختلاف + موجودی قبلی که قبلاً کسر نمی‌شود؛ سناریو: خرید با کیف پول ناقص + diff کارتی -> تحویل کامل
-            r.status="APPROVED"; r.reviewed_at=now(); r.admin_id=u.id
-            db.commit()
-            await update.effective_message.reply_text("پرداخت ما‌به‌تفاوت تایید شد ✅ و کانفیگ ارسال گردید.")
-        del s[key]
-    finally:
-        db.close()
+    # اعمال تأثیر: برای TOPUP -> افزایش کیف پول، برای DIFF -> تکمیل خرید
+    r, ok = await run_db(db_review_receipt, rid, u.id, "APPROVED", ("TOPUP","DIFF"), amt)
+    if not ok:
+        del s[key]; return
+    if r.kind=="TOPUP":
+        try:
+            await context.bot.send_message(chat_id=r.user_id, text=f"شارژ کیف پول تایید شد ✅\nمبلغ: {money(amt)}\nموجودی جدید: {money(r.user_wallet)}")
+        except: pass
+        await update.effective_message.reply_text("شارژ کیف پول انجام شد ✅")
+    elif r.kind=="DIFF":
+        # تکمیل خرید با تحویل کانفیگ؛ مبلغ تاییدی اهمیتی برای کسر ندارد چون ما‌به‌تفاوت کارت به کارت بوده
+        await fake_update_for_delivery(context, r.user_id, r.plan_id, r.price_due + 0.0)  # قیمت نهایی همان اختلاف + موجودی قبلی که قبلاً کسر نمی‌شود؛ سناریو: خرید با کیف پول ناقص + diff کارتی -> تحویل کامل
+        await update.effective_message.reply_text("پرداخت ما‌به‌تفاوت تایید شد ✅ و کانفیگ ارسال گردید.")
+    del s[key]
 
 # ==============================
 # Commands (User shortcuts)
@@ -1465,41 +2866,500 @@ async def cmd_plan(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await show_plan_detail(update, context, update.effective_user.id, pid)
 
 # ==============================
-# Message Router for specific text buttons inside sections
+# Broadcast (job پس‌زمینه، قابل ادامه بعد از ری‌استارت)
 # ==============================
-async def router_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    text=(update.effective_message.text or "").strip()
+BROADCAST_CHUNK       = int(os.getenv("BROADCAST_CHUNK", "200"))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "25"))
+BROADCAST_EDIT_SEC    = float(os.getenv("BROADCAST_EDIT_SEC", "3"))
+
+BROADCAST_STATUS = {"RUNNING":"در حال ارسال ⏳", "PAUSED":"متوقف ⏸", "CANCELLED":"لغو شد ✖️", "DONE":"تمام شد ✅"}
+
+@functools.lru_cache(maxsize=64)
+def kb_broadcast_actions(jid:int, status:str):
+    if status == "RUNNING":
+        row = [InlineKeyboardButton("⏸ توقف", callback_data=f"bc_pause:{jid}")]
+    elif status == "PAUSED":
+        row = [InlineKeyboardButton("▶️ ادامه", callback_data=f"bc_resume:{jid}")]
+    else:
+        return None
+    row.append(InlineKeyboardButton("✖️ لغو", callback_data=f"bc_cancel:{jid}"))
+    return StaticInlineKeyboard([row])
+
+def broadcast_progress_text(j: BroadcastJob) -> str:
+    done = j.sent + j.failed
+    pct = min(100, int(done * 100 / j.total)) if j.total else 100  # jobهای قدیمی بدون last_user_id
+    return (
+        f"📢 اعلان همگانی #{j.id} — {BROADCAST_STATUS.get(j.status, j.status)}\n"
+        f"پیشرفت: {done}/{j.total} ({pct}%)\n"
+        f"✅ موفق: {j.sent} | ❌ ناموفق: {j.failed}"
+    )
 
-    if text=="🆕 تیکت جدید":
-        await ticket_new(update, context, update.effective_user.id); return
-    if text=="📚 سابقه تیکت‌ها":
-        await ticket_history(update, context, update.effective_user.id); return
+class BroadcastEngine:
+    # کاربرها chunk به chunk با keyset (users.id > cursor) خونده می‌شن، همزمان ارسال می‌شن
+    # (ریت رو OutboundLimiter کنترل می‌کنه) و بعد از هر chunk چک‌پوینت می‌خوره.
+    def __init__(self):
+        self.tasks: Dict[int, asyncio.Task] = {}
+
+    async def _load(self, jid:int) -> Optional[BroadcastJob]:
+        return await run_db(lambda db: db.get(BroadcastJob, jid, populate_existing=True))
+
+    async def create(self, bot, admin_id:int, text:str) -> int:
+        def create_job(db):
+            total, last = db.query(func.count(User.id), func.max(User.id)).one()
+            j = BroadcastJob(admin_id=admin_id, text=text, status="RUNNING", total=total, last_user_id=last or 0)
+            db.add(j); db.commit()
+            return j
+        j = await run_db(create_job)
+        m = await bot.send_message(chat_id=admin_id, text=broadcast_progress_text(j), reply_markup=kb_broadcast_actions(j.id, j.status))
+        def set_progress_message(db):
+            db.query(BroadcastJob).filter(BroadcastJob.id==j.id).update(
+                {"progress_chat_id":m.chat_id, "progress_message_id":m.message_id}, synchronize_session=False)
+            db.commit()
+        await run_db(set_progress_message)
+        self.launch(bot, j.id)
+        return j.id
+
+    def launch(self, bot, jid:int):
+        t = self.tasks.get(jid)
+        if t and not t.done():
+            return
+        self.tasks[jid] = spawn_background(self._run(bot, jid))
+
+    async def resume_all(self, bot):
+        ids = await run_db(lambda db: [jid for (jid,) in db.query(BroadcastJob.id).filter(BroadcastJob.status=="RUNNING").all()])
+        for jid in ids:
+            self.launch(bot, jid)
+
+    async def control(self, bot, jid:int, action:str):
+        new = {"pause":"PAUSED", "resume":"RUNNING", "cancel":"CANCELLED"}[action]
+        def set_status(db):
+            j = db.get(BroadcastJob, jid, populate_existing=True)
+            if not j or j.status in ("DONE","CANCELLED"): return False
+            j.status = new
+            if new == "CANCELLED": j.finished_at = now()
+            db.commit()
+            return True
+        if not await run_db(set_status): return
+        # taskِ در حال اجرا بعد از chunk فعلی وضعیت رو می‌بینه و خارج می‌شه
+        if new == "RUNNING":
+            self.launch(bot, jid)
+        await self._show(bot, await self._load(jid))
+
+    async def _show(self, bot, j: Optional[BroadcastJob]):
+        if not j or not j.progress_message_id: return
+        try:
+            await bot.edit_message_text(chat_id=j.progress_chat_id, message_id=j.progress_message_id,
+                                        text=broadcast_progress_text(j), reply_markup=kb_broadcast_actions(j.id, j.status))
+        except Exception:
+            pass  # "message is not modified" و ...
+
+    async def _send(self, bot, sem: asyncio.Semaphore, uid:int, text:str) -> bool:
+        async with sem:
+            try:
+                await bot.send_message(chat_id=uid, text=f"📣 {text}", rate_limit_args={"priority": "bulk"})
+                return True
+            except Exception:
+                return False
+
+    def _next_chunk(self, db, jid:int) -> Tuple[Optional[BroadcastJob], List[int]]:
+        # populate_existing: status/cursor باید از خود دیتابیس بیاد، نه نسخه‌ی identity map سشن
+        # (شمارنده‌ها با UPDATE گروهی بدون synchronize_session نوشته میشن)
+        j = db.get(BroadcastJob, jid, populate_existing=True)
+        if not j or j.status != "RUNNING":
+            return j, []
+        q = db.query(User.id).filter(User.id > j.cursor)
+        if j.last_user_id is not None:
+            q = q.filter(User.id <= j.last_user_id)
+        ids = [uid for (uid,) in q.order_by(User.id.asc()).limit(BROADCAST_CHUNK).all()]
+        if not ids:
+            db.query(BroadcastJob).filter(BroadcastJob.id==jid, BroadcastJob.status=="RUNNING").update(
+                {"status":"DONE", "finished_at":now()}, synchronize_session=False)
+            db.commit()
+        return j, ids
+
+    def _checkpoint(self, db, jid:int, cursor:int, ok:int, bad:int):
+        # فقط شمارنده‌ها و cursor؛ status ممکنه وسطش pause/cancel شده باشه
+        db.query(BroadcastJob).filter(BroadcastJob.id==jid).update({
+            "cursor": cursor,
+            "sent": BroadcastJob.sent + ok,
+            "failed": BroadcastJob.failed + bad,
+        }, synchronize_session=False)
+        db.commit()
+
+    async def _run(self, bot, jid:int):
+        sem = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+        last_edit = 0.0
+        while True:
+            j, ids = await run_db(self._next_chunk, jid)
+            if not ids:
+                break
+            results = await asyncio.gather(*(self._send(bot, sem, uid, j.text) for uid in ids))
+            ok = sum(1 for r in results if r)
+            await run_db(self._checkpoint, jid, ids[-1], ok, len(ids) - ok)
+            if time.monotonic() - last_edit >= BROADCAST_EDIT_SEC:
+                last_edit = time.monotonic()
+                await self._show(bot, await self._load(jid))
+        # اول از tasks خارج شو، بعد وضعیت رو دوباره بخون: resume ای که بین pause و اینجا اومده
+        # launch رو با دیدن همین task (هنوز done نشده) رد کرده بود؛ پس خودمون دوباره راهش می‌ندازیم
+        if self.tasks.get(jid) is asyncio.current_task():
+            self.tasks.pop(jid)
+        j = await self._load(jid)
+        if j and j.status == "RUNNING" and jid not in self.tasks:
+            self.launch(bot, jid)
+        await self._show(bot, j)
+
+broadcasts = BroadcastEngine()
 
 # ==============================
 # Expiry notifier (background)
 # ==============================
+EXPIRY_MAX_SLEEP = float(os.getenv("EXPIRY_MAX_SLEEP", "21600"))  # سقف خواب بین دو اجرا (ثانیه)
+EXPIRY_SEND_CONCURRENCY = int(os.getenv("EXPIRY_SEND_CONCURRENCY", "25"))
+
+class ExpiryScheduler:
+    # به جای اسکن ساعتی همه‌ی خریدها، فقط چیزی که موعدش رسیده:
+    #  - یادآوری n روزه وقتی n <= زمان باقی‌مونده < n+1 روز (مثل قبل)، و فقط اگه توی دفتر expiry_reminders نباشه
+    #  - انقضا وقتی expire_at گذشته
+    # بعد تا نزدیک‌ترین موعد بعدی می‌خوابه؛ خرید جدید با wake() بیدارش می‌کنه.
+    def __init__(self):
+        self._wake: Optional[asyncio.Event] = None
+        self.runs = 0
+        self.reminders_sent = 0
+        self.expired = 0
+        self.next_due_at: Optional[dt.datetime] = None
+        self.last_run: Optional[Dict] = None
+
+    def _event(self) -> asyncio.Event:
+        if self._wake is None:
+            self._wake = asyncio.Event()
+        return self._wake
+
+    def wake(self):
+        self._event().set()
+
+    def due_reminders(self, db, t: dt.datetime) -> List[Tuple[int, str]]:
+        out = []
+        for d in sorted(set(settings.get("reminder_days"))):
+            rows = (db.query(Purchase.id, Purchase.user_id, Plan.name)
+                    .outerjoin(Plan, Plan.id == Purchase.plan_id)
+                    .filter(Purchase.active==True,
+                            Purchase.expire_at >= t + dt.timedelta(days=d),
+                            Purchase.expire_at < t + dt.timedelta(days=d + 1))
+                    .filter(~db.query(ExpiryReminder).filter(
+                        ExpiryReminder.purchase_id == Purchase.id, ExpiryReminder.days_before == d).exists())
+                    .all())
+            for pid, uid, plan_name in rows:
+                db.add(ExpiryReminder(purchase_id=pid, days_before=d, sent_at=t))
+                out.append((uid, f"یادآوری ⏳\nکانفیگ {plan_name} در {d} روز آینده منقضی میشه."))
+        return out
+
+    def expire_due(self, db, t: dt.datetime) -> List[Tuple[int, str]]:
+        # یک UPDATE ... WHERE active AND expire_at < now RETURNING برای همه؛ فقط ردیف‌هایی که
+        # همین statement غیرفعال کرده برمی‌گردن، پس رول‌آپ حتی با دو پروسه‌ی همزمان یک بار کم میشه
+        cols = (Purchase.id, Purchase.user_id, Purchase.plan_id, Purchase.created_at,
+                Purchase.price_paid, Purchase.discount_code)
+        due = (Purchase.active==True) & (Purchase.expire_at < t)
+        if db.get_bind().dialect.update_returning:
+            rows = db.execute(update(Purchase).where(due).values(active=False).returning(*cols)
+                              .execution_options(synchronize_session=False)).all()
+        else:
+            rows = db.execute(select(*cols).where(due)).all()
+            if rows:
+                db.execute(update(Purchase).where(Purchase.id.in_([r.id for r in rows]), Purchase.active==True)
+                           .values(active=False).execution_options(synchronize_session=False))
+        if not rows:
+            return []
+        plans = {pl.id: pl for pl in db.query(Plan).filter(Plan.id.in_({r.plan_id for r in rows})).all()}
+        # رول‌آپ: یک upsert به ازای هر (روز، پلن)، نه هر خرید
+        buckets: Dict[Tuple[dt.date, int], List[float]] = {}
+        out = []
+        for r in rows:
+            plan = plans.get(r.plan_id)
+            revenue, cost, discount = SalesRollup._amounts(r, plan)
+            b = buckets.setdefault((r.created_at.date(), r.plan_id), [0.0, 0.0, 0, 0.0])
+            b[0] -= revenue; b[1] -= cost; b[2] -= 1; b[3] -= discount
+            out.append((r.user_id, f"کانفیگ {plan.name if plan else '-'} منقضی شد و از «کانفیگ‌های من» حذف شد. ❤️"))
+        for (day, plan_id), (revenue, cost, count, discount) in buckets.items():
+            sales_rollup.add(db, day, plan_id, revenue, cost, count, discount)
+        return out
+
+    def next_due(self, db, t: dt.datetime) -> Optional[dt.datetime]:
+        # نزدیک‌ترین expire_at بعد از هر مرز (n+1 روز برای یادآوری‌ها، خود الان برای انقضا)، روی ایندکس (active, expire_at)
+        dues = []
+        for lead in [0] + [d + 1 for d in set(settings.get("reminder_days"))]:
+            e = (db.query(func.min(Purchase.expire_at))
+                 .filter(Purchase.active==True, Purchase.expire_at >= t + dt.timedelta(days=lead)).scalar())
+            if e is not None:
+                dues.append(e - dt.timedelta(days=lead))
+        return min(dues) if dues else None
+
+    def run_once(self, db) -> Tuple[List[Tuple[int, str]], int, Optional[dt.datetime]]:
+        t = now()
+        notices = self.due_reminders(db, t)
+        reminders = len(notices)
+        notices += self.expire_due(db, t)
+        # دفتر و غیرفعال‌سازی قبل از ارسال commit میشن: هر یادآوری حداکثر یک بار
+        db.commit()
+        self.runs += 1
+        self.reminders_sent += reminders
+        self.expired += len(notices) - reminders
+        self.next_due_at = self.next_due(db, t)
+        return notices, reminders, self.next_due_at
+
+    async def _send(self, bot, sem: asyncio.Semaphore, uid: int, text: str) -> bool:
+        async with sem:
+            try:
+                # از مسیر outbound (rate limiter) با اولویت bulk تا پیام‌های تعاملی عقب نیفتن
+                await bot.send_message(chat_id=uid, text=text, rate_limit_args={"priority": "bulk"})
+                return True
+            except Exception:
+                return False
+
+    async def run(self, bot) -> Optional[dt.datetime]:
+        t0 = time.perf_counter()
+        notices, reminders, due = await run_db(self.run_once)
+        if notices:
+            stats_cache.invalidate()
+        sem = asyncio.Semaphore(EXPIRY_SEND_CONCURRENCY)
+        results = await asyncio.gather(*(self._send(bot, sem, uid, msg) for uid, msg in notices))
+        ok = sum(1 for r in results if r)
+        self.last_run = {
+            "at": now().isoformat(), "reminders": reminders, "expired": len(notices) - reminders,
+            "sent": ok, "failed": len(notices) - ok, "duration_ms": round((time.perf_counter() - t0) * 1000, 1),
+        }
+        if notices:
+            print(f"⏳ expiry run: {self.last_run}")
+        return due
+
+    async def loop(self, app: Application):
+        wake = self._event()
+        while True:
+            wake.clear()
+            sleep = EXPIRY_MAX_SLEEP
+            try:
+                due = await self.run(app.bot)
+                if due is not None:
+                    sleep = min(sleep, max(1.0, (due - now()).total_seconds() + 1))
+            except Exception:
+                traceback.print_exc()
+                sleep = 60
+            try:
+                await asyncio.wait_for(wake.wait(), sleep)
+            except asyncio.TimeoutError:
+                pass
+
+    def metrics(self) -> Dict:
+        return {"runs": self.runs, "reminders_sent": self.reminders_sent, "expired": self.expired,
+                "next_due_at": self.next_due_at.isoformat() if self.next_due_at else None,
+                "last_run": self.last_run}
+
+expiry_scheduler = ExpiryScheduler()
+
 async def expiry_notifier(app: Application):
-    while True:
+    await expiry_scheduler.loop(app)
+
+# ==============================
+# Update Ingest (ack فوری وبهوک + worker pool)
+# ==============================
+INGEST_MODE       = os.getenv("INGEST_MODE", "queue").strip().lower()  # queue | inline
+INGEST_WORKERS    = int(os.getenv("INGEST_WORKERS", "8"))  # حداکثر کاربرهای همزمان
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "1000"))
+
+class UpdateIngest:
+    # وبهوک آپدیت رو توی lane همون کاربر (effective_user.id) می‌ذاره و سریع 200 برمی‌گردونه.
+    # آپدیت‌های یک کاربر دقیقاً به ترتیب و یکی‌یکی اجرا می‌شن تا step machine به هم نریزه،
+    # ولی کاربرهای مختلف همزمان پردازش می‌شن (حداکثر به تعداد workerها).
+    # صف ready فقط کلید laneهای منتظر رو نگه می‌داره؛ هر lane در هر لحظه دست حداکثر یک worker ـه.
+    def __init__(self, app: Application, workers: int, maxsize: int):
+        self.app = app
+        self.workers = max(1, workers)
+        self.maxsize = max(1, maxsize)
+        self.lanes: Dict[object, collections.deque] = {}
+        self.ready: asyncio.Queue = asyncio.Queue()
+        self.pending = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._tasks: List[asyncio.Task] = []
+        self.enqueued = 0
+        self.processed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.lanes_created = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    @staticmethod
+    def lane_key(update: Update):
+        tg = update.effective_user
+        # آپدیت بدون کاربر به ترتیب ربطی نداره؛ lane اختصاصی خودش رو می‌گیره
+        return tg.id if tg else ("update", update.update_id)
+
+    async def submit_wait(self, update: Update):
+        # برای polling: به جای drop صبر می‌کنیم جا باز بشه
+        while self.pending >= self.maxsize:
+            await asyncio.sleep(0.01)
+        self.submit(update)
+
+    def submit(self, update: Update) -> bool:
+        if self.pending >= self.maxsize:
+            self.dropped += 1
+            return False
+        key = self.lane_key(update)
+        lane = self.lanes.get(key)
+        if lane is None:
+            lane = self.lanes[key] = collections.deque()
+            self.lanes_created += 1
+            self.ready.put_nowait(key)
+        lane.append((time.monotonic(), update))
+        self.pending += 1
+        self.enqueued += 1
+        self._idle.clear()
+        return True
+
+    async def start(self):
+        for i in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._worker(), name=f"ingest-{i}"))
+
+    async def stop(self, drain_timeout: float = 10.0):
+        # اول صبر می‌کنیم همه‌ی laneها خالی بشن، بعد workerها رو می‌بندیم
         try:
-            db=SessionLocal()
+            await asyncio.wait_for(self._idle.wait(), drain_timeout)
+        except asyncio.TimeoutError:
+            pass
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+
+    async def _worker(self):
+        while True:
+            key = await self.ready.get()
+            lane = self.lanes[key]
+            t0, update = lane.popleft()
+            waited = time.monotonic() - t0
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
             try:
-                ps = db.query(Purchase).filter(Purchase.active==True).all()
-                for p in ps:
-                    days_left = (p.expire_at - now()).days
-                    msg=None
-                    if days_left in [5,3,1]:
-                        msg=f"یادآوری ⏳\nکانفیگ {p.plan.name} در {days_left} روز آینده منقضی میشه."
-                    elif days_left < 0:
-                        p.active=False
-                        msg=f"کانفیگ {p.plan.name} منقضی شد و از «کانفیگ‌های من» حذف شد. ❤️"
-                        db.commit()
-                    if msg:
-                        try: await app.bot.send_message(chat_id=p.user_id, text=msg)
-                        except: pass
+                await process_update_uow(self.app, update)
+                self.processed += 1
+            except Exception:
+                self.failed += 1
+                traceback.print_exc()
             finally:
-                db.close()
-        except: pass
-        await asyncio.sleep(3600)  # هر ساعت چک کن
+                self.pending -= 1
+                if lane:
+                    # بقیه‌ی آپدیت‌های همین کاربر پشت سر کاربرهای دیگه (round-robin)
+                    self.ready.put_nowait(key)
+                else:
+                    # lane بیکار رو نگه نمی‌داریم
+                    del self.lanes[key]
+                if self.pending == 0:
+                    self._idle.set()
+
+    def metrics(self) -> Dict:
+        started = self.processed + self.failed
+        return {
+            "mode": INGEST_MODE,
+            "workers": self.workers,
+            "queue_depth": self.pending,
+            "queue_max": self.maxsize,
+            "lanes_active": len(self.lanes),
+            "lanes_created": self.lanes_created,
+            "lane_max_depth": max((len(l) for l in self.lanes.values()), default=0),
+            "enqueued": self.enqueued,
+            "processed": self.processed,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "wait_avg_ms": round(self.wait_total / started * 1000, 2) if started else 0.0,
+            "wait_max_ms": round(self.wait_max * 1000, 2),
+        }
+
+ingest = UpdateIngest(application, INGEST_WORKERS, INGEST_QUEUE_SIZE)
+
+# ==============================
+# Update dedup (تلگرام وقتی وبهوک کند باشه آپدیت رو دوباره می‌فرسته)
+# ==============================
+DEDUP_SIZE      = int(os.getenv("DEDUP_SIZE", "20000"))
+DEDUP_TTL       = int(os.getenv("DEDUP_TTL", "3600"))  # ثانیه
+DEDUP_PERSIST   = os.getenv("DEDUP_PERSIST", "0") == "1"
+DEDUP_FLUSH_SEC = float(os.getenv("DEDUP_FLUSH_SEC", "5"))
+
+class UpdateDedup:
+    # update_id -> زمان دیدن؛ به ترتیب ورود، پس قدیمی‌ترها همیشه سر OrderedDict هستن
+    def __init__(self, maxsize: int, ttl: int, persist: bool):
+        self.maxsize = max(1, maxsize)
+        self.ttl = ttl
+        self.persist = persist
+        self.seen: "collections.OrderedDict[int, float]" = collections.OrderedDict()
+        self._unsaved: Dict[int, float] = {}
+        self.duplicates = 0
+        self.evicted = 0
+
+    def _evict(self, t: float):
+        cutoff = t - self.ttl
+        while self.seen:
+            uid, ts = next(iter(self.seen.items()))
+            if ts >= cutoff and len(self.seen) <= self.maxsize:
+                break
+            self.seen.popitem(last=False)
+            self.evicted += 1
+
+    def check(self, update_id: Optional[int]) -> bool:
+        # True یعنی تکراریه و باید دور ریخته بشه
+        if update_id is None:
+            return False
+        t = time.time()
+        if update_id in self.seen:
+            self.duplicates += 1
+            return True
+        self.seen[update_id] = t
+        if self.persist:
+            self._unsaved[update_id] = t
+        self._evict(t)
+        return False
+
+    def forget(self, update_id: Optional[int]):
+        # آپدیتی که پردازش نشد (مثلاً صف پر بود) باید retry بعدی‌ش قبول بشه
+        self.seen.pop(update_id, None)
+        self._unsaved.pop(update_id, None)
+
+    def load(self, db):
+        if not self.persist:
+            return
+        rows = (db.query(SeenUpdate.update_id, SeenUpdate.seen_at)
+                .filter(SeenUpdate.seen_at >= time.time() - self.ttl)
+                .order_by(SeenUpdate.seen_at.desc()).limit(self.maxsize).all())
+        for uid, ts in reversed(rows):
+            self.seen[uid] = ts
+
+    def flush(self, db):
+        if not self.persist:
+            return
+        batch, self._unsaved = self._unsaved, {}
+        for uid, ts in batch.items():
+            db.merge(SeenUpdate(update_id=uid, seen_at=ts))
+        db.query(SeenUpdate).filter(SeenUpdate.seen_at < time.time() - self.ttl).delete()
+        db.commit()
+
+    async def flush_loop(self):
+        while True:
+            await asyncio.sleep(DEDUP_FLUSH_SEC)
+            try:
+                await run_db(self.flush)
+            except Exception:
+                traceback.print_exc()
+
+    def metrics(self) -> Dict:
+        return {
+            "size": len(self.seen),
+            "max": self.maxsize,
+            "ttl_sec": self.ttl,
+            "persist": self.persist,
+            "duplicates": self.duplicates,
+            "evicted": self.evicted,
+        }
+
+dedup = UpdateDedup(DEDUP_SIZE, DEDUP_TTL, DEDUP_PERSIST)
 
 # ==============================
 # FastAPI & Webhook
@@ -1509,11 +3369,25 @@ api = FastAPI()
 class TgUpdate(BaseModel):
     update_id: int
 
-@api.on_event("startup")
-async def on_startup():
+# تسک‌های دائمی؛ application.stop() منتظر تسک‌های create_task می‌مونه، پس اینها جدا نگه داشته و cancel می‌شن
+# تسک تموم‌شده (مثلاً اعلان همگانی) خودش از مجموعه حذف میشه تا تا آخر عمر پروسه جمع نشن
+background_tasks: set[asyncio.Task] = set()
+
+def spawn_background(coro) -> asyncio.Task:
+    # context خالی: create_task وگرنه contextvarهای آپدیتِ جاری (current_uow، current_states) رو کپی می‌کنه
+    # و job (مثلاً اعلان همگانی که از هندلر شروع شده) بعد از تموم شدن آپدیت روی سشن اون کار می‌کرد
+    t = asyncio.create_task(coro, context=contextvars.Context())
+    background_tasks.add(t)
+    t.add_done_callback(background_tasks.discard)
+    return t
+
+async def start_bot(webhook: bool = True):
     # مهم: initialize قبل از start برای HTTPXRequest
     await application.initialize()
-    await application.bot.set_webhook(WEBHOOK_URL, allowed_updates=["message","callback_query"])
+    if webhook:
+        await application.bot.set_webhook(WEBHOOK_URL, allowed_updates=ALLOWED_UPDATES)
+    else:
+        await application.bot.delete_webhook()
     await application.start()
     # set commands (optional)
     try:
@@ -1524,31 +3398,120 @@ async def on_startup():
             BotCommand("add_admin","افزودن ادمین (ادمین)"),
             BotCommand("del_admin","حذف ادمین (ادمین)"),
             BotCommand("reset_stats","ریست آمار (ادمین)"),
+            BotCommand("top_buyers","خریداران برتر (ادمین)"),
         ])
     except: pass
+    await run_db(cache_sync)
+    await run_db(sales_rollup.ensure)
+    spawn_background(cache_sync_loop())
+    spawn_background(state_store.flush_loop())
+    spawn_background(stock_counters.reconcile_loop())
+    if inventory.size:
+        spawn_background(inventory.refill_loop())
+    if INGEST_MODE == "queue" or not webhook:
+        await ingest.start()
+    if dedup.persist:
+        await run_db(dedup.load)
+        spawn_background(dedup.flush_loop())
     # run notifier
-    application.create_task(expiry_notifier(application))
+    spawn_background(expiry_notifier(application))
+    # اعلان‌های نیمه‌کاره قبل از ری‌استارت
+    spawn_background(broadcasts.resume_all(application.bot))
+
+async def stop_bot():
+    for t in background_tasks:
+        t.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    await ingest.stop()
+    await run_db(dedup.flush)
+    await state_store.flush()
+    if inventory.size:
+        await run_db(inventory.release)
+    await application.stop()
+    await application.shutdown()
+
+@api.on_event("startup")
+async def on_startup():
+    await start_bot(webhook=True)
     print("✅ Bot started & webhook set.")
 
 @api.on_event("shutdown")
 async def on_shutdown():
-    await application.stop()
-    await application.shutdown()
+    await stop_bot()
 
 @api.post(WEBHOOK_PATH)
 async def webhook(req: Request):
     data = await req.json()
+    update_id = data.get("update_id")
+    if dedup.check(update_id):
+        # retry تلگرام؛ قبلاً گرفتیمش
+        return JSONResponse({"ok": True})
     update = Update.de_json(data, application.bot)
-    try:
-        await application.process_update(update)
-    except Exception as e:
-        traceback.print_exc()
+    if INGEST_MODE == "inline":
+        try:
+            await process_update_uow(application, update)
+        except Exception as e:
+            traceback.print_exc()
+        return JSONResponse({"ok": True})
+    if not ingest.submit(update):
+        # صف پره؛ تلگرام بعداً دوباره می‌فرسته
+        dedup.forget(update_id)
+        return JSONResponse({"ok": False, "error": "queue full"}, status_code=503)
     return JSONResponse({"ok": True})
 
 @api.get("/")
 async def health():
     return PlainTextResponse("OK")
 
+@api.get("/metrics")
+async def metrics():
+    return JSONResponse({
+        "ingest": ingest.metrics(), "dedup": dedup.metrics(), "outbound": outbound.metrics(),
+        "db_sessions": session_stats.metrics(), "admin_cache": admin_cache.metrics(),
+        "settings": settings.metrics(), "stock": stock_counters.metrics(),
+        "inventory": inventory.metrics(), "stats_cache": stats_cache.metrics(),
+        "expiry": expiry_scheduler.metrics(), "state": state_store.metrics(),
+        "router": router.metrics(), "keyboards": keyboard_metrics(),
+    })
+
+# Procfile از main:app استفاده می‌کنه
+app = api
+
+# ==============================
+# Long polling runner (بدون URL عمومی؛ همون ingest/handlerها)
+# ==============================
+POLL_TIMEOUT = int(os.getenv("POLL_TIMEOUT", "30"))
+
+async def poll_updates(stop: Optional[asyncio.Event] = None):
+    offset = None
+    backoff = 1.0
+    while not (stop and stop.is_set()):
+        try:
+            updates = await application.bot.get_updates(
+                offset=offset, timeout=POLL_TIMEOUT, allowed_updates=ALLOWED_UPDATES,
+                read_timeout=POLL_TIMEOUT + 10,
+            )
+            backoff = 1.0
+        except Exception:
+            traceback.print_exc()
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 30.0)
+            continue
+        for update in updates:
+            offset = update.update_id + 1
+            if dedup.check(update.update_id):
+                continue
+            await ingest.submit_wait(update)
+
+async def run_polling():
+    await start_bot(webhook=False)
+    print("✅ Bot started (long polling).")
+    try:
+        await poll_updates()
+    finally:
+        await stop_bot()
+
 # ==============================
 # PTB Handlers registration
 # ==============================
@@ -1558,17 +3521,13 @@ application.add_handler(CommandHandler("del_admin", cmd_del_admin))
 application.add_handler(CommandHandler("new_discount", cmd_new_discount))
 application.add_handler(CommandHandler("new_plan", cmd_new_plan))
 application.add_handler(CommandHandler("reset_stats", cmd_reset_stats))
+application.add_handler(CommandHandler("top_buyers", cmd_top_buyers))
 application.add_handler(MessageHandler(filters.Regex(r"^/plan_\d+$"), cmd_plan))
 
-# دکمه‌های منوها
-application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, router_buttons))
-
-# متن‌ها (fallback/state)
+# همه‌ی متن‌ها (دکمه‌ها + ورودی stepها) از یک ورودی و جدول router
+application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, on_text))
+# رسیدها و کانفیگ‌های عکسی
 application.add_handler(MessageHandler(filters.PHOTO, on_photo))
-# مسیر ویژه ورود مبلغ تایید رسید (ادمین)
-application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, on_admin_enter_amount))
-# بقیه‌ی متنی‌ها
-application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, on_text_message))
 
 application.add_handler(CallbackQueryHandler(on_callback))
 
@@ -1576,3 +3535,17 @@ application.add_handler(CallbackQueryHandler(on_callback))
 # Run (Uvicorn expects `api` as ASGI app)
 # ==============================
 # uvicorn main:api --host 0.0.0.0 --port 8000
+# python main.py poll            (long polling؛ با FAKE_BOT_API=1 کاملاً آفلاین)
+# python main.py rebuild_rollup  (ساخت دوباره‌ی sales_daily از روی purchases)
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("mode", nargs="?", choices=["webhook", "poll", "rebuild_rollup"], default="webhook")
+    args = parser.parse_args()
+    if args.mode == "rebuild_rollup":
+        print(f"sales_daily: {asyncio.run(run_db(sales_rollup.rebuild))} rows rebuilt")
+    elif args.mode == "poll":
+        asyncio.run(run_polling())
+    else:
+        import uvicorn
+        uvicorn.run(api, host="0.0.0.0", port=int(os.getenv("PORT", "8000")))
@@ -0,0 +1,20 @@
+"""baseline: schema as created by Base.metadata.create_all
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-18
+"""
+
+revision = "0001"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # جدول‌ها رو create_all در main.py می‌سازه؛ این نسخه فقط نقطه‌ی شروع تاریخچه‌ست
+    pass
+
+
+def downgrade():
+    pass
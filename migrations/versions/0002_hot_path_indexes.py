@@ -0,0 +1,39 @@
+"""hot-path composite indexes
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18
+"""
+from alembic import op
+
+revision = "0002"
+down_revision = "0001"
+branch_labels = None
+depends_on = None
+
+# (name, table, columns) — هم‌ترتیب با فیلتر/ORDER BY کوئری‌ها
+INDEXES = [
+    # my_configs: user_id=? AND active=? ORDER BY created_at
+    ("ix_purchases_user_active_created", "purchases", ["user_id", "active", "created_at"]),
+    # آمار فروش / expiry_notifier: active=? AND created_at>=?
+    ("ix_purchases_active_created", "purchases", ["active", "created_at"]),
+    # رسیدهای در انتظار: status=? ORDER BY created_at
+    ("ix_receipts_status_created", "receipts", ["status", "created_at"]),
+    # plan_stock و تحویل: plan_id=? ORDER BY id
+    ("ix_config_repo_plan_id", "config_repo", ["plan_id", "id"]),
+    # تیکت‌های من: user_id=? ORDER BY created_at
+    ("ix_tickets_user_created", "tickets", ["user_id", "created_at"]),
+    # پیدا کردن کاربر با @username در پنل ادمین
+    ("ix_users_username", "users", ["username"]),
+]
+
+
+def upgrade():
+    # دیتابیس‌های تازه این ایندکس‌ها رو از create_all گرفتن
+    for name, table, cols in INDEXES:
+        op.create_index(name, table, cols, if_not_exists=True)
+
+
+def downgrade():
+    for name, table, _cols in reversed(INDEXES):
+        op.drop_index(name, table_name=table, if_exists=True)
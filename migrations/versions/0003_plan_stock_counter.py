@@ -0,0 +1,26 @@
+"""plans.stock: materialized config_repo count per plan
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0003"
+down_revision = "0002"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    cols = {c["name"] for c in sa.inspect(op.get_bind()).get_columns("plans")}
+    if "stock" not in cols:
+        op.add_column("plans", sa.Column("stock", sa.Integer(), nullable=False, server_default="0"))
+    # مقدار اولیه از روی خود مخزن
+    op.execute("UPDATE plans SET stock = (SELECT COUNT(*) FROM config_repo WHERE config_repo.plan_id = plans.id)")
+
+
+def downgrade():
+    with op.batch_alter_table("plans") as batch:
+        batch.drop_column("stock")
@@ -0,0 +1,27 @@
+"""config_repo lease columns for the in-memory delivery buffer
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0004"
+down_revision = "0003"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    cols = {c["name"] for c in sa.inspect(op.get_bind()).get_columns("config_repo")}
+    if "reserved_by" not in cols:
+        op.add_column("config_repo", sa.Column("reserved_by", sa.String(32), nullable=True))
+    if "reserved_until" not in cols:
+        op.add_column("config_repo", sa.Column("reserved_until", sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table("config_repo") as batch:
+        batch.drop_column("reserved_until")
+        batch.drop_column("reserved_by")
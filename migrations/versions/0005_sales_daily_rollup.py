@@ -0,0 +1,32 @@
+"""sales_daily: per-day, per-plan rollup of active purchases
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0005"
+down_revision = "0004"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if "sales_daily" in sa.inspect(op.get_bind()).get_table_names():
+        return
+    # پر کردن از روی تاریخچه با main.sales_rollup.ensure (استارت‌آپ) یا «python main.py rebuild_rollup»
+    op.create_table(
+        "sales_daily",
+        sa.Column("day", sa.Date(), primary_key=True),
+        sa.Column("plan_id", sa.Integer(), primary_key=True),
+        sa.Column("revenue", sa.Float(), nullable=False, server_default="0"),
+        sa.Column("cost", sa.Float(), nullable=False, server_default="0"),
+        sa.Column("count", sa.Integer(), nullable=False, server_default="0"),
+        sa.Column("discount", sa.Float(), nullable=False, server_default="0"),
+    )
+
+
+def downgrade():
+    op.drop_table("sales_daily")
@@ -0,0 +1,24 @@
+"""purchases(active, created_at, user_id) for the top buyers report
+
+Replaces ix_purchases_active_created, which is a prefix of the new index.
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-18
+"""
+from alembic import op
+
+revision = "0006"
+down_revision = "0005"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index("ix_purchases_active_created_user", "purchases", ["active", "created_at", "user_id"], if_not_exists=True)
+    op.drop_index("ix_purchases_active_created", table_name="purchases", if_exists=True)
+
+
+def downgrade():
+    op.create_index("ix_purchases_active_created", "purchases", ["active", "created_at"], if_not_exists=True)
+    op.drop_index("ix_purchases_active_created_user", table_name="purchases", if_exists=True)
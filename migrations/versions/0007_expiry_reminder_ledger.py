@@ -0,0 +1,29 @@
+"""expiry reminder ledger + purchases(active, expire_at)
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0007"
+down_revision = "0006"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if "expiry_reminders" not in sa.inspect(op.get_bind()).get_table_names():
+        op.create_table(
+            "expiry_reminders",
+            sa.Column("purchase_id", sa.Integer(), sa.ForeignKey("purchases.id"), primary_key=True),
+            sa.Column("days_before", sa.Integer(), primary_key=True),
+            sa.Column("sent_at", sa.DateTime(), nullable=False),
+        )
+    op.create_index("ix_purchases_active_expire", "purchases", ["active", "expire_at"], if_not_exists=True)
+
+
+def downgrade():
+    op.drop_index("ix_purchases_active_expire", table_name="purchases", if_exists=True)
+    op.drop_table("expiry_reminders")
@@ -0,0 +1,29 @@
+"""user_states table (persistent conversation state)
+
+Revision ID: 0008
+Revises: 0007
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0008"
+down_revision = "0007"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if "user_states" not in sa.inspect(op.get_bind()).get_table_names():
+        op.create_table(
+            "user_states",
+            sa.Column("user_id", sa.Integer(), primary_key=True),
+            sa.Column("data", sa.Text(), nullable=False),
+            sa.Column("expires_at", sa.Float(), nullable=False),
+        )
+    op.create_index("ix_user_states_expires_at", "user_states", ["expires_at"], if_not_exists=True)
+
+
+def downgrade():
+    op.drop_index("ix_user_states_expires_at", table_name="user_states", if_exists=True)
+    op.drop_table("user_states")
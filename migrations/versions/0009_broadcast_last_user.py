@@ -0,0 +1,27 @@
+"""broadcast_jobs.last_user_id: recipients fixed at job creation
+
+Revision ID: 0009
+Revises: 0008
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0009"
+down_revision = "0008"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    insp = sa.inspect(op.get_bind())
+    if "broadcast_jobs" not in insp.get_table_names():
+        return
+    cols = {c["name"] for c in insp.get_columns("broadcast_jobs")}
+    if "last_user_id" not in cols:
+        op.add_column("broadcast_jobs", sa.Column("last_user_id", sa.Integer(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table("broadcast_jobs") as batch:
+        batch.drop_column("last_user_id")